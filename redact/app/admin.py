@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import modelTrainingData
+from .models import trainingLabel, redactionJob, trainingRun
 # Register your models here.
 
-admin.site.register(modelTrainingData)
-
+admin.site.register(trainingLabel)
+admin.site.register(redactionJob)
+admin.site.register(trainingRun)
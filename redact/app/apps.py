@@ -1,6 +1,28 @@
+import os
+import sys
 from django.apps import AppConfig
+from django.conf import settings
+
+# Set in the environment of training processes, which never warm the serving models
+TRAINING_PROCESS_ENV = 'REDACT_TRAINING_PROCESS'
 
 
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        if not settings.WARM_MODELS_ON_STARTUP:
+            return
+        # Training processes load the model they train themselves, and inherit the argv and environment of the server
+        if os.environ.get(TRAINING_PROCESS_ENV):
+            return
+        # Only serving processes warm the models, management commands load them on demand
+        if os.path.basename(sys.argv[0]) == 'manage.py' and 'runserver' not in sys.argv:
+            return
+        # The runserver autoreloader parent only watches files, the child process serves requests
+        if 'runserver' in sys.argv and '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+            return
+
+        from .services.registry import model_registry
+        model_registry.warm()
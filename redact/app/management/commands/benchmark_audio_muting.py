@@ -0,0 +1,61 @@
+import os
+import random
+import time
+import wave
+from tempfile import TemporaryDirectory
+import numpy as np
+from pydub import AudioSegment
+from django.core.management.base import BaseCommand
+from app.services.muting import redact_wav
+
+
+# The previous export: the whole recording rebuilt once per redacted timestamp
+def legacy_export_redacted_audio(audio_path, output_path, redacted_timestamps):
+    audio = AudioSegment.from_file(audio_path)
+    for start_time, end_time in redacted_timestamps:
+        if 0 <= start_time < len(audio) and 0 < end_time <= len(audio):
+            silence = AudioSegment.silent(duration=end_time - start_time)
+            audio = audio[:start_time] + silence + audio[end_time:]
+    audio.export(output_path, format='wav')
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks block-wise in-place audio muting against rebuilding the AudioSegment per redacted word."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=30, help="Length of the recording.")
+        parser.add_argument('--rate', type=int, default=16_000, help="Sample rate of the recording.")
+        parser.add_argument('--timestamps', nargs='+', type=int, default=[100, 1_000], help="Numbers of redacted words.")
+        parser.add_argument('--skip-legacy', action='store_true', help="Only time the block-wise muting.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        length_ms = options['minutes'] * 60_000
+        self.stdout.write(f"{'words':>6} {'minutes':>8} {'muting s':>9} {'legacy s':>9} {'speedup':>8}")
+
+        with TemporaryDirectory() as directory:
+            audio_path = os.path.join(directory, 'recording.wav')
+            with wave.open(audio_path, 'wb') as recording:
+                recording.setnchannels(1)
+                recording.setsampwidth(2)
+                recording.setframerate(options['rate'])
+                for _ in range(options['minutes']):
+                    recording.writeframes(np.random.default_rng(42).integers(-2000, 2000, 60 * options['rate'], dtype=np.int16).tobytes())
+
+            for count in options['timestamps']:
+                starts = sorted(rng.randrange(0, length_ms - 1_000) for _ in range(count))
+                timestamps = [(start, start + rng.randint(200, 800)) for start in starts]
+
+                start_time = time.perf_counter()
+                redact_wav(audio_path, os.path.join(directory, 'muted.wav'), timestamps)
+                elapsed = time.perf_counter() - start_time
+
+                if options['skip_legacy']:
+                    self.stdout.write(f"{count:>6} {options['minutes']:>8} {elapsed:>9.2f} {'-':>9} {'-':>8}")
+                    continue
+
+                start_time = time.perf_counter()
+                legacy_export_redacted_audio(audio_path, os.path.join(directory, 'legacy.wav'), timestamps)
+                legacy_elapsed = time.perf_counter() - start_time
+                self.stdout.write(f"{count:>6} {options['minutes']:>8} {elapsed:>9.2f} {legacy_elapsed:>9.2f} {legacy_elapsed / elapsed:>7.1f}x")
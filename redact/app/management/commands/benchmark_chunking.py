@@ -0,0 +1,34 @@
+import resource
+import time
+from django.core.management.base import BaseCommand
+from app.services.chunking import detect_entities, get_chunker
+from app.services.registry import model_registry
+from app.management.samples import build_document
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks sliding-window chunked NER throughput against document size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[2_000, 20_000, 200_000, 2_000_000], help="Document sizes in characters.")
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per size, the fastest is reported.")
+
+    def handle(self, *args, **options):
+        assistant = model_registry.get_assistant()
+        self.stdout.write(f"{'chars':>10} {'windows':>8} {'entities':>9} {'seconds':>9} {'chars/s':>10} {'max RSS MB':>11}")
+
+        for size in options['sizes']:
+            text = build_document(size)
+            windows = sum(1 for _ in get_chunker(assistant.tokenizer).windows(text))
+
+            best = None
+            for _ in range(options['repeat']):
+                start_time = time.perf_counter()
+                entities = detect_entities(assistant, text, aggregation_strategy="first")
+                elapsed = time.perf_counter() - start_time
+                best = elapsed if best is None else min(best, elapsed)
+
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            self.stdout.write(f"{len(text):>10} {windows:>8} {len(entities):>9} {best:>9.2f} {len(text) / best:>10.0f} {max_rss:>11.0f}")
+
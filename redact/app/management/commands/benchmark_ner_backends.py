@@ -0,0 +1,56 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from app.services.registry import load_pipeline
+from app.management.samples import build_sentences
+
+
+# Entities as comparable (entity_group, word) pairs
+def entity_set(entities):
+    return {(entity['entity_group'], entity['word'].strip()) for entity in entities}
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Compares latency and entity agreement of the ONNX backends with the PyTorch agent."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backends', nargs='+', default=['onnx', 'onnx-int8'], help="Backends compared against 'pytorch'.")
+        parser.add_argument('--samples', type=int, default=200, help="Number of sentences to run.")
+        parser.add_argument('--warmup', type=int, default=5, help="Untimed runs before measuring.")
+
+    def handle(self, *args, **options):
+        texts = build_sentences(options['samples'])
+
+        reference, reference_latencies = self.run_backend('pytorch', texts, options['warmup'])
+        self.stdout.write(f"{'backend':>10} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>8} {'exact':>7} {'precision':>10} {'recall':>7}")
+        self.report('pytorch', reference_latencies, reference_latencies, reference, reference)
+
+        for backend in options['backends']:
+            outputs, latencies = self.run_backend(backend, texts, options['warmup'])
+            self.report(backend, latencies, reference_latencies, outputs, reference)
+
+    def run_backend(self, backend, texts, warmup):
+        assistant = load_pipeline(backend)
+        for text in texts[:warmup]:
+            assistant(text, aggregation_strategy="first")
+
+        outputs = []
+        latencies = []
+        for text in texts:
+            start_time = time.perf_counter()
+            outputs.append(entity_set(assistant(text, aggregation_strategy="first")))
+            latencies.append((time.perf_counter() - start_time) * 1000)
+        return outputs, latencies
+
+    def report(self, backend, latencies, reference_latencies, outputs, reference):
+        exact = sum(output == expected for output, expected in zip(outputs, reference)) / len(reference)
+        found = sum(len(output) for output in outputs)
+        expected = sum(len(expected) for expected in reference)
+        agreed = sum(len(output & expected) for output, expected in zip(outputs, reference))
+        precision = agreed / found if found else 1.0
+        recall = agreed / expected if expected else 1.0
+
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        speedup = statistics.mean(reference_latencies) / statistics.mean(latencies)
+        self.stdout.write(f"{backend:>10} {statistics.mean(latencies):>8.1f} {statistics.median(latencies):>8.1f} {p95:>8.1f} {speedup:>7.2f}x {exact:>7.1%} {precision:>10.1%} {recall:>7.1%}")
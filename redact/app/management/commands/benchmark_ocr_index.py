@@ -0,0 +1,81 @@
+import random
+import time
+from types import SimpleNamespace
+from django.core.management.base import BaseCommand
+from app.services.document import AnalyzedDocument, SpanTable
+from app.services.ocr_index import OCRWordIndex
+from app.management.samples import build_document
+
+
+# The previous lookup: every redacted word tested against every OCR word of every page
+def legacy_redacted_words_coordinates(redacted_list, result):
+    redacted_cords = []
+    for page in result.pages:
+        redacted_cords_page = []
+        for word in page.words:
+            for redacted_word in redacted_list:
+                if len(redacted_word.strip()) <= 1 and not redacted_word.strip().isnumeric():
+                    continue
+                elif redacted_word in word.content or redacted_word.strip() in word.content.strip():
+                    redacted_cords_page.append([(polygon.x, polygon.y) for polygon in word.polygon])
+        redacted_cords.append(redacted_cords_page)
+    return redacted_cords
+
+
+# Synthetic AnalyzeResult, with the words of the document laid out in lines on each page
+def build_result(text, pages):
+    document = AnalyzedDocument(text)
+    words_per_page = -(-len(document.tokens) // pages)
+    result_pages = []
+    for page_index in range(pages):
+        words = []
+        for i in range(page_index * words_per_page, min((page_index + 1) * words_per_page, len(document.tokens))):
+            x, y = (i % 12) * 0.6, (i % words_per_page) // 12 * 0.2
+            polygon = [SimpleNamespace(x=x, y=y), SimpleNamespace(x=x + 0.5, y=y), SimpleNamespace(x=x + 0.5, y=y + 0.15), SimpleNamespace(x=x, y=y + 0.15)]
+            words.append(SimpleNamespace(content=document.tokens[i], span=SimpleNamespace(offset=document.token_starts[i], length=len(document.tokens[i])), polygon=polygon))
+        result_pages.append(SimpleNamespace(words=words, width=8.5, height=11))
+    return SimpleNamespace(content=text, pages=result_pages)
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks the OCR word index against testing every redacted word against every OCR word."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=200, help="Number of pages.")
+        parser.add_argument('--words-per-page', type=int, default=400, help="OCR words on each page.")
+        parser.add_argument('--terms', type=int, default=300, help="Number of redacted words.")
+
+    def handle(self, *args, **options):
+        text = build_document(options['pages'] * options['words_per_page'] * 6)
+        result = build_result(text, options['pages'])
+        words = [word.content for page in result.pages for word in page.words]
+        redacted_list = random.Random(42).sample(sorted(set(words)), min(options['terms'], len(set(words))))
+        self.stdout.write(f"{options['pages']} pages, {len(words)} OCR words, {len(redacted_list)} redacted words")
+
+        start_time = time.perf_counter()
+        index = OCRWordIndex(result)
+        build = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        redacted_cords = index.polygons_by_page(index.containing(redacted_list))
+        lookup = time.perf_counter() - start_time
+
+        spans = SpanTable()
+        spans.add_spans(AnalyzedDocument(text).occurrences(redacted_list), 'CUSTOM', 'custom')
+        start_time = time.perf_counter()
+        index.covered(spans)
+        covered = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        legacy_cords = legacy_redacted_words_coordinates(redacted_list, result)
+        legacy = time.perf_counter() - start_time
+
+        # The legacy loop appends a box once per matching redacted word, the index once per word
+        same = all(sorted(set(map(tuple, page))) == sorted(set(map(tuple, legacy_page))) for page, legacy_page in zip(redacted_cords, legacy_cords))
+        self.stdout.write(f"{'step':>18} {'seconds':>8}")
+        self.stdout.write(f"{'legacy loop':>18} {legacy:>8.3f}")
+        self.stdout.write(f"{'index build':>18} {build:>8.3f}")
+        self.stdout.write(f"{'term lookup':>18} {lookup:>8.3f}")
+        self.stdout.write(f"{'span coverage':>18} {covered:>8.3f}")
+        self.stdout.write(f"Speedup {legacy / (build + lookup):.1f}x including the build, same boxes as the legacy loop: {same}")
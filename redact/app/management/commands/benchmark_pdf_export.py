@@ -0,0 +1,103 @@
+import os
+import random
+import time
+import tracemalloc
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from django.core.management.base import BaseCommand
+from app.services.pdf_writer import redact_pdf_file
+
+
+# The previous exporter: a reportlab overlay drawn, saved and parsed back for every page, then merged
+# all_pages=False keeps its guard that only redacted the first two pages
+def legacy_export_redacted_pdf(pdf_path, output_path, redacted_cords, page_dims, all_pages=True):
+    reader = PdfReader(pdf_path)
+    writer = PdfWriter()
+
+    for page_num in range(len(reader.pages)):
+        page = reader.pages[page_num]
+        page_width = float(page.mediabox.width)
+        page_height = float(page.mediabox.height)
+        packet = BytesIO()
+        can = canvas.Canvas(packet, pagesize=letter)
+
+        if all_pages or page_num < 2:
+            for coord_set in redacted_cords[page_num]:
+                x_coords = [point[0] for point in coord_set]
+                y_coords = [point[1] for point in coord_set]
+                x_min, x_max = min(x_coords) / page_dims[page_num][0] * page_width, max(x_coords) / page_dims[page_num][0] * page_width
+                y_min, y_max = page_height - (min(y_coords) / page_dims[page_num][1] * page_height), page_height - (max(y_coords) / page_dims[page_num][1] * page_height)
+
+                can.setFillColorRGB(0, 0, 0)
+                can.rect(x_min, y_min, (x_max - x_min), (y_max - y_min), stroke=0, fill=1)
+
+        can.save()
+        packet.seek(0)
+        new_pdf = PdfReader(packet)
+        if new_pdf.pages:
+            page.merge_page(new_pdf.pages[0])
+        writer.add_page(page)
+
+    with open(output_path, 'wb') as output_file:
+        writer.write(output_file)
+
+
+# Writes a PDF of lines of text on every page, and boxes over some of its words as OCR would give them, in inches
+def build_pdf(path, pages, lines, boxes, rng):
+    pdf = canvas.Canvas(path, pagesize=letter)
+    redacted_cords = []
+    for _ in range(pages):
+        pdf.setFont('Helvetica', 10)
+        for line in range(lines):
+            pdf.drawString(72, 740 - line * 14, ' '.join(f'word{rng.randint(0, 999)}' for _ in range(10)))
+        pdf.showPage()
+        page_cords = []
+        for _ in range(boxes):
+            x, y = rng.uniform(1, 7), rng.uniform(1, 10)
+            page_cords.append([(x, y), (x + 0.6, y), (x + 0.6, y + 0.15), (x, y + 0.15)])
+        redacted_cords.append(page_cords)
+    pdf.save()
+    return redacted_cords, [(8.5, 11)] * pages
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks the incremental PDF redaction writer against the per-page reportlab overlay exporter."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', nargs='+', type=int, default=[100, 1_000], help="Numbers of pages.")
+        parser.add_argument('--lines', type=int, default=40, help="Lines of text on each page.")
+        parser.add_argument('--boxes', type=int, default=20, help="Redacted words on each page.")
+        parser.add_argument('--skip-legacy', action='store_true', help="Only time the incremental writer.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        self.stdout.write(f"{'pages':>6} {'writer s':>9} {'writer MB':>10} {'legacy s':>9} {'legacy MB':>10} {'first 2 s':>10} {'speedup':>8}")
+        with TemporaryDirectory() as directory:
+            for pages in options['pages']:
+                pdf_path = os.path.join(directory, f'document_{pages}.pdf')
+                redacted_cords, page_dims = build_pdf(pdf_path, pages, options['lines'], options['boxes'], rng)
+                output_path = os.path.join(directory, 'redacted.pdf')
+
+                elapsed, peak = self.measure(redact_pdf_file, pdf_path, output_path, redacted_cords, page_dims)
+                if options['skip_legacy']:
+                    self.stdout.write(f"{pages:>6} {elapsed:>9.2f} {peak:>10.1f} {'-':>9} {'-':>10} {'-':>10} {'-':>8}")
+                    continue
+
+                legacy_elapsed, legacy_peak = self.measure(legacy_export_redacted_pdf, pdf_path, output_path, redacted_cords, page_dims)
+                first_pages_elapsed, _ = self.measure(legacy_export_redacted_pdf, pdf_path, output_path, redacted_cords, page_dims, False)
+                self.stdout.write(f"{pages:>6} {elapsed:>9.2f} {peak:>10.1f} {legacy_elapsed:>9.2f} {legacy_peak:>10.1f} {first_pages_elapsed:>10.2f} {legacy_elapsed / elapsed:>7.1f}x")
+
+    # Seconds taken, then peak Python memory in MB in a second run
+    def measure(self, function, *args):
+        start_time = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start_time
+        tracemalloc.start()
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak / (1024 * 1024)
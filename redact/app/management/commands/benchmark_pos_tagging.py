@@ -0,0 +1,56 @@
+import time
+from django.core.management.base import BaseCommand
+from app.services import guardrails
+from app.services.document import AnalyzedDocument, SpanTable
+from app.management.samples import build_document
+
+
+# The previous guardrail: one pos_tag call per word, without sentence context
+def legacy_proper_nouns(words):
+    from nltk.tag import pos_tag
+
+    return [i for i, word in enumerate(words) if pos_tag([word])[0][1] == 'NNP']
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks the batched proper nouns guardrail against tagging one word at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--words', type=int, default=100_000, help="Number of words in the document.")
+        parser.add_argument('--legacy-words', type=int, default=None, help="Only time the per-word loop on the first N words, and scale it to the document.")
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        guardrails.get_pos_tagger()
+        self.stdout.write(f"Tagger loaded in {time.perf_counter() - start_time:.2f}s")
+
+        text = build_document(options['words'] * 6)
+        document = AnalyzedDocument(' '.join(text.split()[:options['words']]))
+        words = document.tokens
+
+        guardrails.pos_tag_cache.clear()
+        start_time = time.perf_counter()
+        spans = SpanTable()
+        guardrails.guardrail_proper_nouns(document, spans)
+        cold = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        guardrails.guardrail_proper_nouns(AnalyzedDocument(document.text), SpanTable())
+        warm = time.perf_counter() - start_time
+
+        legacy_words = words[:options['legacy_words']] if options['legacy_words'] else words
+        start_time = time.perf_counter()
+        legacy_indices = legacy_proper_nouns(legacy_words)
+        legacy = (time.perf_counter() - start_time) * len(words) / len(legacy_words)
+
+        token_index = {start: i for i, start in enumerate(document.token_starts)}
+        batched_indices = {token_index[start] for start in spans.starts}
+        legacy_indices = set(legacy_indices)
+        agreed = len({i for i in batched_indices if i < len(legacy_words)} & legacy_indices)
+
+        self.stdout.write(f"{len(words)} words, {len(document.sentences)} sentences")
+        self.stdout.write(f"{'run':>16} {'seconds':>8} {'words/s':>10} {'speedup':>8}")
+        for name, elapsed in (('per-word', legacy), ('batched (cold)', cold), ('batched (cached)', warm)):
+            self.stdout.write(f"{name:>16} {elapsed:>8.2f} {len(words) / elapsed:>10.0f} {legacy / elapsed:>7.1f}x")
+        self.stdout.write(f"Proper nouns: {len(legacy_indices)} per-word, {len(batched_indices)} batched, {agreed} in both")
@@ -0,0 +1,54 @@
+import random
+import re
+import time
+from django.core.management.base import BaseCommand
+from app.services.rewriter import redact_terms
+
+
+# The previous rewriter: one str.replace per redacted word, then a pass to strip the asterisks
+def legacy_redact_terms(text, redacted_list):
+    redacted_text = text
+    for redacted_word in sorted(redacted_list, key=len, reverse=True):
+        if len(redacted_word.strip()) <= 1 and not redacted_word.strip().isnumeric():
+            continue
+        redacted_text = redacted_text.replace(redacted_word.strip(), '*' + '█' * len(redacted_word.strip()) + '*')
+    return re.sub(r'\*(.*?)\*', lambda match: '█' * len(match.group(1)), redacted_text)
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks the single-pass text rewriter against the str.replace loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=10_000_000, help="Text size in characters.")
+        parser.add_argument('--terms', nargs='+', type=int, default=[100, 1_000, 5_000], help="Numbers of redacted terms.")
+        parser.add_argument('--density', type=float, default=0.05, help="Share of the words in the text that are redacted terms.")
+        parser.add_argument('--skip-legacy', action='store_true', help="Only time the single-pass rewriter.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 10))) for _ in range(50_000)]
+        self.stdout.write(f"{'terms':>6} {'chars':>10} {'rewriter s':>11} {'legacy s':>9} {'speedup':>8}")
+
+        for term_count in options['terms']:
+            terms = rng.sample(vocabulary, term_count)
+            words = []
+            length = 0
+            while length < options['size']:
+                word = rng.choice(terms) if rng.random() < options['density'] else rng.choice(vocabulary)
+                words.append(word)
+                length += len(word) + 1
+            text = ' '.join(words)
+
+            start_time = time.perf_counter()
+            redact_terms(text, terms)
+            elapsed = time.perf_counter() - start_time
+
+            if options['skip_legacy']:
+                self.stdout.write(f"{term_count:>6} {len(text):>10} {elapsed:>11.2f} {'-':>9} {'-':>8}")
+                continue
+
+            start_time = time.perf_counter()
+            legacy_redact_terms(text, terms)
+            legacy_elapsed = time.perf_counter() - start_time
+            self.stdout.write(f"{term_count:>6} {len(text):>10} {elapsed:>11.2f} {legacy_elapsed:>9.2f} {legacy_elapsed / elapsed:>7.1f}x")
@@ -0,0 +1,40 @@
+import os
+import random
+import time
+from tempfile import TemporaryDirectory
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from app.management.fake_speech import FakeSpeechServer, build_recording
+from app.services.utils import azure_speech_to_text
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Benchmarks chunked parallel transcription against one request, on a local stand-in for the speech service."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=20, help="Length of the recording.")
+        parser.add_argument('--seconds-per-minute', type=float, default=1.0, help="Time the stand-in service takes per minute of audio.")
+        parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8], help="Chunks sent at a time.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        server = FakeSpeechServer(options['seconds_per_minute'])
+        try:
+            with TemporaryDirectory() as directory:
+                audio_path = os.path.join(directory, 'recording.wav')
+                # Words of 400ms with 200ms gaps, 100 a minute
+                expected = build_recording(audio_path, [rng.randint(1, 20) for _ in range(options['minutes'] * 100)])
+
+                self.stdout.write(f"{'mode':>12} {'requests':>9} {'seconds':>8} {'words ok':>9}")
+                runs = [('one request', {'SPEECH_CHUNKING': False})] + [(f'chunked x{concurrency}', {'SPEECH_MAX_CONCURRENCY': concurrency}) for concurrency in options['concurrency']]
+                for name, overrides in runs:
+                    requests = server.requests
+                    with override_settings(AZURE_SI_ENDPOINT=server.endpoint, CONTENT_CACHE=False, **overrides):
+                        start_time = time.perf_counter()
+                        _, transcription_json = azure_speech_to_text(audio_path)
+                        elapsed = time.perf_counter() - start_time
+                    words = [(word['text'], word['offsetMilliseconds'], word['durationMilliseconds']) for phrase in transcription_json['phrases'] for word in phrase['words']]
+                    self.stdout.write(f"{name:>12} {server.requests - requests:>9} {elapsed:>8.2f} {str(words == expected):>9}")
+        finally:
+            server.close()
@@ -0,0 +1,123 @@
+import io
+import json
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Local stand-in for the Azure fast transcription endpoint, shared by the tests and the benchmark commands
+# Every burst of sound in an uploaded WAV file is heard as one word, named after its loudness: word1 at WORD_AMPLITUDE, word2 at twice that...
+WORD_AMPLITUDE = 1000
+WINDOW_MS = 10
+PHRASE_GAP_MS = 500
+
+
+# Writes a 16-bit mono recording of the words, each a tone as loud as its number, with longer pauses between phrases
+# Returns the words with their offsets and durations in milliseconds, as a transcription would give them
+def build_recording(path, words, frame_rate=16000, word_ms=400, gap_ms=200, phrase_length=8):
+    expected = []
+    position = 0
+    with wave.open(path, 'wb') as recording:
+        recording.setnchannels(1)
+        recording.setsampwidth(2)
+        recording.setframerate(frame_rate)
+        for i, word in enumerate(words):
+            tone = word * WORD_AMPLITUDE * np.sin(2 * np.pi * 440 * np.arange(frame_rate * word_ms // 1000) / frame_rate)
+            pause = gap_ms if (i + 1) % phrase_length else PHRASE_GAP_MS + gap_ms
+            recording.writeframes(tone.astype('<i2').tobytes() + bytes(2 * (frame_rate * pause // 1000)))
+            expected.append((f'word{word}', position, word_ms))
+            position += word_ms + pause
+    return expected
+
+# Transcription json of a WAV file, in the format of fast transcription
+def transcribe_wav(data):
+    with wave.open(io.BytesIO(data), 'rb') as recording:
+        frame_rate = recording.getframerate()
+        samples = np.abs(np.frombuffer(recording.readframes(recording.getnframes()), dtype='<i2').astype(np.int32))
+    window = frame_rate * WINDOW_MS // 1000
+    loudness = samples[:len(samples) // window * window].reshape(-1, window).max(axis=1)
+    active = np.concatenate(([False], loudness > WORD_AMPLITUDE // 2, [False]))
+    edges = np.flatnonzero(active[1:] != active[:-1])
+
+    phrases = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        word = {
+            'text': f'word{int(round(loudness[start:end].max() / WORD_AMPLITUDE))}',
+            'offsetMilliseconds': int(start * WINDOW_MS),
+            'durationMilliseconds': int((end - start) * WINDOW_MS),
+        }
+        if phrases and word['offsetMilliseconds'] - (phrases[-1]['words'][-1]['offsetMilliseconds'] + phrases[-1]['words'][-1]['durationMilliseconds']) < PHRASE_GAP_MS:
+            phrases[-1]['words'].append(word)
+        else:
+            phrases.append({'words': [word]})
+    for phrase in phrases:
+        phrase['text'] = ' '.join(word['text'] for word in phrase['words'])
+        phrase['offsetMilliseconds'] = phrase['words'][0]['offsetMilliseconds']
+        phrase['durationMilliseconds'] = phrase['words'][-1]['offsetMilliseconds'] + phrase['words'][-1]['durationMilliseconds'] - phrase['offsetMilliseconds']
+    return {
+        'durationMilliseconds': len(samples) * 1000 // frame_rate,
+        'combinedPhrases': [{'text': ' '.join(phrase['text'] for phrase in phrases)}],
+        'phrases': phrases,
+    }
+
+
+class FakeSpeechHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        boundary = self.headers['Content-Type'].split('boundary=')[1].encode()
+        audio = body.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n--' + boundary, 1)[0]
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.active += 1
+            self.server.peak_active = max(self.server.peak_active, self.server.active)
+        try:
+            transcription = transcribe_wav(audio)
+            # The service takes longer for longer recordings
+            time.sleep(self.server.seconds_per_minute * transcription['durationMilliseconds'] / 60_000)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+        response = json.dumps(transcription).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSpeechServer(ThreadingHTTPServer):
+    """
+        Fake fast transcription endpoint on a local port, served on a background thread.
+
+        __init__ inputs:
+            seconds_per_minute: Seconds each request takes per minute of audio.
+        __init__ output:
+            A FakeSpeechServer object, with the number of requests and the most it served at once in requests and peak_active.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, seconds_per_minute=0.0):
+        super().__init__(('127.0.0.1', 0), FakeSpeechHandler)
+        self.seconds_per_minute = seconds_per_minute
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
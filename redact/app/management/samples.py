@@ -0,0 +1,38 @@
+import random
+
+# Synthetic documents with PII, shared by the benchmark commands
+SENTENCES = [
+    "My name is {first} {last} and I work as a {job} at {company}.",
+    "You can reach me at {email} or call {phone} after {time}.",
+    "The invoice for account {account} was paid on {date}.",
+    "{first} moved to {number} Main Street, {city}, last year.",
+    "Nothing sensitive is mentioned in this sentence at all.",
+]
+FIRST_NAMES = ["John", "Priya", "Wei", "Fatima", "Carlos", "Anna"]
+LAST_NAMES = ["Smith", "Sharma", "Chen", "Khan", "Garcia", "Novak"]
+CITIES = ["Boston", "Pune", "Shanghai", "Lagos", "Madrid", "Prague"]
+
+
+# Builds a synthetic document of roughly the given number of characters
+def build_document(size, seed=42):
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        sentence = rng.choice(SENTENCES).format(
+            first=first, last=last, job="engineer", company="Contoso Ltd",
+            email=f"{first.lower()}.{last.lower()}@example.com", phone=f"+1 555 {rng.randint(1000, 9999)}",
+            time="5pm", account=rng.randint(10**9, 10**10), date="12/03/2024",
+            number=rng.randint(1, 999), city=rng.choice(CITIES),
+        )
+        # Paragraph breaks every few sentences
+        sentence += "\n\n" if rng.random() < 0.2 else " "
+        parts.append(sentence)
+        length += len(sentence)
+    return "".join(parts)
+
+
+# Splits a synthetic document into its sentences, for per-request benchmarks
+def build_sentences(count, seed=42):
+    return [sentence.strip() for sentence in build_document(count * 80, seed).replace("\n\n", " ").split(". ") if sentence.strip()][:count]
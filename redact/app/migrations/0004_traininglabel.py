@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:02
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+
+# Folds the rows of modelTrainingData into one trainingLabel per (word, label), counting its rows
+def fold_training_data(apps, schema_editor):
+    modelTrainingData = apps.get_model('app', 'modelTrainingData')
+    trainingLabel = apps.get_model('app', 'trainingLabel')
+    pairs = modelTrainingData.objects.values('word', 'label').annotate(count=Count('id'), first_seen=Min('timestamp'), last_seen=Max('timestamp')).order_by()
+    trainingLabel.objects.bulk_create((trainingLabel(**pair) for pair in pairs.iterator()), batch_size=1000)
+
+# Unfolds each trainingLabel into a single row, counts are lost
+def unfold_training_data(apps, schema_editor):
+    modelTrainingData = apps.get_model('app', 'modelTrainingData')
+    trainingLabel = apps.get_model('app', 'trainingLabel')
+    modelTrainingData.objects.bulk_create((modelTrainingData(word=pair.word, label=pair.label) for pair in trainingLabel.objects.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_redactionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='trainingLabel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.CharField(max_length=256)),
+                ('label', models.CharField(max_length=256)),
+                ('count', models.PositiveBigIntegerField(default=1)),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('word', 'label'), name='unique_training_label')],
+            },
+        ),
+        migrations.RunPython(fold_training_data, unfold_training_data),
+        migrations.DeleteModel(
+            name='modelTrainingData',
+        ),
+    ]
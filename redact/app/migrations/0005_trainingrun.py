@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:58
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_traininglabel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='trainingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=16)),
+                ('pid', models.IntegerField(blank=True, null=True)),
+                ('step', models.IntegerField(default=0)),
+                ('max_steps', models.IntegerField(default=0)),
+                ('epoch', models.FloatField(blank=True, null=True)),
+                ('loss', models.FloatField(blank=True, null=True)),
+                ('eta_seconds', models.FloatField(blank=True, null=True)),
+                ('cancel_requested', models.BooleanField(default=False)),
+                ('metrics', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_trainingrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trainingrun',
+            name='high_water_mark',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='trainingrun',
+            name='new_labels',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='trainingrun',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled'), ('skipped', 'Skipped')], default='queued', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='traininglabel',
+            index=models.Index(fields=['last_seen'], name='app_trainin_last_se_92c0c6_idx'),
+        ),
+    ]
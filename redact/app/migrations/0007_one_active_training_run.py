@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+# Runs started twice by different server processes before the constraint, all but the first are failed
+def fail_extra_active_runs(apps, schema_editor):
+    trainingRun = apps.get_model('app', 'trainingRun')
+    active = trainingRun.objects.filter(status__in=['queued', 'running']).order_by('created')
+    first = active.first()
+    if first is not None:
+        active.exclude(pk=first.pk).update(status='failed', error='Another training run was already active.')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_incremental_training'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_extra_active_runs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='trainingrun',
+            constraint=models.UniqueConstraint(models.Value(1), condition=models.Q(('status__in', ['queued', 'running'])), name='one_active_training_run'),
+        ),
+    ]
@@ -1,11 +1,83 @@
+import uuid
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
-class modelTrainingData(models.Model):
-    word = models.CharField(max_length=256,null=False)
-    label = models.CharField(max_length=256,null=False)
-    timestamp = models.DateTimeField(auto_now_add=True)
+# Distinct (word, label) pairs detected by the agents, kept for fine-tuning
+# Each pair is stored once with how often it was seen, so the table grows with the vocabulary and not with traffic
+class trainingLabel(models.Model):
+    word = models.CharField(max_length=256)
+    label = models.CharField(max_length=256)
+    count = models.PositiveBigIntegerField(default=1)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['word', 'label'], name='unique_training_label')]
+        indexes = [models.Index(fields=['last_seen'])] # Training runs select the pairs seen since the last run
+
+    def __str__(self):
+        return f"{self.word} ({self.label}): seen {self.count} times"
+
+
+# Redaction jobs run by the local job workers, polled by the client with their job_id
+class redactionJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    kind = models.CharField(max_length=16)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='queued')
+    params = models.JSONField(default=dict)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=64, blank=True, default='') # host:pid of the process running the job
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'finished'])]
 
     def __str__(self):
-        return f"Time stamp: {self.timestamp}"
+        return f"Job {self.job_id}: {self.kind}, {self.status}"
+
+
+# Fine-tuning runs, trained in a separate process that records its progress here
+class trainingRun(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+        ('skipped', 'Skipped'), # Too few new training labels since the last run
+    ]
 
+    run_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='queued')
+    pid = models.IntegerField(null=True, blank=True) # Process running the training
+    step = models.IntegerField(default=0)
+    max_steps = models.IntegerField(default=0)
+    epoch = models.FloatField(null=True, blank=True)
+    loss = models.FloatField(null=True, blank=True)
+    eta_seconds = models.FloatField(null=True, blank=True)
+    cancel_requested = models.BooleanField(default=False)
+    new_labels = models.IntegerField(default=0) # Training labels seen since the last finished run
+    high_water_mark = models.DateTimeField(null=True, blank=True) # Newest last_seen of the training labels the run trained on
+    metrics = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Only one run can be queued or running at a time, across every server process
+        constraints = [models.UniqueConstraint(models.Value(1), condition=models.Q(status__in=['queued', 'running']), name='one_active_training_run')]
+
+    def __str__(self):
+        return f"Training run {self.run_id}: {self.status}, step {self.step} of {self.max_steps}"
@@ -1,25 +1,8 @@
-import os, shutil, urllib
-from django.conf import settings
-from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
-from ultralytics import YOLO
-from django.conf import settings
-
-# Set up models locally
-if not os.path.exists(settings.MODEL_PATH):
-    os.makedirs('models')
-    tokenizer = AutoTokenizer.from_pretrained("lakshyakh93/deberta_finetuned_pii")
-    tokenizer.save_pretrained(settings.MODEL_PATH)
-    model = AutoModelForTokenClassification.from_pretrained("lakshyakh93/deberta_finetuned_pii")
-    model.save_pretrained(settings.MODEL_PATH)
-
-if not os.path.exists(settings.YOLO_MODEL_PATH):
-    os.makedirs('yolo')
-    download_path = 'https://drive.google.com/file/d/1ZD_CEsbo3p3_dd8eAtRfRxHDV44M0djK/view'
-    urllib.request.urlretrieve(download_path, settings.YOLO_MODEL_PATH)
+from .registry import model_registry
 
 class TextRedactionAgents:
     def __init__(self, degree=0):
-        self.assistant = pipeline("token-classification", tokenizer=settings.MODEL_PATH, model=settings.MODEL_PATH , device=-1)
+        self.assistant = model_registry.get_assistant()
 
         self.degree0_list = [
             "SSN", "PASSWORD", "CREDITCARDNUMBER", "CREDITCARDCVV", "ACCOUNTNUMBER", "IBAN",
@@ -42,8 +25,8 @@ class TextRedactionAgents:
 
 class ImageRedactionAgents:
     def __init__(self, degree=0):
-        self.assistant = pipeline("token-classification", tokenizer=settings.MODEL_PATH, model=settings.MODEL_PATH , device=-1)
-        self.yolo_model = YOLO(settings.YOLO_MODEL_PATH)
+        self.assistant = model_registry.get_assistant()
+        self.yolo_model = model_registry.get_yolo_model()
 
         self.degree0_list = [
             "SSN", "PASSWORD", "CREDITCARDNUMBER", "CREDITCARDCVV", "ACCOUNTNUMBER", "IBAN",
@@ -65,7 +48,7 @@ class ImageRedactionAgents:
 
 class PDFRedactionAgents:
     def __init__(self, degree=0):
-        self.assistant = pipeline("token-classification", tokenizer=settings.MODEL_PATH, model=settings.MODEL_PATH , device=-1)
+        self.assistant = model_registry.get_assistant()
 
         self.degree0_list = [
             "SSN", "PASSWORD", "CREDITCARDNUMBER", "CREDITCARDCVV", "ACCOUNTNUMBER", "IBAN",
@@ -87,7 +70,7 @@ class PDFRedactionAgents:
 
 class AudioRedactionAgents:
     def __init__(self, degree=0):
-        self.assistant = pipeline("token-classification", tokenizer=settings.MODEL_PATH, model=settings.MODEL_PATH , device=-1)
+        self.assistant = model_registry.get_assistant()
 
         self.degree0_list = [
             "SSN", "PASSWORD", "CREDITCARDNUMBER", "CREDITCARDCVV", "ACCOUNTNUMBER", "IBAN",
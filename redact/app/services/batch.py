@@ -0,0 +1,113 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+# Kinds of files redacted in a batch, videos are redacted by Video Indexer one at a time
+BATCH_KINDS = ['text', 'image', 'pdf', 'audio']
+
+batch_pool = None
+batch_pool_lock = threading.Lock()
+
+
+# Sets up Django in a batch worker process, the models are loaded by the first file it redacts
+def init_batch_worker():
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'redact.settings')
+    django.setup()
+
+# Redacts one file of a batch in a worker process
+# Returns the output of the service, the agents speech and the seconds it took
+def redact_batch_file(kind, params):
+    from .jobs import run_service
+
+    start_time = time.perf_counter()
+    output, agents_speech = run_service(kind, params)
+    return output, agents_speech, time.perf_counter() - start_time
+
+# Process pool of the batches, started on first use and kept for the next batches so models are only loaded once per worker
+# Workers are spawned, forking a process that already holds the models and threads is not safe
+def get_batch_pool():
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            workers = settings.BATCH_WORKERS or os.cpu_count()
+            batch_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_batch_worker)
+    return batch_pool
+
+# A worker that died (for example killed for memory) breaks the pool, the next batch starts a new one
+def reset_batch_pool(pool):
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is pool:
+            batch_pool = None
+
+# Name of the output of a file in the archive, with a number added when another file of the batch has the same name
+def archive_name(file_name, kind, output, used_names=()):
+    base_name, extension = os.path.splitext(file_name)
+    base_name += '_redacted'
+    extension = '.txt' if kind == 'text' else os.path.splitext(output)[1] or extension
+    name = base_name + extension
+    number = 2
+    while name in used_names:
+        name = f'{base_name}_{number}{extension}'
+        number += 1
+    return name
+
+# Redacts the files of a batch in parallel, writing each output into one zip as soon as it is done
+# files: (file name, kind, params) of each uploaded file
+# Returns the path of the zip and the manifest, which is also stored in the zip as manifest.json
+def redact_batch(files, archive_path):
+    from .utils import media_file_path
+
+    pool = get_batch_pool()
+    start_time = time.perf_counter()
+    manifest = []
+    futures = {}
+    for file_name, kind, params in files:
+        if kind not in BATCH_KINDS:
+            manifest.append({'file': file_name, 'kind': kind, 'status': 'skipped', 'error': 'This file type is not redacted in batches'})
+            continue
+        futures[pool.submit(redact_batch_file, kind, params)] = (file_name, kind)
+
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    used_names = set()
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for future in as_completed(futures):
+            file_name, kind = futures[future]
+            entry = {'file': file_name, 'kind': kind}
+            try:
+                output, agents_speech, seconds = future.result()
+                entry.update({'seconds': round(seconds, 3), 'agents_speech': agents_speech})
+                if output == 'flag':
+                    manifest.append({**entry, 'status': 'flagged'})
+                    continue
+
+                # Services return the text, or the media URL of the redacted file
+                name = archive_name(file_name, kind, output, used_names)
+                if kind == 'text':
+                    archive.writestr(name, output)
+                else:
+                    archive.write(media_file_path(output), name)
+            except Exception as e:
+                print(f"Batch file {file_name} failed: {e!r}")
+                if isinstance(e, BrokenProcessPool):
+                    reset_batch_pool(pool)
+                manifest.append({**entry, 'status': 'failed', 'error': str(e)})
+                continue
+
+            used_names.add(name)
+            manifest.append({**entry, 'output': name, 'status': 'done'})
+
+        archive.writestr('manifest.json', json.dumps({
+            'files': sorted(manifest, key=lambda entry: entry['file']),
+            'seconds': round(time.perf_counter() - start_time, 3),
+        }, indent=2))
+
+    return archive_path, manifest
@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+CLOSE = object() # Queued by close, stops the worker thread
+
+
+class NERBatcher:
+    """
+        Micro-batching scheduler in front of the token-classification pipeline.
+        Calls from concurrent requests are queued, grouped into padded batches and run in a single forward pass.
+
+        __init__ inputs:
+            assistant: The token-classification pipeline.
+            max_batch_size: Maximum number of texts run in one forward pass.
+            max_wait_ms: Maximum time the first queued text waits for others to join its batch.
+        __init__ output:
+            An NERBatcher object, callable like the pipeline it wraps.
+
+        __call__ inputs:
+            text: A string, or a list of strings.
+            kwargs: Pipeline arguments, such as aggregation_strategy.
+        __call__ outputs:
+            The entity list for the text, or one entity list per text when a list is given.
+
+        close:
+            Stops the worker thread once the queued texts are run, so the pipeline can be freed. Texts submitted afterwards run directly on the pipeline.
+
+    """
+
+    def __init__(self, assistant, max_batch_size=8, max_wait_ms=10):
+        self.assistant = assistant
+        self.tokenizer = assistant.tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.batches_run = 0
+        self.texts_run = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __call__(self, text, **kwargs):
+        if isinstance(text, (list, tuple)):
+            return self.map(text, **kwargs)
+        return self.submit(text, **kwargs).result()
+
+    def map(self, texts, **kwargs):
+        futures = [self.submit(text, **kwargs) for text in texts]
+        return [future.result() for future in futures]
+
+    def submit(self, text, **kwargs):
+        future = Future()
+        # Empty texts have no entities and would only pad the batch
+        if not text or not text.strip():
+            future.set_result([])
+            return future
+
+        with self._lock:
+            if not self._closed:
+                self._ensure_worker()
+                self._queue.put((text, kwargs, future))
+                return future
+        self._run_batch([(text, future)], kwargs)
+        return future
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(CLOSE)
+
+    def stats(self):
+        return {
+            'batches': self.batches_run,
+            'texts': self.texts_run,
+            'average_batch_size': round(self.texts_run / self.batches_run, 2) if self.batches_run else 0,
+            'queued': self._queue.qsize(),
+        }
+
+    # Called with the lock held
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='ner-batcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size and batch[-1] is not CLOSE:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Nothing is queued after CLOSE, the texts before it are still run
+            if batch[-1] is CLOSE:
+                batch.pop()
+                closed = True
+
+            # Texts can only share a forward pass when they use the same pipeline arguments
+            groups = {}
+            for text, kwargs, future in batch:
+                key = tuple(sorted(kwargs.items()))
+                groups.setdefault(key, []).append((text, future))
+
+            for key, items in groups.items():
+                self._run_batch(items, dict(key))
+
+    def _run_batch(self, items, kwargs):
+        items = [(text, future) for text, future in items if future.set_running_or_notify_cancel()]
+        if not items:
+            return
+
+        texts = [text for text, _ in items]
+        try:
+            results = self.assistant(texts, batch_size=len(texts), **kwargs)
+        except Exception as e:
+            if len(items) == 1:
+                items[0][1].set_exception(e)
+                return
+            # One failing text does not fail the others of its batch, they are run one by one
+            for text, future in items:
+                try:
+                    future.set_result(self.assistant(text, **kwargs))
+                except Exception as text_error:
+                    future.set_exception(text_error)
+            return
+
+        self.batches_run += 1
+        self.texts_run += len(texts)
+        for (_, future), entities in zip(items, results):
+            future.set_result(entities)
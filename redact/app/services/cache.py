@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+from collections import Counter, OrderedDict
+from diskcache import Cache
+from django.conf import settings
+
+content_cache = None
+content_cache_lock = threading.Lock()
+known_digests = OrderedDict()
+KNOWN_DIGESTS_SIZE = 1024
+
+
+# SHA-256 of a file, read in blocks
+# Digests of uploads, computed while they were written, are reused while the file is unchanged
+def file_digest(path):
+    stat = os.stat(path)
+    known = known_digests.get(path)
+    if known is not None and known[0] == (stat.st_size, stat.st_mtime_ns):
+        return known[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    remember_digest(path, digest.hexdigest())
+    return digest.hexdigest()
+
+def remember_digest(path, digest):
+    stat = os.stat(path)
+    with content_cache_lock:
+        known_digests[path] = ((stat.st_size, stat.st_mtime_ns), digest)
+        known_digests.move_to_end(path)
+        while len(known_digests) > KNOWN_DIGESTS_SIZE:
+            known_digests.popitem(last=False)
+
+def text_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Version of the agent weights, outputs cached before a fine-tuning are not used after it
+def model_version():
+    if not os.path.isdir(settings.MODEL_PATH):
+        return (settings.NER_BACKEND, 0)
+    return (settings.NER_BACKEND, max((entry.stat().st_mtime_ns for entry in os.scandir(settings.MODEL_PATH) if entry.is_file()), default=0))
+
+
+class ContentCache:
+    """
+        Disk cache of the results of remote services and of final outputs, keyed by the SHA-256 of the input.
+        Shared by every process of the app (diskcache is process-safe), the least recently used entries are evicted past size_limit bytes.
+
+        get_or_compute inputs:
+            kind: What is cached, such as 'ocr' or 'transcription', counted separately.
+            key: Key of the entry within its kind, built from content digests.
+            compute: Function computing the value when it is not cached.
+            dump: Function turning the value into what is stored, such as AnalyzeResult.to_dict.
+            load: Function turning what is stored back into the value.
+            store_if: Function of the value, values it returns false for (like failed requests) are not stored.
+        get_or_compute outputs:
+            The value.
+
+    """
+
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.cache = Cache(directory, size_limit=size_limit, eviction_policy='least-recently-used')
+        self.hits = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, kind, key, compute, dump=None, load=None, store_if=None):
+        stored = self.cache.get((kind, key))
+        if stored is not None:
+            self.count(self.hits, kind)
+            return load(stored) if load else stored
+
+        self.count(self.misses, kind)
+        value = compute()
+        if store_if is None or store_if(value):
+            self.cache.set((kind, key), dump(value) if dump else value)
+        return value
+
+    def count(self, counter, kind):
+        with self.lock:
+            counter[kind] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'size_mb': round(self.cache.volume() / (1024 * 1024), 1),
+            }
+
+    def clear(self):
+        self.cache.clear()
+
+# The content cache of this process, opened on first use
+# Returns None when CONTENT_CACHE is off
+def get_content_cache():
+    global content_cache
+    if not settings.CONTENT_CACHE:
+        return None
+    with content_cache_lock:
+        if content_cache is None or content_cache.directory != settings.CONTENT_CACHE_PATH:
+            content_cache = ContentCache(settings.CONTENT_CACHE_PATH, settings.CONTENT_CACHE_SIZE)
+    return content_cache
+
+# Caches a value with the content cache, or computes it when the cache is off
+def cached(kind, key, compute, dump=None, load=None, store_if=None):
+    cache = get_content_cache()
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(kind, key, compute, dump, load, store_if)
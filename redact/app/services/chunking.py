@@ -0,0 +1,161 @@
+from itertools import islice
+import regex as re
+from django.conf import settings
+
+# Sentence ends followed by whitespace, or blank lines
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+
+class TextChunker:
+    """
+        Splits long documents into overlapping windows that fit the agent's token limit, and merges the entities found in each window back into document offsets.
+
+        __init__ inputs:
+            tokenizer: The (fast) tokenizer of the agent.
+            max_tokens: Token limit of the model, including special tokens.
+            overlap_tokens: Number of tokens shared by consecutive windows.
+            batch_size: Number of windows sent to the agent at once. Bounds memory for very large inputs.
+        __init__ output:
+            A TextChunker object.
+
+        analyze inputs:
+            assistant: The token-classification pipeline or the batching scheduler in front of it.
+            text: The document.
+            kwargs: Pipeline arguments, such as aggregation_strategy.
+        analyze outputs:
+            entities: Entities with start/end offsets in the document.
+
+    """
+
+    def __init__(self, tokenizer, max_tokens=512, overlap_tokens=64, batch_size=16):
+        self.tokenizer = tokenizer
+        self.window_tokens = max(1, max_tokens - tokenizer.num_special_tokens_to_add())
+        self.overlap_tokens = min(max(0, overlap_tokens), self.window_tokens // 2)
+        # Sentences longer than this are cut at whitespace before tokenizing
+        self.max_sentence_chars = 16 * self.window_tokens
+        self.batch_size = max(1, batch_size)
+
+    def analyze(self, assistant, text, **kwargs):
+        entities = []
+        previous = None # (window, own_start, window_entities)
+
+        windows = self.windows(text)
+        while True:
+            batch = list(islice(windows, self.batch_size))
+            if not batch:
+                break
+
+            results = assistant([text[start:end] for start, end in batch], **kwargs)
+            for window, window_entities in zip(batch, results):
+                own_start = window[0]
+                if previous:
+                    # Consecutive windows split the overlap between them at its midpoint
+                    previous_window, previous_own_start, previous_entities = previous
+                    own_start = (min(window[0], previous_window[1]) + previous_window[1]) / 2
+                    entities += self._owned_entities(previous_window[0], previous_entities, previous_own_start, own_start)
+                previous = (window, own_start, window_entities)
+
+        if previous:
+            previous_window, previous_own_start, previous_entities = previous
+            entities += self._owned_entities(previous_window[0], previous_entities, previous_own_start, len(text))
+
+        return entities
+
+    # Yields (start, end) character windows of at most window_tokens tokens
+    def windows(self, text):
+        window = [] # Units as (start, end, token count)
+        window_tokens = 0
+
+        for unit in self._units(text):
+            if window and window_tokens + unit[2] > self.window_tokens:
+                yield (window[0][0], window[-1][1])
+
+                # Carry trailing units into the next window as overlap
+                carried = []
+                carried_tokens = 0
+                for previous_unit in reversed(window):
+                    if carried_tokens + previous_unit[2] > self.overlap_tokens:
+                        break
+                    carried.insert(0, previous_unit)
+                    carried_tokens += previous_unit[2]
+                while carried and carried_tokens + unit[2] > self.window_tokens:
+                    carried_tokens -= carried.pop(0)[2]
+
+                window = carried
+                window_tokens = carried_tokens
+
+            window.append(unit)
+            window_tokens += unit[2]
+
+        if window:
+            yield (window[0][0], window[-1][1])
+
+    # Yields sentences as (start, end, token count), splitting sentences that do not fit a window
+    def _units(self, text):
+        sentences = self._sentences(text)
+        while True:
+            group = list(islice(sentences, 64))
+            if not group:
+                break
+
+            encodings = self.tokenizer([text[start:end] for start, end in group], add_special_tokens=False, return_offsets_mapping=True)
+            for (start, end), offsets in zip(group, encodings['offset_mapping']):
+                if len(offsets) <= self.window_tokens:
+                    yield (start, end, len(offsets))
+                    continue
+
+                # Cut long sentences at token boundaries, in pieces small enough to be carried as overlap
+                piece_tokens = self.overlap_tokens or self.window_tokens
+                for i in range(0, len(offsets), piece_tokens):
+                    piece = offsets[i:i + piece_tokens]
+                    piece_end = offsets[i + piece_tokens][0] if i + piece_tokens < len(offsets) else end - start
+                    yield (start + piece[0][0], start + piece_end, len(piece))
+
+    # Yields sentence spans, without surrounding whitespace
+    def _sentences(self, text):
+        position = 0
+        for boundary in SENTENCE_BOUNDARY.finditer(text):
+            yield from self._bounded_spans(text, position, boundary.start())
+            position = boundary.end()
+        yield from self._bounded_spans(text, position, len(text))
+
+    def _bounded_spans(self, text, start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end - start > self.max_sentence_chars:
+            cut = text.rfind(' ', start, start + self.max_sentence_chars)
+            if cut <= start:
+                cut = start + self.max_sentence_chars
+            yield (start, cut)
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if start < end:
+            yield (start, end)
+
+    # Entities of a window whose centre lies in the part of the document the window owns
+    def _owned_entities(self, offset, window_entities, own_start, own_end):
+        owned = []
+        for entity in window_entities:
+            entity = dict(entity)
+            entity['start'] += offset
+            entity['end'] += offset
+            centre = (entity['start'] + entity['end']) / 2
+            if own_start <= centre < own_end:
+                owned.append(entity)
+        return owned
+
+
+_chunkers = {}
+
+# Returns the chunker configured in settings for a tokenizer
+def get_chunker(tokenizer):
+    chunker = _chunkers.get(id(tokenizer))
+    if chunker is None or chunker.tokenizer is not tokenizer:
+        chunker = TextChunker(tokenizer, settings.NER_CHUNK_MAX_TOKENS, settings.NER_CHUNK_OVERLAP_TOKENS, settings.NER_CHUNK_BATCH_SIZE)
+        _chunkers[id(tokenizer)] = chunker
+    return chunker
+
+# Runs the agent over a document of any length, returning entities with document offsets
+def detect_entities(assistant, text, **kwargs):
+    return get_chunker(assistant.tokenizer).analyze(assistant, text, **kwargs)
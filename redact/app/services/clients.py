@@ -0,0 +1,183 @@
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.identity import DefaultAzureCredential
+from azure.storage.blob import BlobServiceClient
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.contentsafety import ContentSafetyClient
+from django.conf import settings
+
+clients = {}
+clients_lock = threading.RLock() # Clients are created with the shared session, itself a pooled client
+
+
+# Creates a client once per process and returns it on every later call
+# Azure SDK clients are thread-safe, so one client serves all requests
+def pooled_client(name, create):
+    client = clients.get(name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(name)
+            if client is None:
+                client = clients[name] = create()
+    return client
+
+# HTTP session shared by the Azure clients and the REST calls, its connections are kept alive between requests
+def get_http_session():
+    def create():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=settings.AZURE_HTTP_POOL_CONNECTIONS, pool_maxsize=settings.AZURE_HTTP_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    return pooled_client('http_session', create)
+
+# Transport of the Azure SDK clients over the shared session, which the clients must not close
+def shared_transport():
+    return RequestsTransport(session=get_http_session(), session_owner=False)
+
+def get_azure_credential():
+    return pooled_client('azure_credential', DefaultAzureCredential)
+
+def get_document_analysis_client():
+    return pooled_client('document_analysis', lambda: DocumentAnalysisClient(
+        endpoint=settings.AZURE_DI_ENDPOINT, credential=AzureKeyCredential(settings.AZURE_DI_KEY), transport=shared_transport()
+    ))
+
+def get_content_safety_client():
+    return pooled_client('content_safety', lambda: ContentSafetyClient(
+        endpoint=settings.AZURE_CS_ENDPOINT, credential=AzureKeyCredential(settings.AZURE_CS_KEY), transport=shared_transport()
+    ))
+
+def get_blob_service_client():
+    return pooled_client('blob_service', lambda: BlobServiceClient(
+        account_url=settings.AZURE_STORAGE_URL, credential=get_azure_credential(), transport=shared_transport()
+    ))
+
+
+class MultipartFile:
+    """
+        Body of a multipart/form-data request with one file, read from disk in chunks while it is sent instead of loaded into memory.
+        Its length is known up front, so it is sent with a Content-Length like a body built by requests.
+
+        __init__ inputs:
+            field: Name of the form field.
+            path: Path of the file.
+            chunk_size: Bytes read at a time.
+        __init__ output:
+            A MultipartFile object, passed as data with content_type as the Content-Type header.
+
+    """
+
+    def __init__(self, field, path, chunk_size=1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.head = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{os.path.basename(path)}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def __len__(self):
+        return len(self.head) + os.path.getsize(self.path) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b''):
+                yield chunk
+        yield self.tail
+
+
+class TokenCache:
+    """
+        Caches access tokens until shortly before they expire.
+
+        __init__ inputs:
+            refresh_margin: Seconds before the expiry at which a token is fetched again, or None for AZURE_TOKEN_REFRESH_MARGIN, read at each get.
+        __init__ output:
+            A TokenCache object.
+
+        get inputs:
+            key: What the token is for, such as a scope.
+            fetch: Function returning (token, expiry as a unix timestamp), called when there is no valid token.
+        get outputs:
+            The token.
+
+    """
+
+    def __init__(self, refresh_margin=None):
+        self.refresh_margin = refresh_margin
+        self.tokens = {}
+        self.lock = threading.RLock() # Fetching a token can need another token, like the ARM token for a VI token
+        self.fetches = 0
+
+    def get(self, key, fetch):
+        with self.lock:
+            token, expires_on = self.tokens.get(key, (None, 0))
+            refresh_margin = settings.AZURE_TOKEN_REFRESH_MARGIN if self.refresh_margin is None else self.refresh_margin
+            if token is None or time.time() >= expires_on - refresh_margin:
+                token, expires_on = fetch()
+                # Dropping expired tokens, such as those of videos redacted earlier
+                now = time.time()
+                self.tokens = {key: value for key, value in self.tokens.items() if value[1] > now}
+                self.tokens[key] = (token, expires_on)
+                self.fetches += 1
+            return token
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+
+token_cache = TokenCache()
+
+# Expiry of a JWT, read from its payload without verifying it
+def jwt_expiry(token, default_lifetime):
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+    except (IndexError, ValueError, KeyError, TypeError):
+        return time.time() + default_lifetime
+
+# Azure Resource Manager token for Video Indexer
+def get_arm_token():
+    scope = f'{settings.AZURE_VI_RESOURCE_MANAGER}/.default'
+
+    def fetch():
+        access_token = get_azure_credential().get_token(scope)
+        return access_token.token, access_token.expires_on
+    return token_cache.get(('arm', scope), fetch)
+
+# Video Indexer access token, for the account or for one video
+def get_vi_access_token(scope='Account', video_id=None):
+    def fetch():
+        params = {
+            'permissionType': 'Contributor',
+            'scope': scope
+        }
+        if video_id:
+            params['videoId'] = video_id
+        headers = {
+            'Authorization': 'Bearer ' + get_arm_token(),
+            'Content-Type': 'application/json'
+        }
+        vi_access_token_request = get_http_session().post(
+            url=f'{settings.AZURE_VI_RESOURCE_MANAGER}/subscriptions/{settings.AZURE_VI_SUBSCRIPTION}/resourceGroups/{settings.AZURE_VI_RESOURCE_GROUP}/providers/Microsoft.VideoIndexer/accounts/{settings.AZURE_VI_NAME}/generateAccessToken?api-version=2024-01-01',
+            json=params,
+            headers=headers
+        )
+        vi_access_token_request.raise_for_status()
+        vi_access_token = vi_access_token_request.json().get('accessToken')
+        # Video Indexer tokens are valid for an hour
+        return vi_access_token, jwt_expiry(vi_access_token, 3600)
+    return token_cache.get(('vi', scope, video_id), fetch)
@@ -1,14 +1,261 @@
-from ..models import modelTrainingData
+import atexit
+import queue
+import threading
+import time
+from collections import Counter, namedtuple
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Max, Q
+from django.db.models.functions import Mod
+from django.utils import timezone
+from ..models import trainingLabel, trainingRun
 import pandas as pd
 
+# Adds rows into the training labels in one transaction
+# Rows of the same (word, label) are counted together, and pairs already stored get their count and last_seen updated in place
+def writeOutputRows(rows):
+   counts = Counter((data['word'], data['label']) for data in rows)
+   now = connection.ops.adapt_datetimefield_value(timezone.now())
+   table = connection.ops.quote_name(trainingLabel._meta.db_table)
+   word, label, count, first_seen, last_seen = (connection.ops.quote_name(name) for name in ('word', 'label', 'count', 'first_seen', 'last_seen'))
+   upsert = (f"INSERT INTO {table} ({word}, {label}, {count}, {first_seen}, {last_seen}) VALUES (%s, %s, %s, %s, %s) "
+             f"ON CONFLICT ({word}, {label}) DO UPDATE SET {count} = {table}.{count} + excluded.{count}, {last_seen} = excluded.{last_seen}")
+   pairs = list(counts.items())
+   with transaction.atomic(), connection.cursor() as cursor:
+      for start in range(0, len(pairs), settings.FEEDBACK_BATCH_SIZE):
+         cursor.executemany(upsert, [(pair[0], pair[1], pair_count, now, now) for pair, pair_count in pairs[start:start + settings.FEEDBACK_BATCH_SIZE]])
+
+
+class FeedbackWriter:
+   """
+      Write-behind buffer in front of the training labels table.
+      Rows are queued by the request and written by a background thread in batches of up to batch_size, or every flush_seconds when fewer come in.
+
+      __init__ inputs:
+         write: Function writing a list of rows into the database.
+         batch_size: Most rows written in one transaction.
+         flush_seconds: Longest time a row waits for others to join its batch.
+         max_queued: Most rows waiting to be written. When the writer falls behind, a put waits up to put_timeout seconds in all for room, and the rows left are dropped after that.
+      __init__ output:
+         A FeedbackWriter object.
+
+      put inputs:
+         rows: Dictionaries with the word and label of a detection.
+
+      flush inputs:
+         timeout: Seconds to wait, or None to wait until every queued row is written.
+      flush outputs:
+         Whether the queue was emptied in time.
+
+   """
+
+   def __init__(self, write, batch_size=500, flush_seconds=1.0, max_queued=50000, put_timeout=5.0):
+      self.write = write
+      self.batch_size = max(1, batch_size)
+      self.flush_seconds = flush_seconds
+      self.put_timeout = put_timeout
+      self.written = 0
+      self.dropped = 0
+      self.failed = 0
+
+      self._queue = queue.Queue(maxsize=max_queued)
+      self._thread = None
+      self._lock = threading.Lock()
+
+   # The request waits at most put_timeout in all for room in the queue, however many rows it has
+   def put(self, rows):
+      self._ensure_worker()
+      deadline = time.monotonic() + self.put_timeout
+      for i, row in enumerate(rows):
+         try:
+            self._queue.put(row, timeout=max(0, deadline - time.monotonic()))
+         except queue.Full:
+            # The database is too far behind, feedback is dropped rather than holding the request any longer
+            with self._lock:
+               self.dropped += len(rows) - i
+            print(f"Feedback writer is {self._queue.qsize()} rows behind, dropped {len(rows) - i} rows")
+            return
+
+   def flush(self, timeout=None):
+      deadline = None if timeout is None else time.monotonic() + timeout
+      with self._queue.all_tasks_done:
+         while self._queue.unfinished_tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+               return False
+            self._queue.all_tasks_done.wait(remaining)
+      return True
+
+   def stats(self):
+      return {
+         'queued': self._queue.qsize(),
+         'written': self.written,
+         'dropped': self.dropped,
+         'failed': self.failed,
+      }
+
+   def _ensure_worker(self):
+      if self._thread is None or not self._thread.is_alive():
+         with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+               self._thread = threading.Thread(target=self._run, name='feedback-writer', daemon=True)
+               self._thread.start()
+
+   def _run(self):
+      while True:
+         batch = [self._queue.get()]
+         deadline = time.monotonic() + self.flush_seconds
+         while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+               if remaining > 0:
+                  batch.append(self._queue.get(timeout=remaining))
+               else:
+                  batch.append(self._queue.get_nowait())
+            except queue.Empty:
+               break
+         self._write_batch(batch)
+
+   def _write_batch(self, batch):
+      try:
+         close_old_connections()
+         self.write(batch)
+         self.written += len(batch)
+      except Exception as e:
+         self.failed += len(batch)
+         print(f"Feedback writer failed to write {len(batch)} rows: {e!r}")
+      finally:
+         for _ in batch:
+            self._queue.task_done()
+
+
+feedback_writer = None
+feedback_writer_lock = threading.Lock()
+
+def get_feedback_writer():
+   global feedback_writer
+   with feedback_writer_lock:
+      if feedback_writer is None:
+         feedback_writer = FeedbackWriter(writeOutputRows, settings.FEEDBACK_BATCH_SIZE, settings.FEEDBACK_FLUSH_SECONDS, settings.FEEDBACK_MAX_QUEUED, settings.FEEDBACK_PUT_TIMEOUT)
+         # Rows still queued when the server stops are written before it exits
+         atexit.register(feedback_writer.flush, settings.FEEDBACK_SHUTDOWN_TIMEOUT)
+   return feedback_writer
+
 def uploadOutputDB(dict_struct):
-   # To create a new object and push it into the database do the below
-   for data in dict_struct:
-      modelTrainingData.objects.create(**data)
-   # (**) is used to let django know to convert the dictionary key:values to be mapped onto the django model class.
+   # Rows are written by the feedback writer in the background, so the request does not wait on the database
+   if settings.FEEDBACK_WRITE_BEHIND:
+      get_feedback_writer().put(dict_struct)
+   else:
+      writeOutputRows(dict_struct)
 
 def getDBDataframe():
-   response = modelTrainingData.objects.all().values()
+   # Rows still queued are written first, so they are part of the training data
+   if feedback_writer is not None:
+      feedback_writer.flush(settings.FEEDBACK_SHUTDOWN_TIMEOUT)
+   # One row per distinct (word, label), with how often it was seen
+   response = trainingLabel.objects.all().values('word', 'label', 'count', 'first_seen', 'last_seen')
    df = pd.DataFrame(response)
    return df
 
+# Training labels a run trains on: the pairs seen in (after, until], and the older pairs of replay_ids
+# after is None for a first run, which trains on every pair
+TrainingSelection = namedtuple('TrainingSelection', ['after', 'until', 'new_labels', 'replay_ids'])
+
+# Selection of the next training run, from the high-water mark of the last finished run to the newest pair
+# About TRAINING_REPLAY_RATIO older pairs are replayed for every new one, so the agent does not forget them
+# The replayed pairs are one in every few older pairs by id, from an offset set by the seed, read once here through the index on last_seen
+def trainingSelection(seed=0):
+   after = trainingRun.objects.filter(status='done', high_water_mark__isnull=False).order_by('-high_water_mark').values_list('high_water_mark', flat=True).first()
+   until = trainingLabel.objects.aggregate(until=Max('last_seen'))['until']
+   if until is None:
+      return TrainingSelection(after, after, 0, ())
+
+   new_pairs = trainingLabel.objects.filter(last_seen__lte=until)
+   if after is not None:
+      new_pairs = new_pairs.filter(last_seen__gt=after)
+   new_labels = new_pairs.count()
+   # Runs skipped for too few new labels do not need a replay
+   replay_labels = int(new_labels * settings.TRAINING_REPLAY_RATIO) if new_labels >= settings.TRAINING_MIN_NEW_LABELS else 0
+   old_pairs = trainingLabel.objects.filter(last_seen__lte=after) if after is not None and replay_labels else trainingLabel.objects.none()
+   old_labels = old_pairs.count()
+   if not old_labels:
+      return TrainingSelection(after, until, new_labels, ())
+
+   replay_buckets = -(-old_labels // replay_labels)
+   replayed = old_pairs.annotate(replay_bucket=Mod(F('id') + seed % replay_buckets, replay_buckets)).filter(replay_bucket=0)
+   # Not ordered by id in the query, which would scan the primary key rather than the range of the index
+   replay_ids = tuple(sorted(replayed.order_by().values_list('id', flat=True)[:replay_labels]))
+   return TrainingSelection(after, until, new_labels, replay_ids)
+
+# Training labels of a split, one pair in every TRAINING_EVAL_BUCKETS goes to 'eval' by its id and the others to 'train'
+# labels: Labels known to the model, pairs with other labels are left out
+# selection: TrainingSelection of a run, the pairs seen in its range are found through the index on last_seen, or None for every pair
+# The replayed pairs of a selection are not part of it, they are read by id in iterTrainingLabels
+def trainingLabelQuerySet(split, labels=None, selection=None):
+   pairs = trainingLabel.objects.annotate(bucket=Mod('id', settings.TRAINING_EVAL_BUCKETS))
+   pairs = pairs.filter(bucket=0) if split == 'eval' else pairs.exclude(bucket=0)
+   if labels is not None:
+      pairs = pairs.filter(label__in=list(labels))
+   if selection is not None:
+      pairs = pairs.filter(last_seen__lte=selection.until)
+      if selection.after is not None:
+         pairs = pairs.filter(last_seen__gt=selection.after)
+   return pairs
+
+# Number of pairs of a split streamed by iterTrainingLabels
+def countTrainingLabels(split, labels=None, selection=None, chunk_size=1000):
+   count = trainingLabelQuerySet(split, labels, selection).count()
+   if selection is not None:
+      for start in range(0, len(selection.replay_ids), chunk_size):
+         count += trainingLabelQuerySet(split, labels).filter(id__in=selection.replay_ids[start:start + chunk_size]).count()
+   return count
+
+# Streams the (word, label) pairs of a split in lists of up to chunk_size, one query per chunk
+# Chunks are read after the last pair of the previous one, so no cursor stays open between them
+# Without a selection pairs come by id, with one the new pairs come by last_seen, walking its index, and the replayed pairs follow by id
+# rng: Random generator shuffling the order of the chunks, or None to read them in order
+def iterTrainingLabels(split, labels=None, chunk_size=1000, selection=None, rng=None):
+   pairs = trainingLabelQuerySet(split, labels, selection)
+   order = ('id',) if selection is None else ('last_seen', 'id')
+   replay_ids = selection.replay_ids if selection is not None else ()
+   replay_chunks = [replay_ids[start:start + chunk_size] for start in range(0, len(replay_ids), chunk_size)]
+
+   if rng is None:
+      last = None
+      while True:
+         chunk = chunkAfter(pairs, order, last, chunk_size)
+         if not chunk:
+            break
+         last = chunk[-1][:len(order)]
+         yield [(word, label) for *_, word, label in chunk]
+      for ids in replay_chunks:
+         chunk = replayChunk(split, labels, ids)
+         if chunk:
+            yield chunk
+      return
+
+   # The key of the last pair of every chunk is read first, so the chunks can be read in any order
+   starts = [None]
+   for i, key in enumerate(pairs.order_by(*order).values_list(*order).iterator(chunk_size), 1):
+      if i % chunk_size == 0:
+         starts.append(key)
+   chunks = [('after', start) for start in starts] + [('ids', ids) for ids in replay_chunks]
+   rng.shuffle(chunks)
+   for kind, value in chunks:
+      chunk = [(word, label) for *_, word, label in chunkAfter(pairs, order, value, chunk_size)] if kind == 'after' else replayChunk(split, labels, value)
+      if chunk:
+         yield chunk
+
+# Up to chunk_size pairs following the key `last` in the given order, or the first ones when last is None
+def chunkAfter(pairs, order, last, chunk_size):
+   if last is not None:
+      if order == ('id',):
+         pairs = pairs.filter(id__gt=last[0])
+      else:
+         # Pairs written in the same batch share their last_seen, ties are broken by id
+         pairs = pairs.filter(Q(last_seen__gt=last[0]) | Q(id__gt=last[1]), last_seen__gte=last[0])
+   return list(pairs.order_by(*order).values_list(*order, 'word', 'label')[:chunk_size])
+
+# Replayed pairs of a split among the given ids
+def replayChunk(split, labels, ids):
+   return list(trainingLabelQuerySet(split, labels).filter(id__in=ids).order_by('id').values_list('word', 'label'))
@@ -0,0 +1,172 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import regex as re
+from .rewriter import TermMatcher, merge_spans, redaction_terms
+
+TOKEN = re.compile(r'\S+')
+SENTENCE_ENDS = ('.', '!', '?')
+MAX_SENTENCE_TOKENS = 128
+
+Span = namedtuple('Span', ['start', 'length', 'category', 'source', 'confidence'])
+
+
+class AnalyzedDocument:
+    """
+        A text analyzed once per input. Tokens, their character offsets, sentences and the space-joined text are computed on first use and cached.
+
+        __init__ inputs:
+            text: The text of the input (typed text, file contents, OCR content or transcript).
+        __init__ output:
+            An AnalyzedDocument object.
+
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._tokens = None
+        self._token_starts = None
+        self._sentences = None
+        self._joined_text = None
+        self._joined_starts = None
+
+    # Whitespace separated tokens, same as text.split()
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = []
+            self._token_starts = array('q')
+            for match in TOKEN.finditer(self.text):
+                self._tokens.append(match.group())
+                self._token_starts.append(match.start())
+        return self._tokens
+
+    @property
+    def token_starts(self):
+        self.tokens
+        return self._token_starts
+
+    # Sentences as (first token, last token + 1), cut after tokens ending a sentence
+    @property
+    def sentences(self):
+        if self._sentences is None:
+            self._sentences = []
+            first = 0
+            for i, token in enumerate(self.tokens):
+                if token.endswith(SENTENCE_ENDS) or i + 1 - first >= MAX_SENTENCE_TOKENS:
+                    self._sentences.append((first, i + 1))
+                    first = i + 1
+            if first < len(self.tokens):
+                self._sentences.append((first, len(self.tokens)))
+        return self._sentences
+
+    def token_span(self, index):
+        start = self.token_starts[index]
+        return start, start + len(self._tokens[index])
+
+    # The tokens joined by single spaces, the text the guardrails scan
+    @property
+    def joined_text(self):
+        if self._joined_text is None:
+            self._joined_text = ' '.join(self.tokens)
+            self._joined_starts = array('q')
+            position = 0
+            for token in self._tokens:
+                self._joined_starts.append(position)
+                position += len(token) + 1
+        return self._joined_text
+
+    # Maps a span of the joined text back to the original text
+    def joined_to_text(self, start, end):
+        self.joined_text
+        if not self._tokens:
+            return start, end
+        first = max(bisect_right(self._joined_starts, start) - 1, 0)
+        last = max(bisect_right(self._joined_starts, max(end - 1, start)) - 1, 0)
+        text_start = self._token_starts[first] + min(start - self._joined_starts[first], len(self._tokens[first]))
+        text_end = self._token_starts[last] + min(end - self._joined_starts[last], len(self._tokens[last]))
+        return text_start, max(text_end, text_start)
+
+    # Spans of every occurrence of the terms in the text
+    def occurrences(self, terms):
+        return TermMatcher(redaction_terms(terms)).spans(self.text)
+
+
+class SpanTable:
+    """
+        Compact, array-backed table of detections. NER, regex, guardrails and custom words all write into it, and exporters read redacted offsets from it.
+        Categories and sources are stored as small integer ids.
+
+        add inputs:
+            start: Offset of the detection in the document text.
+            length: Length of the detection.
+            category: Entity group, guardrail or other label.
+            source: What produced the detection, such as 'ner', 'regex', 'custom' or a guardrail name.
+            confidence: Score of the detection, 1.0 for exact matches.
+
+    """
+
+    def __init__(self):
+        self.starts = array('q')
+        self.lengths = array('l')
+        self.categories = array('H')
+        self.sources = array('B')
+        self.confidences = array('f')
+
+        self.category_names = []
+        self.source_names = []
+        self._category_ids = {}
+        self._source_ids = {}
+        self._merged = None
+
+    def add(self, start, length, category, source, confidence=1.0):
+        if length <= 0:
+            return
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.categories.append(self._intern(category, self.category_names, self._category_ids))
+        self.sources.append(self._intern(source, self.source_names, self._source_ids))
+        self.confidences.append(confidence)
+        self._merged = None
+
+    def add_spans(self, spans, category, source, confidence=1.0):
+        for start, end in spans:
+            self.add(start, end - start, category, source, confidence)
+
+    # Adds the detections of another table, such as one filled on another thread
+    def extend(self, other):
+        for span in other:
+            self.add(span.start, span.length, span.category, span.source, span.confidence)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield Span(self.starts[i], self.lengths[i], self.category_names[self.categories[i]], self.source_names[self.sources[i]], self.confidences[i])
+
+    # Texts of the detections, optionally only those of some sources
+    def texts(self, text, sources=None):
+        source_ids = None if sources is None else {self._source_ids[source] for source in sources if source in self._source_ids}
+        return [text[self.starts[i]:self.starts[i] + self.lengths[i]] for i in range(len(self.starts)) if source_ids is None or self.sources[i] in source_ids]
+
+    # Sorted, non-overlapping (start, end) spans of all detections
+    def merged(self):
+        if self._merged is None:
+            spans = sorted(zip(self.starts, (start + length for start, length in zip(self.starts, self.lengths))))
+            merged = list(merge_spans(spans))
+            self._merged = (array('q', [start for start, _ in merged]), array('q', [end for _, end in merged]))
+        return list(zip(*self._merged))
+
+    # Whether any detection overlaps [start, end)
+    def covers(self, start, end):
+        self.merged()
+        merged_starts, merged_ends = self._merged
+        i = bisect_left(merged_ends, start + 1)
+        return i < len(merged_starts) and merged_starts[i] < end
+
+    def _intern(self, name, names, ids):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+        return ids[name]
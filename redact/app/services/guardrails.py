@@ -1,23 +1,72 @@
 import os
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.contentsafety import ContentSafetyClient
+import threading
+from collections import OrderedDict
 from azure.ai.contentsafety.models import AnalyzeTextOptions, AnalyzeImageOptions, TextCategory, ImageData, ImageCategory
 from django.conf import settings
-import regex as re
+from .scanner import PatternScanner
+from .clients import get_content_safety_client
+from .cache import cached, file_digest, text_digest
 
 import nltk
-nltk.download('averaged_perceptron_tagger_eng')
 
-# Guardrail for Azure content safety
-def guardrail_azure_cs_text(word_list):
-    flag = 0
-    text = ' '.join(word_list)
-    endpoint = settings.AZURE_CS_ENDPOINT
-    key = settings.AZURE_CS_KEY
+pos_tagger = None
+pos_tagger_lock = threading.Lock()
+pos_tag_cache = OrderedDict()
+pos_tag_cache_lock = threading.Lock()
+POS_TAG_CACHE_SIZE = 50_000
+
+# Loads the POS tagger once per process from NLTK_DATA_PATH
+# The tagger data is only downloaded, into NLTK_DATA_PATH, when it is missing, so later starts work offline
+def get_pos_tagger():
+    global pos_tagger
+    with pos_tagger_lock:
+        if pos_tagger is None:
+            from nltk.tag.perceptron import PerceptronTagger
+
+            if settings.NLTK_DATA_PATH not in nltk.data.path:
+                nltk.data.path.insert(0, settings.NLTK_DATA_PATH)
+            try:
+                nltk.data.find('taggers/averaged_perceptron_tagger_eng/')
+            except LookupError:
+                print(f"POS tagger not found, downloading it to {settings.NLTK_DATA_PATH}")
+                nltk.download('averaged_perceptron_tagger_eng', download_dir=settings.NLTK_DATA_PATH, quiet=True)
+            pos_tagger = PerceptronTagger()
+    return pos_tagger
+
+# Tags sentences in one batch, reusing the tags of sentences seen before
+# Tags depend on the neighbouring words, so whole sentences are memoized rather than single tokens
+# The cache is shared by the guardrail stages, PDF shards and job workers, the tagger runs outside its lock
+def tag_sentences(sentences):
+    known = {}
+    with pos_tag_cache_lock:
+        for sentence in sentences:
+            if sentence in pos_tag_cache:
+                pos_tag_cache.move_to_end(sentence)
+                known[sentence] = pos_tag_cache[sentence]
+
+    missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in known))
+    if missing:
+        for sentence, tagged in zip(missing, get_pos_tagger().tag_sents([list(sentence) for sentence in missing])):
+            known[sentence] = tuple(tag for _, tag in tagged)
+        with pos_tag_cache_lock:
+            for sentence in missing:
+                pos_tag_cache[sentence] = known[sentence]
+            while len(pos_tag_cache) > POS_TAG_CACHE_SIZE:
+                pos_tag_cache.popitem(last=False)
+
+    return [known[sentence] for sentence in sentences]
+
+# Guardrail for Azure content safety, verdicts are cached by the SHA-256 of the text or image
+def guardrail_azure_cs_text(document):
+    text = document.joined_text
+    return cached('safety', ('text', text_digest(text)), lambda: azure_cs_text_flag(text))
+
+def guardrail_azure_cs_image(image):
+    return cached('safety', ('image', file_digest(image)), lambda: azure_cs_image_flag(image))
 
-    content_safety_client = ContentSafetyClient(
-        endpoint=endpoint, credential=AzureKeyCredential(key)
-    )
+def azure_cs_text_flag(text):
+    flag = 0
+    content_safety_client = get_content_safety_client()
 
     request = AnalyzeTextOptions(text=text)
     response = content_safety_client.analyze_text(request)
@@ -38,14 +87,9 @@ def guardrail_azure_cs_text(word_list):
 
     return flag
 
-def guardrail_azure_cs_image(image):
+def azure_cs_image_flag(image):
     flag = 0
-    endpoint = settings.AZURE_CS_ENDPOINT
-    key = settings.AZURE_CS_KEY
-
-    content_safety_client = ContentSafetyClient(
-        endpoint=endpoint, credential=AzureKeyCredential(key)
-    )
+    content_safety_client = get_content_safety_client()
 
     with open(image, 'rb') as file:
         request = AnalyzeImageOptions(image=ImageData(content=file.read()))
@@ -68,64 +112,52 @@ def guardrail_azure_cs_image(image):
     return flag
 
 # Guardrail that redacts proper nouns
-def guardrail_proper_nouns(word_list):
-    from nltk.tag import pos_tag
-    
+def guardrail_proper_nouns(document, spans):
+    tokens = document.tokens
+    sentences = [tuple(tokens[first:last]) for first, last in document.sentences]
+
     redacted_list = []
-    for word in word_list:
-        word = word.strip()
-        if word:
-            tag = pos_tag([word])[0][1]
+    for (first, _), tags in zip(document.sentences, tag_sentences(sentences)):
+        for i, tag in enumerate(tags, first):
             if tag == 'NNP':
-                redacted_list.append(word)
+                redacted_list.append(tokens[i])
+                start, end = document.token_span(i)
+                spans.add(start, end - start, 'proper_nouns', 'guardrail_proper_nouns')
 
     return list(set(redacted_list))
 
-# Guardrail that redacts numbers
-def guardrail_numbers(word_list):
-    patterns = {
-        "numbers": re.compile(r"\b\d+[\d.,-]*\b"),
-    }
-
-    redacted_list = []
-    for pattern in patterns.values():
-        matches = pattern.findall(' '.join(word_list))
-        for match in matches:
-            match_text = ''.join(match).strip()
-            if match_text:
-                redacted_list.append(match_text)
-    
-    return redacted_list
-
-# Guardrail that redacts URLs
-def guardrail_urls(word_list):
-    patterns = {
-        "urls": re.compile(r'(?:https?://)?(?:www\.)?([\w.-]+\.\w+)'),
-    }
-
-    redacted_list = []
-    for pattern in patterns.values():
-        matches = pattern.findall(' '.join(word_list))
-        for match in matches:
-            match_text = ''.join(match).strip()
+# Pattern guardrails: name, label reported to the client, and patterns
+# All patterns are scanned in a single pass over the joined text of the document
+PATTERN_GUARDRAILS = {}
+guardrail_scanner = PatternScanner()
+
+def register_guardrail(name, label, patterns):
+    PATTERN_GUARDRAILS[name] = label
+    for pattern in patterns:
+        guardrail_scanner.register(name, pattern)
+
+register_guardrail('numbers', 'Numbers', [
+    r"\b\d+[\d.,-]*\b",
+])
+register_guardrail('urls', 'URLs', [
+    r'(?:https?://)?(?:www\.)?([\w.-]+\.\w+)',
+])
+register_guardrail('emails', 'Emails', [
+    r"(?<!\*)\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b(?!\*)",
+    # Obfuscated emails
+    r"(?<!\*)[A-Za-z0-9._%+-]+\s?at\s?[A-Za-z0-9.-]+\s?dot\s?[A-Za-z]{2,}(?!\*)",
+])
+
+# Guardrail that redacts the matches of all pattern guardrails, writing them into the span table
+# Returns the redacted words of each guardrail
+def guardrail_patterns(document, spans):
+    redacted_lists = {name: [] for name in PATTERN_GUARDRAILS}
+    for name, matches in guardrail_scanner.scan(document.joined_text):
+        for match_start, match_end, match_text in matches:
+            match_text = match_text.strip()
             if match_text:
-                redacted_list.append(match_text)
-    
-    return redacted_list
-
-# Guardrail that redacts emails
-def guardrail_emails(word_list):
-    patterns = {
-        "email": re.compile(r"(?<!\*)\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b(?!\*)"),
-        "obfuscated_email": re.compile(r"(?<!\*)[A-Za-z0-9._%+-]+\s?at\s?[A-Za-z0-9.-]+\s?dot\s?[A-Za-z]{2,}(?!\*)"),
-    }
+                redacted_lists[name].append(match_text)
+                start, end = document.joined_to_text(match_start, match_end)
+                spans.add(start, end - start, name, 'guardrail_' + name)
 
-    redacted_list = []
-    for pattern in patterns.values():
-        matches = pattern.findall(' '.join(word_list))
-        for match in matches:
-            match_text = ''.join(match).strip()
-            if match_text:
-                redacted_list.append(match_text)
-    
-    return redacted_list
+    return redacted_lists
@@ -0,0 +1,158 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from ..models import redactionJob
+
+# Kinds of jobs that wait on slow media services, they get their own workers
+MEDIA_JOB_KINDS = ['audio', 'video']
+
+
+# Runs the service of a kind of redaction
+# Returns the output of the service (the redacted text, the path of the redacted file, the video URL, or 'flag') and the agents speech
+def run_service(kind, params):
+    from .model_service import TextRedactionService, ImageRedactionService, PDFRedactionService, AudioRedactionService, VideoRedactionService
+
+    degree = params.get('degree', 0)
+    guardrail_toggle = params.get('guardrail_toggle', 1)
+    regexPattern = params.get('regexPattern')
+    wordsToRemove = params.get('wordsToRemove', [])
+
+    if kind == 'text':
+        return TextRedactionService(degree, guardrail_toggle).redact_text(params['text'], regexPattern, wordsToRemove)
+    elif kind == 'image':
+        return ImageRedactionService(degree, guardrail_toggle).redact_image(params['path'], regexPattern, wordsToRemove)
+    elif kind == 'pdf':
+        return PDFRedactionService(degree, guardrail_toggle).redact_pdf(params['path'], regexPattern, wordsToRemove)
+    elif kind == 'audio':
+        return AudioRedactionService(degree, guardrail_toggle).redact_audio(params['path'])
+    elif kind == 'video':
+        output_url, agents_speech = VideoRedactionService(degree, guardrail_toggle).redact_video(params['path'])
+        if output_url == 'error':
+            raise RuntimeError('Could not process the video at this time. Please try again later.')
+        return output_url, agents_speech
+
+    raise ValueError(f"Unknown job kind '{kind}'")
+
+# Runs a redaction job with the service of its kind
+# Returns the result sent to the client, paths of outputs are returned as media URLs
+def run_redaction(kind, params):
+    output, agents_speech = run_service(kind, params)
+    if output == 'flag':
+        return {'flag': 'The data you submitted was flagged for content safety violations.'}
+
+    if kind == 'text':
+        return {'redacted_text': output, 'agents_speech': agents_speech}
+    elif kind == 'image':
+        return {'redacted_image_url': media_url(output), 'agents_speech': agents_speech}
+    elif kind == 'pdf':
+        return {'redacted_file_url': media_url(output), 'agents_speech': agents_speech}
+    elif kind == 'audio':
+        return {'redacted_audio_url': media_url(output), 'agents_speech': agents_speech}
+    return {'redacted_video_url': output, 'agents_speech': agents_speech}
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def media_url(path):
+    return path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL.rstrip('/')).replace(os.sep, '/')
+
+
+class JobRunner:
+    """
+        Runs redaction jobs on local worker threads, recording their status and result in the redactionJob table.
+        Audio and video jobs, which wait on Azure for minutes, run on their own workers so they cannot hold up text, image and PDF jobs.
+
+        submit inputs:
+            kind: 'text', 'image', 'pdf', 'audio' or 'video'.
+            params: Inputs of the service, saved with the job.
+        submit outputs:
+            The queued redactionJob.
+
+    """
+
+    def __init__(self, workers, media_workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='redaction-job')
+        self.media_pool = ThreadPoolExecutor(max_workers=media_workers, thread_name_prefix='redaction-media-job')
+        self.last_purge = 0
+
+    def submit(self, kind, params):
+        job = redactionJob.objects.create(kind=kind, params=params)
+        self.enqueue(job)
+        self.purge_expired()
+        return job
+
+    def enqueue(self, job):
+        pool = self.media_pool if job.kind in MEDIA_JOB_KINDS else self.pool
+        pool.submit(self.run, job.job_id)
+
+    def run(self, job_id):
+        close_old_connections()
+        try:
+            # Only one worker can move a job out of the queue
+            if not redactionJob.objects.filter(job_id=job_id, status='queued').update(status='running', started=timezone.now(), worker=worker_name()):
+                return
+            job = redactionJob.objects.get(job_id=job_id)
+            start_time = time.perf_counter()
+            try:
+                job.result = run_redaction(job.kind, job.params)
+                job.status = 'done'
+            except Exception as e:
+                print(f"Job {job_id} failed: {e!r}")
+                job.status = 'failed'
+                job.error = str(e)
+            job.finished = timezone.now()
+            job.save(update_fields=['status', 'result', 'error', 'finished'])
+            print(f"Job {job_id} ({job.kind}) {job.status} in {time.perf_counter() - start_time:.2f}s")
+        finally:
+            close_old_connections()
+
+    # Queued jobs left by a stopped process are run again, running ones cannot be resumed
+    # Jobs of other live processes on this host are left alone, the queued to running update keeps them from running twice
+    def recover(self):
+        host = socket.gethostname()
+        interrupted = 0
+        for job in redactionJob.objects.filter(status='running', worker__startswith=host + ':'):
+            if not process_alive(int(job.worker.rsplit(':', 1)[1])):
+                interrupted += redactionJob.objects.filter(pk=job.pk, status='running').update(status='failed', error='The server restarted while the job was running.', finished=timezone.now())
+        queued = list(redactionJob.objects.filter(status='queued').order_by('created'))
+        for job in queued:
+            self.enqueue(job)
+        if interrupted or queued:
+            print(f"Recovered jobs: {len(queued)} queued again, {interrupted} interrupted")
+
+    # Deletes finished jobs older than JOB_RETENTION_HOURS, at most once a minute
+    def purge_expired(self):
+        if time.monotonic() - self.last_purge < 60:
+            return
+        self.last_purge = time.monotonic()
+        expiry = timezone.now() - timedelta(hours=settings.JOB_RETENTION_HOURS)
+        deleted, _ = redactionJob.objects.filter(status__in=['done', 'failed'], finished__lt=expiry).delete()
+        if deleted:
+            print(f"Purged {deleted} expired jobs")
+
+job_runner = None
+job_runner_lock = threading.Lock()
+
+# The job runner of this process, started on first use
+def get_job_runner():
+    global job_runner
+    with job_runner_lock:
+        if job_runner is None:
+            job_runner = JobRunner(settings.JOB_WORKERS, settings.JOB_MEDIA_WORKERS)
+            job_runner.recover()
+    return job_runner
@@ -1,13 +1,140 @@
+import functools
 import os
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from .agents import TextRedactionAgents, ImageRedactionAgents, PDFRedactionAgents, AudioRedactionAgents
-from .guardrails import guardrail_azure_cs_text, guardrail_azure_cs_image, guardrail_proper_nouns, guardrail_numbers, guardrail_urls, guardrail_emails
+from .registry import model_registry
+from .chunking import detect_entities
+from .document import AnalyzedDocument, SpanTable
+from .ocr_index import OCRWordIndex
+from .stages import StageGraph
+from .pdf_writer import RedactedPDFWriter
+from .rewriter import redact_spans, redaction_terms
+from .guardrails import guardrail_azure_cs_text, guardrail_azure_cs_image, guardrail_proper_nouns, guardrail_patterns, PATTERN_GUARDRAILS
 from .db_service import uploadOutputDB
-from .utils import azure_image_ocr, azure_pdf_ocr, azure_speech_to_text, azure_upload_video, match_regexPattern, export_redacted_image, export_redacted_pdf, export_redacted_audio
-from azure.identity import DefaultAzureCredential
+from .utils import azure_image_ocr, azure_pdf_ocr, azure_speech_to_text, azure_upload_video, match_regexPattern, export_redacted_image, export_redacted_audio, output_file_path, output_file_url
+from .cache import get_content_cache, cached, file_digest, text_digest, model_version
+from .clients import get_http_session, get_vi_access_token
 from django.conf import settings
 
+# Entity groups redacted at each degree
+def degree_entity_groups(degree, agents):
+    if degree == 0:
+        return set(agents.degree0_list)
+    elif degree == 1:
+        return set(agents.degree0_list + agents.degree1_list)
+    elif degree == 2:
+        return set(agents.degree0_list + agents.degree1_list + agents.degree2_list)
+    return set()
+
+# Writes the entities of the redacted groups into the span table
+# Returns the redacted words, and the rows stored for improving models
+def add_agent_entities(entities, entity_groups, spans, offset=0):
+    redacted_list_from_agent = []
+    output_db_list = []
+    for entity in entities:
+        if entity['entity_group'] in entity_groups:
+            redacted_list_from_agent += entity['word'].strip().split()
+            spans.add(offset + entity['start'], entity['end'] - entity['start'], entity['entity_group'], 'ner', float(entity['score']))
+        # Appending to Output DB List
+        output_db_list.append({
+            'word': entity['word'],
+            'label': 'B-' + entity['entity_group'] # Adding B- prefix to entity_group
+        })
+        output_db_list.append({
+            'word': entity['word'],
+            'label': 'I-' + entity['entity_group'] # Adding I- prefix to entity_group
+        })
+
+    return redacted_list_from_agent, output_db_list
+
+# Writes the custom words and the regex matches given by the user into the span table
+# Returns the redacted words
+def add_user_detections(document, spans, regexPattern, custom_words):
+    spans.add_spans(document.occurrences(custom_words), 'CUSTOM', 'custom')
+    regex_matches = match_regexPattern(document.text, regexPattern)
+    spans.add_spans(regex_matches, 'REGEX', 'regex')
+
+    return custom_words + [document.text[start:end] for start, end in regex_matches]
+
+# Runs the guardrails, which write into the span table, and reports them to the client
+def run_guardrails(document, spans, agents_speech):
+    redacted_list_no_proper_nouns = guardrail_proper_nouns(document, spans)
+    redacted_lists = guardrail_patterns(document, spans)
+
+    agents_speech.append('<h4>' + 'guardrail: redacting proper nouns' + '</h4>')
+    agents_speech.append('<p>Redacting Proper Nouns: ' + str(redacted_list_no_proper_nouns) + '</p>')
+    redacted_list = redacted_list_no_proper_nouns
+    for name, label in PATTERN_GUARDRAILS.items():
+        agents_speech.append('<h4>' + 'guardrail: redacting ' + name + '</h4>')
+        agents_speech.append('<p>Redacting ' + label + ': ' + str(redacted_lists[name]) + '</p>')
+        redacted_list = redacted_list + redacted_lists[name]
+
+    return redacted_list
+
+# Runs the guardrails into their own span table and speech, so they can run next to the agent
+def guardrail_stage(document):
+    spans = SpanTable()
+    agents_speech = []
+    redacted_list = run_guardrails(document, spans, agents_speech)
+    return redacted_list, spans, agents_speech
+
+# Runs OCR on a file and analyzes its content
+def ocr_stage(ocr, file):
+    result = ocr(file)
+    return result, AnalyzedDocument(result.content)
+
+# Page ranges of the shards of a PDF, like "1-20", or [None] to read it whole when it has no more than shard_pages pages
+def pdf_page_shards(page_count, shard_pages):
+    if page_count <= shard_pages:
+        return [None]
+    return [f'{first}-{min(first + shard_pages - 1, page_count)}' for first in range(1, page_count + 1, shard_pages)]
+
+# Adds the output of the guardrail stage to the detections and speech of the service
+def add_guardrail_stage(stage_result, spans, agents_speech):
+    redacted_list, guardrail_spans, guardrail_speech = stage_result
+    spans.extend(guardrail_spans)
+    agents_speech += guardrail_speech
+    return redacted_list
+
+# Words found once are redacted wherever else they appear in the document
+def add_occurrences(document, spans, redacted_list, custom_words=[]):
+    custom_words = set(custom_words)
+    spans.add_spans(document.occurrences([word for word in redacted_list if word not in custom_words]), 'OCCURRENCE', 'occurrence')
+
+# Caches the final output of a redaction method, keyed by its input, its options and the agent weights
+# The input is the text for 'text', otherwise the path of the uploaded file. Redacted files are cached with their bytes, written back to the outputs folder on a hit
+def cached_output(kind):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, source, *args, **kwargs):
+            if get_content_cache() is None:
+                return method(self, source, *args, **kwargs)
+
+            digest = text_digest(source) if kind == 'text' else file_digest(source)
+            key = (digest, self.degree, self.guardrail_toggle, repr(args), repr(sorted(kwargs.items())), model_version())
+            computed = []
+
+            def compute():
+                computed.append(True)
+                output, agents_speech = method(self, source, *args, **kwargs)
+                if kind == 'text' or output == 'flag':
+                    return output, agents_speech, None
+                with open(output_file_path(source), 'rb') as output_file:
+                    return output, agents_speech, output_file.read()
+
+            output, agents_speech, output_bytes = cached(kind + '_output', key, compute)
+            if output_bytes is not None and not computed:
+                # The output of an earlier upload with the same name may have replaced it
+                with open(output_file_path(source), 'wb') as output_file:
+                    output_file.write(output_bytes)
+                output = output_file_url(output_file_path(source))
+            return output, agents_speech
+        return wrapper
+    return decorator
+
 class TextRedactionService:
     """
         The service for redacting text and text files.
@@ -32,48 +159,29 @@ class TextRedactionService:
         self.degree = degree
         self.guardrail_toggle = guardrail_toggle
 
-        self.assistant = TextRedactionAgents(degree).assistant
-        self.degree0_list = TextRedactionAgents(degree).degree0_list
-        self.degree1_list = TextRedactionAgents(degree).degree1_list
-        self.degree2_list = TextRedactionAgents(degree).degree2_list
+        agents = TextRedactionAgents(degree)
+        self.assistant = agents.assistant
+        self.degree0_list = agents.degree0_list
+        self.degree1_list = agents.degree1_list
+        self.degree2_list = agents.degree2_list
+        self.entity_groups = degree_entity_groups(degree, agents)
 
+    @cached_output('text')
     def redact_text(self, text, regexPattern, wordsToRemove=[]):
-        word_list = text.split()
-        redacted_list = []
-        redacted_list_from_agent = [] + [j for i in wordsToRemove for j in i.split()]
-        output_db_list = [] # Storing outputs for improving models
+        document = AnalyzedDocument(text)
+        spans = SpanTable() # Every detection, as offsets in the text
+        custom_words = [j for i in wordsToRemove for j in i.split()]
 
-        content_safety_flag = guardrail_azure_cs_text(word_list)
+        content_safety_flag = guardrail_azure_cs_text(document)
         if content_safety_flag:
             return 'flag', []
 
-        raw_redacted_list_from_agent = self.assistant(text, aggregation_strategy="first")
-        for entity in raw_redacted_list_from_agent:
-            if self.degree == 0:
-                if entity['entity_group'] in self.degree0_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 1:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 2:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list + self.degree2_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            # Appending to Output DB List
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'B-' + entity['entity_group'] # Adding B- prefix to entity_group
-            })
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'I-' + entity['entity_group'] # Adding I- prefix to entity_group
-            })
-
-        redacted_list_from_agent = list(set(redacted_list_from_agent))
+        raw_redacted_list_from_agent = detect_entities(self.assistant, text, aggregation_strategy="first")
+        redacted_list_from_agent, output_db_list = add_agent_entities(raw_redacted_list_from_agent, self.entity_groups, spans)
         uploadOutputDB(output_db_list)
 
-        # Match regex pattern given by user
-        regex_matches = match_regexPattern(text, regexPattern)
-        redacted_list_from_agent = list(set(redacted_list_from_agent + regex_matches))
+        # Custom words and regex pattern given by user
+        redacted_list_from_agent = list(set(redacted_list_from_agent + add_user_detections(document, spans, regexPattern, custom_words)))
                 
         # Return chat history
         agents_speech = []
@@ -82,32 +190,13 @@ class TextRedactionService:
         
         # Guardrails
         if self.guardrail_toggle:        
-            redacted_list_no_proper_nouns = guardrail_proper_nouns(word_list)
-            redacted_list_no_numbers = guardrail_numbers(word_list)
-            redacted_list_no_urls = guardrail_urls(word_list)
-            redacted_list_no_emails = guardrail_emails(word_list)
-            redacted_list = list(set(redacted_list_from_agent + redacted_list_no_proper_nouns + redacted_list_no_numbers + redacted_list_no_urls + redacted_list_no_emails))
-
-            agents_speech.append('<h4>' + 'guardrail: redacting proper nouns' + '</h4>')
-            agents_speech.append('<p>Redacting Proper Nouns: ' + str(redacted_list_no_proper_nouns) + '</p>')
-            agents_speech.append('<h4>' + 'guardrail: redacting numbers' + '</h4>')
-            agents_speech.append('<p>Redacting Numbers: ' + str(redacted_list_no_numbers) + '</p>')
-            agents_speech.append('<h4>' + 'guardrail: redacting urls' + '</h4>')
-            agents_speech.append('<p>Redacting URLs: ' + str(redacted_list_no_urls) + '</p>')
-            agents_speech.append('<h4>' + 'guardrail: redacting emails' + '</h4>')
-            agents_speech.append('<p>Redacting Emails: ' + str(redacted_list_no_emails) + '</p>')
+            redacted_list = redacted_list_from_agent + run_guardrails(document, spans, agents_speech)
         else:
             redacted_list = redacted_list_from_agent  
-        redacted_list = sorted(redacted_list, key=len, reverse=True)
+        add_occurrences(document, spans, redacted_list, custom_words)
 
-        # Redact text
-        redacted_text = text
-        for redacted_word in redacted_list:
-            # Removing single characters from redacted words but not numbers
-            if len(redacted_word.strip()) <= 1 and not redacted_word.strip().isnumeric():
-                continue
-            else:
-                redacted_text = redacted_text.replace(redacted_word.strip(), '*' + '█' * len(redacted_word.strip()) + '*')
+        # Redact text, every redacted span is masked in a single pass
+        redacted_text = redact_spans(text, spans.merged())
 
         return redacted_text, agents_speech
 
@@ -138,50 +227,40 @@ class ImageRedactionService:
         if degree == 2 and guardrail_toggle:
             self.guardrail_toggle = 1
 
-        self.assistant = ImageRedactionAgents(degree).assistant
-        self.yolo_model = ImageRedactionAgents(degree).yolo_model
-        self.degree0_list = ImageRedactionAgents(degree).degree0_list
-        self.degree1_list = ImageRedactionAgents(degree).degree1_list
-        self.degree2_list = ImageRedactionAgents(degree).degree2_list
+        agents = ImageRedactionAgents(degree)
+        self.assistant = agents.assistant
+        self.yolo_model = agents.yolo_model
+        self.degree0_list = agents.degree0_list
+        self.degree1_list = agents.degree1_list
+        self.degree2_list = agents.degree2_list
+        self.entity_groups = degree_entity_groups(degree, agents)
     
+    @cached_output('image')
     def redact_image(self, image, regexPattern, wordsToRemove=[]):
-        result = azure_image_ocr(image)
-        word_list = result.content.split()
-        redacted_list = []
-        output_db_list = [] # Storing outputs for improving models
+        custom_words = [j for i in wordsToRemove for j in i.split()]
+
+        # Content safety, OCR and face detection do not depend on each other, the agent and guardrails wait for OCR
+        # A flagged image stops the run before the agent and guardrails start
+        stages = StageGraph('image redaction')
+        stages.add('content_safety', lambda: guardrail_azure_cs_image(image), stop_if=bool)
+        stages.add('ocr', lambda: ocr_stage(azure_image_ocr, image))
+        stages.add('faces', lambda: self.extract_faces(image))
+        stages.add('agent', lambda ocr: detect_entities(self.assistant, ocr[1].text, aggregation_strategy="first"), after=['ocr'])
+        if self.guardrail_toggle:
+            stages.add('guardrails', lambda ocr: guardrail_stage(ocr[1]), after=['ocr'])
+        results = stages.run()
+        self.stage_latencies = stages.latencies
 
-        content_safety_flag = guardrail_azure_cs_image(image)
-        if content_safety_flag:
+        if stages.stopped:
             return 'flag', []
 
-        raw_redacted_list_from_agent = self.assistant(result.content, aggregation_strategy="first")
-        redacted_list_from_agent = [] + [j for i in wordsToRemove for j in i.split()]
-        for entity in raw_redacted_list_from_agent:
-            if self.degree == 0:
-                if entity['entity_group'] in self.degree0_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 1:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 2:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list + self.degree2_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-            # Appending to Output DB List
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'B-' + entity['entity_group'] # Adding B- prefix to entity_group
-            })
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'I-' + entity['entity_group'] # Adding I- prefix to entity_group
-            })
-
-        redacted_list_from_agent = list(set(redacted_list_from_agent))
+        result, document = results['ocr']
+        spans = SpanTable() # Every detection, as offsets in the OCR content
+        redacted_list_from_agent, output_db_list = add_agent_entities(results['agent'], self.entity_groups, spans)
         uploadOutputDB(output_db_list)
 
-        # Match regex pattern given by user
-        regex_matches = match_regexPattern(result.content, regexPattern)
-        redacted_list_from_agent = list(set(redacted_list_from_agent + regex_matches))
+        # Custom words and regex pattern given by user
+        redacted_list_from_agent = list(set(redacted_list_from_agent + add_user_detections(document, spans, regexPattern, custom_words)))
 
         # Return chat history
         agents_speech = []
@@ -190,16 +269,13 @@ class ImageRedactionService:
         
         # Guardrails are called only for last degree
         if self.guardrail_toggle:
-            redacted_list, agents_speech = self.guardrails(redacted_list_from_agent, word_list, agents_speech)
+            redacted_list = redacted_list_from_agent + add_guardrail_stage(results['guardrails'], spans, agents_speech)
         else:
             redacted_list = redacted_list_from_agent
-        redacted_list = sorted(redacted_list, key=len, reverse=True)
+        add_occurrences(document, spans, redacted_list, custom_words)
 
-        # Extract redacted words and their coordinates
-        redacted_cords = self.extract_redacted_words_coordinates(redacted_list, result)
-
-        # Extract faces
-        redacted_cords = redacted_cords + self.extract_faces(image)
+        # Extract coordinates of the redacted words, and add the faces
+        redacted_cords = self.extract_redacted_words_coordinates(spans, redacted_list, result) + results['faces']
 
         # Export redacted image
         output_path = export_redacted_image(image, redacted_cords)
@@ -209,7 +285,8 @@ class ImageRedactionService:
     # Extract faces
     def extract_faces(self, image):
         redacted_cords = []
-        results = self.yolo_model(image, classes=[0])
+        with model_registry.yolo_lock:
+            results = self.yolo_model(image, classes=[0])
         for result in results:
             if len(result.boxes.xyxy) > 0:
                 for i in range(len(result.boxes.xyxy)):
@@ -217,39 +294,12 @@ class ImageRedactionService:
         
         return redacted_cords
     
-    # Guardrails are called only for last degree
-    def guardrails(self, redacted_list_from_agent, word_list, agents_speech):
-        redacted_list_no_proper_nouns = guardrail_proper_nouns(word_list)
-        redacted_list_no_numbers = guardrail_numbers(word_list)
-        redacted_list_no_urls = guardrail_urls(word_list)
-        redacted_list_no_emails = guardrail_emails(word_list)
-        redacted_list = list(set(redacted_list_from_agent + redacted_list_no_proper_nouns + redacted_list_no_numbers + redacted_list_no_urls + redacted_list_no_emails))
-
-        agents_speech.append('<h4>' + 'guardrail: redacting proper nouns' + '</h4>')
-        agents_speech.append('<p>Redacting Proper Nouns: ' + str(redacted_list_no_proper_nouns) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting numbers' + '</h4>')
-        agents_speech.append('<p>Redacting Numbers: ' + str(redacted_list_no_numbers) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting urls' + '</h4>')
-        agents_speech.append('<p>Redacting URLs: ' + str(redacted_list_no_urls) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting emails' + '</h4>')
-        agents_speech.append('<p>Redacting Emails: ' + str(redacted_list_no_emails) + '</p>')
-
-        return redacted_list, agents_speech
-    
-    # Extract redacted words and their coordinates
-    def extract_redacted_words_coordinates(self, redacted_list, result):
+    # Extract coordinates of the OCR words overlapped by redacted spans or containing redacted words
+    def extract_redacted_words_coordinates(self, spans, redacted_list, result):
+        index = OCRWordIndex(result)
         redacted_cords = []
-        for page in result.pages:
-            for word in page.words:
-                for redacted_word in redacted_list:
-                    # Removing single characters from redacted words but not numbers
-                    if len(redacted_word.strip()) <= 1 and not redacted_word.strip().isnumeric():
-                        continue
-                    elif redacted_word in word.content or redacted_word.strip() in word.content.strip():
-                        cords = []
-                        for polygon in word.polygon:
-                            cords.append((polygon.x, polygon.y))
-                        redacted_cords.append(cords)
+        for redacted_cords_page in index.polygons_by_page(index.redacted(spans, redacted_list)):
+            redacted_cords += redacted_cords_page
         
         return redacted_cords
     
@@ -281,112 +331,141 @@ class PDFRedactionService:
         if degree == 2 and guardrail_toggle:
             self.guardrail_toggle = 1
 
-        self.assistant = PDFRedactionAgents(degree).assistant
-        self.degree0_list = PDFRedactionAgents(degree).degree0_list
-        self.degree1_list = PDFRedactionAgents(degree).degree1_list
-        self.degree2_list = PDFRedactionAgents(degree).degree2_list
+        agents = PDFRedactionAgents(degree)
+        self.assistant = agents.assistant
+        self.degree0_list = agents.degree0_list
+        self.degree1_list = agents.degree1_list
+        self.degree2_list = agents.degree2_list
+        self.entity_groups = degree_entity_groups(degree, agents)
     
+    @cached_output('pdf')
     def redact_pdf(self, pdf, regexPattern, wordsToRemove=[]):
-        result = azure_pdf_ocr(pdf)
-        word_list = result.content.split()
-        redacted_list = []
-        output_db_list = [] # Stores outputs for improving models
-        redacted_list_from_agent = [] + [j for i in wordsToRemove for j in i.split()]
-
-        content_safety_flag = guardrail_azure_cs_text(word_list)
-        if content_safety_flag:
-            return 'flag', []
-
-        for page in result.pages:
-            raw_redacted_list_from_agent_page = self.assistant(" ".join([line.content for line in page.lines]), aggregation_strategy="first")
-            for entity in raw_redacted_list_from_agent_page:
-                if self.degree == 0:
-                    if entity['entity_group'] in self.degree0_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-                elif self.degree == 1:
-                    if entity['entity_group'] in self.degree0_list + self.degree1_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-                elif self.degree == 2:
-                    if entity['entity_group'] in self.degree0_list + self.degree1_list + self.degree2_list:
-                        redacted_list_from_agent += entity['word'].strip().split()
-                # Appending to Output DB List
-                output_db_list.append({
-                'word': entity['word'],
-                'label': 'B-' + entity['entity_group'] # Adding B- prefix to entity_group
-                })
-                output_db_list.append({
-                    'word': entity['word'],
-                    'label': 'I-' + entity['entity_group'] # Adding I- prefix to entity_group
-                })
-
-        redacted_list_from_agent = list(set(redacted_list_from_agent))
-        uploadOutputDB(output_db_list)
-
-        redacted_list_from_agent = list(set(redacted_list_from_agent))
-
-        # Match regex pattern given by user
-        regex_matches = match_regexPattern(result.content, regexPattern)
-        redacted_list_from_agent = list(set(redacted_list_from_agent + regex_matches))
+        custom_words = [j for i in wordsToRemove for j in i.split()]
+        start_time = time.perf_counter()
+
+        # Large PDFs are split in shards of PDF_SHARD_PAGES pages, OCRed and analyzed concurrently
+        # The pages of a shard are redacted into the output as soon as it is done, without waiting for the other shards
+        writer = RedactedPDFWriter(pdf, output_file_path(pdf))
+        shards = pdf_page_shards(len(writer.reader.pages), settings.PDF_SHARD_PAGES)
+        self.stage_latencies = {}
+        self.first_pages_latency = None
+        redacted_shards = []
+        executor = ThreadPoolExecutor(max_workers=settings.PDF_OCR_CONCURRENCY, thread_name_prefix='pdf-shard')
+        try:
+            for future in as_completed([executor.submit(self.analyze_shard, pdf, pages) for pages in shards]):
+                shard = future.result()
+                if shard is None:
+                    # A flagged shard flags the whole PDF
+                    writer.discard()
+                    return 'flag', []
+
+                redacted_shards.append(self.redact_shard(shard, regexPattern, custom_words, writer))
+                if self.first_pages_latency is None:
+                    self.first_pages_latency = time.perf_counter() - start_time
+
+            self.redact_words_of_other_shards(redacted_shards, writer)
+            writer.close()
+        except BaseException:
+            if not writer.output.closed:
+                writer.discard()
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.total_latency = time.perf_counter() - start_time
+        print(f"pdf redaction: {len(writer.reader.pages)} pages in {len(shards)} shards, first pages {self.first_pages_latency:.2f}s, total {self.total_latency:.2f}s")
 
         # Return chat history
+        redacted_shards.sort(key=lambda shard: shard['result'].pages[0].page_number if shard['result'].pages else 0)
         agents_speech = []
         agents_speech.append('<h4>' + 'assistant' + '</h4>')
-        agents_speech.append('<p>Redacting words: ' + str(redacted_list_from_agent) + '</p>')
-        
+        agents_speech.append('<p>Redacting words: ' + str(list(set(word for shard in redacted_shards for word in shard['agent_words']))) + '</p>')
+        for shard in redacted_shards:
+            if len(redacted_shards) > 1 and shard['guardrail_speech']:
+                agents_speech.append('<h4>' + 'pages ' + shard['pages'] + '</h4>')
+            agents_speech += shard['guardrail_speech']
+
+        return output_file_url(writer.output_path), agents_speech
+
+    # OCR of a shard, then content safety, the agent and guardrails side by side
+    # Returns the results of the stages, or None when content safety flags the shard
+    def analyze_shard(self, pdf, pages):
+        stages = StageGraph(f'pdf redaction {pages or "all pages"}')
+        stages.add('ocr', lambda: ocr_stage(lambda file: azure_pdf_ocr(file, pages), pdf))
+        stages.add('content_safety', lambda ocr: guardrail_azure_cs_text(ocr[1]), after=['ocr'], stop_if=bool)
+        stages.add('agent', lambda ocr: self.detect_page_entities(ocr[0]), after=['ocr'])
+        if self.guardrail_toggle:
+            stages.add('guardrails', lambda ocr: guardrail_stage(ocr[1]), after=['ocr'])
+        results = stages.run()
+        self.stage_latencies[pages or 'all'] = stages.latencies
+
+        if stages.stopped:
+            return None
+        return {'pages': pages or 'all', 'results': results}
+
+    # Redacts the pages of a shard into the output
+    # Returns the shard with its OCR index, redacted words and the OCR words already redacted
+    def redact_shard(self, shard, regexPattern, custom_words, writer):
+        results = shard['results']
+        result, document = results['ocr']
+        spans = SpanTable() # Every detection, as offsets in the OCR content of the shard
+        redacted_list_from_agent = []
+        output_db_list = [] # Stores outputs for improving models
+        for (start, _), raw_redacted_list_from_agent_page in results['agent']:
+            redacted_list_from_agent_page, output_db_list_page = add_agent_entities(raw_redacted_list_from_agent_page, self.entity_groups, spans, offset=start)
+            redacted_list_from_agent += redacted_list_from_agent_page
+            output_db_list += output_db_list_page
+        uploadOutputDB(output_db_list)
+
+        # Custom words and regex pattern given by user
+        redacted_list_from_agent = list(set(redacted_list_from_agent + add_user_detections(document, spans, regexPattern, custom_words)))
+
         # Guardrails are called only for last degree
+        guardrail_speech = []
         if self.guardrail_toggle:
-            redacted_list, agents_speech = self.guardrails(redacted_list_from_agent, word_list, agents_speech)
+            redacted_list = redacted_list_from_agent + add_guardrail_stage(results['guardrails'], spans, guardrail_speech)
         else:
             redacted_list = redacted_list_from_agent
-        redacted_list = sorted(redacted_list, key=len, reverse=True)
-
-        # Extract redacted words and their coordinates
-        redacted_cords, page_dims = self.extract_redacted_words_coordinates(redacted_list, result)
-
-        # Export redacted PDF
-        output_path = export_redacted_pdf(pdf, redacted_cords, page_dims)
-
-        return output_path, agents_speech
-    
-    # Guardrails are called only for last degree
-    def guardrails(self, redacted_list_from_agent, word_list, agents_speech):
-        redacted_list_no_proper_nouns = guardrail_proper_nouns(word_list)
-        redacted_list_no_numbers = guardrail_numbers(word_list)
-        redacted_list_no_urls = guardrail_urls(word_list)
-        redacted_list_no_emails = guardrail_emails(word_list)
-        redacted_list = list(set(redacted_list_from_agent + redacted_list_no_proper_nouns + redacted_list_no_numbers + redacted_list_no_urls + redacted_list_no_emails))
-
-        agents_speech.append('<h4>' + 'guardrail: redacting proper nouns' + '</h4>')
-        agents_speech.append('<p>Redacting Proper Nouns: ' + str(redacted_list_no_proper_nouns) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting numbers' + '</h4>')
-        agents_speech.append('<p>Redacting Numbers: ' + str(redacted_list_no_numbers) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting urls' + '</h4>')
-        agents_speech.append('<p>Redacting URLs: ' + str(redacted_list_no_urls) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting emails' + '</h4>')
-        agents_speech.append('<p>Redacting Emails: ' + str(redacted_list_no_emails) + '</p>')
-
-        return redacted_list, agents_speech
-    
-    # Extract redacted words and their coordinates
-    def extract_redacted_words_coordinates(self, redacted_list, result):
-        redacted_cords = []
-        page_dims = []
-        for page in result.pages:
-            page_dims.append((page.width, page.height))
-            redacted_cords_page = []
-            for word in page.words:
-                for redacted_word in redacted_list:
-                    # Removing single characters from redacted words but not numbers
-                    if len(redacted_word.strip()) <= 1 and not redacted_word.strip().isnumeric():
-                        continue
-                    elif redacted_word in word.content or redacted_word.strip() in word.content.strip():
-                        cords = []
-                        for polygon in word.polygon:
-                            cords.append((polygon.x, polygon.y))
-                        redacted_cords_page.append(cords)
-            redacted_cords.append(redacted_cords_page)
-        
-        return redacted_cords, page_dims
+        add_occurrences(document, spans, redacted_list, custom_words)
+
+        # Redact the OCR words overlapped by redacted spans or containing redacted words
+        index = OCRWordIndex(result)
+        redacted = index.redacted(spans, redacted_list)
+        self.redact_pages(result, index, redacted, writer)
+
+        return {'pages': shard['pages'], 'result': result, 'document': document, 'index': index, 'redacted': redacted, 'redacted_list': redacted_list, 'agent_words': redacted_list_from_agent, 'guardrail_speech': guardrail_speech}
+
+    # Words found once are redacted wherever else they appear in the document, including the pages of other shards
+    def redact_words_of_other_shards(self, redacted_shards, writer):
+        if len(redacted_shards) < 2:
+            return
+        all_words = set(word for shard in redacted_shards for word in shard['redacted_list'])
+        for shard in redacted_shards:
+            other_words = list(all_words - set(shard['redacted_list']))
+            if not other_words:
+                continue
+            spans = SpanTable()
+            add_occurrences(shard['document'], spans, other_words)
+            redacted = np.setdiff1d(shard['index'].redacted(spans, other_words), shard['redacted'])
+            self.redact_pages(shard['result'], shard['index'], redacted, writer)
+
+    # Writes the boxes of the redacted OCR words of a shard into its pages
+    def redact_pages(self, result, index, redacted, writer):
+        for page, redacted_cords_page in zip(result.pages, index.polygons_by_page(redacted)):
+            writer.redact_page(page.page_number - 1, redacted_cords_page, (page.width, page.height))
+
+    # Entities of each page, with the offset of the page in the OCR content
+    # Pages are sent together so they share padded batches
+    def detect_page_entities(self, result):
+        page_offsets = [self.page_offsets(page) for page in result.pages]
+        page_texts = [result.content[start:end] for start, end in page_offsets]
+        raw_redacted_list_from_agent_pages = self.assistant(page_texts, aggregation_strategy="first") if page_texts else []
+        return list(zip(page_offsets, raw_redacted_list_from_agent_pages))
+
+    # Offsets of a page in the OCR content
+    def page_offsets(self, page):
+        if not page.spans:
+            return 0, 0
+        return page.spans[0].offset, page.spans[-1].offset + page.spans[-1].length
 
 
 class AudioRedactionService:
@@ -412,43 +491,34 @@ class AudioRedactionService:
         self.degree = degree
         self.guardrail_toggle = guardrail_toggle
 
-        self.assistant = AudioRedactionAgents(degree).assistant
-        self.degree0_list = AudioRedactionAgents(degree).degree0_list
-        self.degree1_list = AudioRedactionAgents(degree).degree1_list
-        self.degree2_list = AudioRedactionAgents(degree).degree2_list
+        agents = AudioRedactionAgents(degree)
+        self.assistant = agents.assistant
+        self.degree0_list = agents.degree0_list
+        self.degree1_list = agents.degree1_list
+        self.degree2_list = agents.degree2_list
+        self.entity_groups = degree_entity_groups(degree, agents)
 
+    @cached_output('audio')
     def redact_audio(self, audio, wordsToRemove=[]):    
-        result, transcription_json = azure_speech_to_text(audio) # Transcription json contains the transcript along with timestamps
-        word_list = result.split()
-        redacted_list = []
-        redacted_list_from_agent = []
-        output_db_list = [] # Stores outputs for improving models
+        # Content safety, the agent and guardrails all wait for the transcript, then run side by side
+        # A flagged transcript stops the run, the results of the agent and guardrails are dropped
+        stages = StageGraph('audio redaction')
+        stages.add('transcription', lambda: azure_speech_to_text(audio)) # Transcription json contains the transcript along with timestamps
+        stages.add('document', lambda transcription: AnalyzedDocument(transcription[0]), after=['transcription'])
+        stages.add('content_safety', guardrail_azure_cs_text, after=['document'], stop_if=bool)
+        stages.add('agent', lambda document: detect_entities(self.assistant, document.text, aggregation_strategy="first"), after=['document'])
+        if self.guardrail_toggle:
+            stages.add('guardrails', guardrail_stage, after=['document'])
+        results = stages.run()
+        self.stage_latencies = stages.latencies
 
-        content_safety_flag = guardrail_azure_cs_text(word_list)
-        if content_safety_flag:
+        if stages.stopped:
             return 'flag', []
-        
-        raw_redacted_list_from_agent = self.assistant(result, aggregation_strategy="first")
-        for entity in raw_redacted_list_from_agent:
-            if self.degree == 0:
-                if entity['entity_group'] in self.degree0_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 1:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            elif self.degree == 2:
-                if entity['entity_group'] in self.degree0_list + self.degree1_list + self.degree2_list:
-                    redacted_list_from_agent += entity['word'].strip().split()
-            # Appending to Output DB List
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'B-' + entity['entity_group'] # Adding B- prefix to entity_group
-            })
-            output_db_list.append({
-                'word': entity['word'],
-                'label': 'I-' + entity['entity_group'] # Adding I- prefix to entity_group
-            })
-        
+
+        _, transcription_json = results['transcription']
+        document = results['document']
+        spans = SpanTable() # Every detection, as offsets in the transcript
+        redacted_list_from_agent, output_db_list = add_agent_entities(results['agent'], self.entity_groups, spans)
         redacted_list_from_agent = list(set(redacted_list_from_agent))
         uploadOutputDB(output_db_list)
 
@@ -459,46 +529,38 @@ class AudioRedactionService:
 
         # Guardrails are called only for last degree
         if self.guardrail_toggle:
-            redacted_list, agents_speech = self.guardrails(redacted_list_from_agent, word_list, agents_speech)
+            redacted_list = redacted_list_from_agent + add_guardrail_stage(results['guardrails'], spans, agents_speech)
         else:
             redacted_list = redacted_list_from_agent
-        redacted_list = sorted(redacted_list, key=len, reverse=True)
+        add_occurrences(document, spans, redacted_list)
 
         # Extract redacted words and their timestamps
-        redacted_timestamps = self.extract_redacted_words_timestamps(redacted_list, transcription_json)
+        redacted_timestamps = self.extract_redacted_words_timestamps(spans, document, transcription_json)
 
         # Export redacted audio
         output_path = export_redacted_audio(audio, redacted_timestamps)
         
         return output_path, agents_speech
     
-    # Guardrails are called only for last degree
-    def guardrails(self, redacted_list_from_agent, word_list, agents_speech):
-        redacted_list_no_proper_nouns = guardrail_proper_nouns(word_list)
-        redacted_list_no_numbers = guardrail_numbers(word_list)
-        redacted_list_no_urls = guardrail_urls(word_list)
-        redacted_list_no_emails = guardrail_emails(word_list)
-        redacted_list = list(set(redacted_list_from_agent + redacted_list_no_proper_nouns + redacted_list_no_numbers + redacted_list_no_urls + redacted_list_no_emails))
-
-        agents_speech.append('<h4>' + 'guardrail: redacting proper nouns' + '</h4>')
-        agents_speech.append('<p>Redacting Proper Nouns: ' + str(redacted_list_no_proper_nouns) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting numbers' + '</h4>')
-        agents_speech.append('<p>Redacting Numbers: ' + str(redacted_list_no_numbers) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting urls' + '</h4>')
-        agents_speech.append('<p>Redacting URLs: ' + str(redacted_list_no_urls) + '</p>')
-        agents_speech.append('<h4>' + 'guardrail: redacting emails' + '</h4>')
-        agents_speech.append('<p>Redacting Emails: ' + str(redacted_list_no_emails) + '</p>')
-
-        return redacted_list, agents_speech
-    
-    # Extract redacted words and their timestamps
-    def extract_redacted_words_timestamps(self, redacted_list, transcription_json):
+    # Extract timestamps of the transcribed words overlapped by redacted spans
+    def extract_redacted_words_timestamps(self, spans, document, transcription_json):
         redacted_timestamps = []
+        redacted_words = None
+        position = 0
         for phrase in transcription_json['phrases']:
             for word in phrase['words']:
-                for redacted_word in redacted_list:
-                    if redacted_word in word['text'] or redacted_word.strip() in word['text'].strip():
-                        redacted_timestamps.append((word['offsetMilliseconds'], word['offsetMilliseconds'] + word['durationMilliseconds']))
+                # Words are aligned with the transcript in order, looking only a little ahead
+                start = document.text.find(word['text'], position, position + len(word['text']) + 32)
+                if start != -1:
+                    position = start + len(word['text'])
+                    redacted = spans.covers(start, position)
+                else:
+                    # Words missing from the transcript are matched against the redacted words instead
+                    if redacted_words is None:
+                        redacted_words = redaction_terms(spans.texts(document.text))
+                    redacted = any(redacted_word in word['text'] for redacted_word in redacted_words)
+                if redacted:
+                    redacted_timestamps.append((word['offsetMilliseconds'], word['offsetMilliseconds'] + word['durationMilliseconds']))
         
         return redacted_timestamps
     
@@ -525,43 +587,29 @@ class VideoRedactionService:
         self.guardrail_toggle = guardrail_toggle
 
     def redact_video(self, video):
-        import requests
+        session = get_http_session()
 
         video_name = os.path.basename(video)
         video_url = azure_upload_video(video)
 
-        # Get VI token
-        vi_default_credential = DefaultAzureCredential()
-        vi_scope = f'{settings.AZURE_VI_RESOURCE_MANAGER}/.default'
-        vi_token = vi_default_credential.get_token(vi_scope).token
-
-        # Get VI access token
-        headers = {
-            'Authorization': 'Bearer ' + vi_token,
-            'Content-Type': 'application/json'
-        }
+        # Get VI access token, cached until it expires
+        vi_access_token = get_vi_access_token()
         params = {
             'permissionType': 'Contributor',
             'scope': 'Account'
         }
-        vi_access_token_request = requests.post(
-            url=f'{settings.AZURE_VI_RESOURCE_MANAGER}/subscriptions/{settings.AZURE_VI_SUBSCRIPTION}/resourceGroups/{settings.AZURE_VI_RESOURCE_GROUP}/providers/Microsoft.VideoIndexer/accounts/{settings.AZURE_VI_NAME}/generateAccessToken?api-version=2024-01-01',
-            json=params,
-            headers=headers
-        )
-        vi_access_token = vi_access_token_request.json().get('accessToken')
 
         # TEMPORARY: Delete all videos in VI
-        vi_get_videos_request = requests.get(
+        vi_get_videos_request = session.get(
             f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos?accessToken={vi_access_token}'
         )
         for video in vi_get_videos_request.json().get('results'):
-            vi_video_delete_request = requests.delete(
+            vi_video_delete_request = session.delete(
                 url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{video.get("id")}?accessToken={vi_access_token}'
             )            
 
         # Upload the video to VI
-        vi_video_upload_request = requests.post(
+        vi_video_upload_request = session.post(
             url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos?name={video_name}&videoUrl={video_url}&privacy=public&accessToken={vi_access_token}',
             json=params
         )
@@ -577,7 +625,7 @@ class VideoRedactionService:
                 return 'error', []
 
         # Poll to check indexing
-        vi_video_poll_request = requests.get(
+        vi_video_poll_request = session.get(
             url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_id}/Index?accessToken={vi_access_token}',
             json=params
         )
@@ -585,7 +633,7 @@ class VideoRedactionService:
         polling_count = 0
         while (vi_video_poll_request.json().get('state') != "Processed" and polling_count < 60):
             time.sleep(10)
-            vi_video_poll_request = requests.get(
+            vi_video_poll_request = session.get(
                 url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_id}/Index?accessToken={vi_access_token}',
                 json=params
             )
@@ -602,13 +650,13 @@ class VideoRedactionService:
                 "blurringKind": "LowBlur"
             }
         }
-        vi_video_redact_request = requests.post(
+        vi_video_redact_request = session.post(
             url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_id}/redact?name={vi_redacted_video}&accessToken={vi_access_token}',
             json=params
         )
         
         # Find the id for the redacted video
-        vi_get_videos_request = requests.get(
+        vi_get_videos_request = session.get(
             f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos?accessToken={vi_access_token}'
         )
         vi_video_redacted_id = None
@@ -618,26 +666,15 @@ class VideoRedactionService:
                 break
 
         # Get an access token for the redacted video
-        headers = {
-            'Authorization': 'Bearer ' + vi_token,
-            'Content-Type': 'application/json'
-        }
-
         params = {
             'permissionType': 'Contributor',
             'scope': 'Video',
             'videoId': vi_video_redacted_id
         }
-
-        vi_video_redacted_access_token_request = requests.post(
-            url=f'{settings.AZURE_VI_RESOURCE_MANAGER}/subscriptions/{settings.AZURE_VI_SUBSCRIPTION}/resourceGroups/{settings.AZURE_VI_RESOURCE_GROUP}/providers/Microsoft.VideoIndexer/accounts/{settings.AZURE_VI_NAME}/generateAccessToken?api-version=2024-01-01',
-            json=params,
-            headers=headers
-        )
-        vi_video_redacted_access_token = vi_video_redacted_access_token_request.json().get('accessToken')
+        vi_video_redacted_access_token = get_vi_access_token('Video', vi_video_redacted_id)
 
         # Poll for redacted video indexing
-        vi_video_redacted_poll_request = requests.get(
+        vi_video_redacted_poll_request = session.get(
             url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_redacted_id}/Index?accessToken={vi_video_redacted_access_token}',
             json=params
         )
@@ -645,7 +682,7 @@ class VideoRedactionService:
         polling_count = 0
         while (vi_video_redacted_poll_request.json().get('state') != "Processed" and polling_count < 60):
             time.sleep(10)
-            vi_video_redacted_poll_request = requests.get(
+            vi_video_redacted_poll_request = session.get(
                 url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_redacted_id}/Index?accessToken={vi_video_redacted_access_token}',
                 json=params
             )
@@ -657,13 +694,13 @@ class VideoRedactionService:
 
         # Get a URL for the redacted video
         from urllib.parse import quote
-        vi_video_redacted_download_request = requests.get(
+        vi_video_redacted_download_request = session.get(
             f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_redacted_id}/SourceFile/DownloadUrl?accessToken={vi_video_redacted_access_token}'
         )        
         vi_video_redacted_url = vi_video_redacted_download_request.json().replace(vi_redacted_video, quote(vi_redacted_video))
 
         # Delete original video from VI when done
-        vi_video_delete_request = requests.delete(
+        vi_video_delete_request = session.delete(
             url=f'https://api.videoindexer.ai/{settings.AZURE_VI_LOCATION}/Accounts/{settings.AZURE_VI_ID}/Videos/{vi_video_id}?accessToken={vi_access_token}'
         )
 
@@ -1,15 +1,16 @@
-import os, shutil, json
+import os, shutil, json, random, time
 import numpy as np
-import pandas as pd
-import torch
-from .db_service import getDBDataframe
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, TrainingArguments, Trainer
-from sklearn.model_selection import train_test_split
+from .db_service import countTrainingLabels, iterTrainingLabels
+from ..models import trainingRun
+from transformers import AutoTokenizer, AutoModelForSequenceClassification, TrainingArguments, Trainer, TrainerCallback, DataCollatorWithPadding
 from sklearn.metrics import accuracy_score
-from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset, get_worker_info
 from django.conf import settings
 
-def train_model():
+# Fine-tunes the agent on the training labels, recording progress and metrics under run_id
+# selection: TrainingSelection of the labels to train on, or None for every label
+# Returns the training metrics, or None when the run was cancelled, in which case the weights are left as they were
+def train_model(run_id=None, selection=None):
     # Parameters
     TRAIN_EPOCHS = 1
     LEARNING_RATE = 2e-5
@@ -20,26 +21,23 @@ def train_model():
     clear_model_checkpoint()
 
     # Load model and tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(settings.MODEL_PATH)
+    tokenizer = AutoTokenizer.from_pretrained(settings.MODEL_PATH, use_fast=True)
     model = AutoModelForSequenceClassification.from_pretrained(settings.MODEL_PATH)
     label2id = model.config.label2id
 
-    # Load data
-    data = getDBDataframe()
+    progress = TrainingProgressCallback(run_id)
 
-    # Split data
-    y = data.pop('label')
-    X = data.pop('word')
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
-
-    # Create dataloaders
-    train_dataset = CustomDataset(X_train, y_train, tokenizer, label2id)
-    test_dataset = CustomDataset(X_test, y_test, tokenizer, label2id)
+    # Create datasets, streamed from the database and padded per batch
+    train_dataset = TrainingLabelDataset('train', tokenizer, label2id, selection)
+    test_dataset = TrainingLabelDataset('eval', tokenizer, label2id, selection)
+    data_collator = DataCollatorWithPadding(tokenizer)
 
     args = TrainingArguments(
         output_dir=settings.MODEL_PATH,
         evaluation_strategy = 'epoch',
-        save_strategy = 'epoch',
+        save_strategy = 'steps',
+        save_steps=settings.TRAINING_CHECKPOINT_STEPS,
+        logging_steps=settings.TRAINING_LOGGING_STEPS,
         learning_rate=LEARNING_RATE,
         per_device_train_batch_size=TRAIN_BATCH_SIZE,
         per_device_eval_batch_size=VALID_BATCH_SIZE,
@@ -66,13 +64,17 @@ def train_model():
         train_dataset=train_dataset,
         eval_dataset=test_dataset,
         tokenizer=tokenizer,
-        compute_metrics=compute_metrics
+        data_collator=data_collator,
+        compute_metrics=compute_metrics,
+        callbacks=[progress]
     )
 
     train_output = trainer.train() # Training
-    append_logs_to_file(settings.MODEL_TRAINING_LOGS, train_output.metrics)
 
     del tokenizer, model, trainer
+    if progress.cancelled:
+        clear_model_checkpoint()
+        return None
     move_checkpoint_to_models()
 
     return train_output.metrics
@@ -86,22 +88,10 @@ def clear_model_checkpoint():
             shutil.rmtree(folder_path)
             print(f"Removed checkpoint folder: {folder_path}")
 
-# Appends logs to a json file
+# Appends a log entry to a JSON lines file, entries already written are never read or rewritten
 def append_logs_to_file(log_file_path, new_logs):
-    if os.path.exists(log_file_path):
-        with open(log_file_path, 'r') as file:
-            try:
-                existing_logs = json.load(file)
-            except json.JSONDecodeError:
-                existing_logs = []
-    else:
-        existing_logs = []
-
-    existing_logs.append(new_logs)
-    with open(log_file_path, 'w') as file:
-        json.dump(existing_logs, file, indent=4)
-
-    print(f"Logs appended to {log_file_path}")
+    with open(log_file_path, 'a') as file:
+        file.write(json.dumps(new_logs) + '\n')
 
 # Move checkpoint folder to models directory
 def move_checkpoint_to_models():
@@ -121,25 +111,87 @@ def move_checkpoint_to_models():
             print(f"All checkpoint model files moved to MODEL_PATH.")
 
 
-# Custom Dataset class for training
-class CustomDataset(Dataset):
-    def __init__(self, X, y, tokenizer, label2id):
-        self.label2id = label2id        
-        self.examples = []
-
-        for input, label in zip(X.values, y.values):
-            input = tokenizer.encode_plus(input, max_length=512, truncation=True, padding='max_length', return_tensors='pt')
-            self.examples.append({'input_ids': input['input_ids'].squeeze(),
-                                  'attention_mask': input['attention_mask'].squeeze(),
-                                  'labels' : torch.tensor(self.get_id(label), dtype=torch.long)})
-    
-    def get_id(self, label):
-        for key, value in self.label2id.items():
-            if label == key:
-                return value
+# Records the progress of a training run: step, loss and ETA every TRAINING_PROGRESS_SECONDS, and each log of the trainer in the metrics log
+# Stops the training at the next progress update once the run is cancelled
+class TrainingProgressCallback(TrainerCallback):
+    def __init__(self, run_id=None):
+        self.run_id = run_id
+        self.cancelled = False
+        self.start_time = time.monotonic()
+        self.last_update = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start_time = time.monotonic()
+        self.update(state, control)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if time.monotonic() - self.last_update >= settings.TRAINING_PROGRESS_SECONDS:
+            self.update(state, control)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        logs = logs or {}
+        append_logs_to_file(settings.MODEL_TRAINING_LOGS, {'run_id': self.run_id, 'time': time.time(), 'step': state.global_step, 'epoch': state.epoch, **logs})
+        if 'loss' in logs and self.run_id is not None:
+            trainingRun.objects.filter(run_id=self.run_id).update(loss=logs['loss'])
+
+    def update(self, state, control):
+        self.last_update = time.monotonic()
+        if self.run_id is None:
+            return
+        eta_seconds = None
+        if state.global_step:
+            eta_seconds = (time.monotonic() - self.start_time) / state.global_step * max(state.max_steps - state.global_step, 0)
+        trainingRun.objects.filter(run_id=self.run_id).update(step=state.global_step, max_steps=state.max_steps, epoch=state.epoch, eta_seconds=eta_seconds)
+        if trainingRun.objects.filter(run_id=self.run_id, cancel_requested=True).exists():
+            self.cancelled = True
+            control.should_training_stop = True
+
+
+# Dataset class for training
+class TrainingLabelDataset(IterableDataset):
+    """
+        Streams the training labels of a split from the database, TRAINING_CHUNK_SIZE pairs at a time.
+        Each chunk is tokenized in one call of the fast tokenizer, without padding, so batches are padded to their longest word by the data collator.
+
+        __init__ inputs:
+            split: 'train' or 'eval'.
+            tokenizer: Fast tokenizer of the model.
+            label2id: Ids of the labels of the model, pairs with other labels are skipped.
+            selection: TrainingSelection of the pairs of a run, or None for every pair.
+            seed: Seed of the shuffling of the training chunks.
+        __init__ output:
+            A TrainingLabelDataset object, yielding input_ids, attention_mask and labels for each pair.
+
+    """
+
+    def __init__(self, split, tokenizer, label2id, selection=None, seed=42):
+        self.split = split
+        self.tokenizer = tokenizer
+        self.label2id = dict(label2id)
+        self.selection = selection
+        self.seed = seed
+        self.epoch = 0
+
+    # Called by the trainer at each epoch, so every epoch shuffles differently
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __len__(self):
-        return len(self.examples)
-
-    def __getitem__(self, i):
-        return self.examples[i]
+        return countTrainingLabels(self.split, self.label2id, self.selection, settings.TRAINING_CHUNK_SIZE)
+
+    def __iter__(self):
+        # Dataloader workers take every num_workers-th chunk
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        # Training chunks are read in a shuffled order, and shuffled inside, differently at each epoch
+        # Every worker draws the same order, so together they still read each chunk once
+        rng = random.Random(self.seed + self.epoch) if self.split == 'train' else None
+
+        for i, chunk in enumerate(iterTrainingLabels(self.split, self.label2id, settings.TRAINING_CHUNK_SIZE, self.selection, rng)):
+            if i % num_workers != worker_id:
+                continue
+            if rng is not None:
+                rng.shuffle(chunk)
+            encodings = self.tokenizer([word for word, _ in chunk], max_length=512, truncation=True)
+            for input_ids, attention_mask, (_, label) in zip(encodings['input_ids'], encodings['attention_mask'], chunk):
+                yield {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': self.label2id[label]}
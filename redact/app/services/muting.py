@@ -0,0 +1,102 @@
+import os
+import wave
+import numpy as np
+from pydub import AudioSegment
+from django.conf import settings
+
+# NumPy types of the PCM samples by sample width in bytes, 24-bit samples have none
+SAMPLE_TYPES = {1: np.uint8, 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+
+# Sorts the redacted intervals and merges the ones that overlap or touch
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+# Redacted intervals in milliseconds as frame ranges, clipped to the length of the audio
+def frame_ranges(redacted_timestamps, frame_rate, frame_count):
+    ranges = []
+    for start_time, end_time in merge_intervals(redacted_timestamps):
+        start = max(0, int(start_time * frame_rate // 1000))
+        end = min(frame_count, int(-(-end_time * frame_rate // 1000)))
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+# Mutes, or bleeps when a frequency is given, the frames of a block that fall in the redacted ranges
+# frames: Writable buffer of the block, first_frame: index of its first frame in the whole audio
+def redact_block(frames, first_frame, ranges, sample_width, channels, frame_rate, bleep_frequency=None):
+    frame_count = len(frames) // (sample_width * channels)
+    if bleep_frequency and sample_width not in SAMPLE_TYPES:
+        bleep_frequency = None # 24-bit audio is only muted
+
+    if bleep_frequency:
+        samples = np.frombuffer(frames, dtype=SAMPLE_TYPES[sample_width]).reshape(frame_count, channels)
+    else:
+        samples = np.frombuffer(frames, dtype=np.uint8).reshape(frame_count, sample_width * channels)
+    silence = 128 if sample_width == 1 else 0 # 8-bit PCM is unsigned
+
+    for start, end in ranges:
+        start = max(start - first_frame, 0)
+        end = min(end - first_frame, frame_count)
+        if start >= end:
+            continue
+        if bleep_frequency:
+            # Phase follows the position in the whole audio, so bleeps continue across blocks
+            seconds = np.arange(first_frame + start, first_frame + end) / frame_rate
+            tone = 0.25 * np.sin(2 * np.pi * bleep_frequency * seconds)
+            if sample_width == 1:
+                tone = 128 + tone * 127
+            else:
+                tone = tone * np.iinfo(SAMPLE_TYPES[sample_width]).max
+            samples[start:end] = tone.astype(samples.dtype)[:, None]
+        else:
+            samples[start:end] = silence
+
+# Redacts a PCM WAV file into output_path block by block, in the same format
+# Only one block of AUDIO_BLOCK_SECONDS is in memory at a time
+def redact_wav(audio_path, output_path, redacted_timestamps, bleep_frequency=None):
+    with wave.open(audio_path, 'rb') as source:
+        params = source.getparams()
+        ranges = frame_ranges(redacted_timestamps, params.framerate, params.nframes)
+        block_frames = max(1, int(settings.AUDIO_BLOCK_SECONDS * params.framerate))
+        with wave.open(output_path, 'wb') as output:
+            output.setparams(params)
+            first_frame = 0
+            while True:
+                frames = bytearray(source.readframes(block_frames))
+                if not frames:
+                    break
+                redact_block(frames, first_frame, ranges, params.sampwidth, params.nchannels, params.framerate, bleep_frequency)
+                output.writeframesraw(frames)
+                first_frame += len(frames) // (params.sampwidth * params.nchannels)
+
+# Redacts audio in other formats, decoded with ffmpeg, then encoded again in the format of the input
+def redact_decoded_audio(audio_path, output_path, redacted_timestamps, bleep_frequency=None):
+    audio = AudioSegment.from_file(audio_path)
+    frames = bytearray(audio.raw_data)
+    ranges = frame_ranges(redacted_timestamps, audio.frame_rate, int(audio.frame_count()))
+    redact_block(frames, 0, ranges, audio.sample_width, audio.channels, audio.frame_rate, bleep_frequency)
+    redacted_audio = AudioSegment(data=bytes(frames), sample_width=audio.sample_width, frame_rate=audio.frame_rate, channels=audio.channels)
+    redacted_audio.export(output_path, format=os.path.splitext(audio_path)[1].lstrip('.').lower() or 'wav')
+
+def is_pcm_wav(audio_path):
+    try:
+        with wave.open(audio_path, 'rb') as source:
+            return source.getcomptype() == 'NONE'
+    except (wave.Error, EOFError):
+        return False
+
+# Redacts the timestamps of an audio file into output_path, keeping its format
+def redact_audio_file(audio_path, output_path, redacted_timestamps, bleep_frequency=None):
+    if is_pcm_wav(audio_path):
+        redact_wav(audio_path, output_path, redacted_timestamps, bleep_frequency)
+    else:
+        redact_decoded_audio(audio_path, output_path, redacted_timestamps, bleep_frequency)
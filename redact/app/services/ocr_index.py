@@ -0,0 +1,120 @@
+import numpy as np
+
+NGRAM_SIZE = 3
+
+
+class OCRWordIndex:
+    """
+        Index over the words of an OCR result, built once per AnalyzeResult.
+        Offsets, pages and polygons of the words are stored in NumPy arrays, and the distinct word texts in a hash index with an n-gram index for substring lookups.
+
+        __init__ inputs:
+            result: AnalyzeResult from Azure Document Intelligence.
+        __init__ output:
+            An OCRWordIndex object.
+
+        covered inputs:
+            spans: SpanTable of the detections, with offsets in result.content.
+        covered outputs:
+            Indices of the words overlapped by a detection.
+
+        containing inputs:
+            terms: Redacted words.
+        containing outputs:
+            Indices of the words that contain one of the terms.
+
+    """
+
+    def __init__(self, result):
+        offsets = []
+        lengths = []
+        pages = []
+        point_counts = []
+        points = []
+        word_ids = []
+        self.vocabulary = []
+        self.vocabulary_ids = {}
+        for page_index, page in enumerate(result.pages):
+            for word in page.words:
+                offsets.append(word.span.offset)
+                lengths.append(word.span.length)
+                pages.append(page_index)
+                point_counts.append(len(word.polygon))
+                points.extend((point.x, point.y) for point in word.polygon)
+
+                content = word.content.strip()
+                if content not in self.vocabulary_ids:
+                    self.vocabulary_ids[content] = len(self.vocabulary)
+                    self.vocabulary.append(content)
+                word_ids.append(self.vocabulary_ids[content])
+
+        self.page_count = len(result.pages)
+        self.starts = np.array(offsets, dtype=np.int64)
+        self.ends = self.starts + np.array(lengths, dtype=np.int64)
+        self.pages = np.array(pages, dtype=np.int32)
+        self.points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        self.point_starts = np.concatenate(([0], np.cumsum(point_counts, dtype=np.int64)))
+        self.word_ids = np.array(word_ids, dtype=np.int32)
+
+        # Words sharing a text, and the distinct texts holding each n-gram
+        order = np.argsort(self.word_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(self.word_ids[order])) + 1
+        self.words_of_text = np.split(order, boundaries) if len(order) else []
+        self.ngrams = {}
+        for text_id, text in enumerate(self.vocabulary):
+            for size in range(1, NGRAM_SIZE + 1):
+                for i in range(len(text) - size + 1):
+                    self.ngrams.setdefault(text[i:i + size], set()).add(text_id)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Words overlapped by a detection, found with a binary search of each word in the merged spans
+    def covered(self, spans):
+        merged = spans.merged()
+        if not merged or not len(self):
+            return np.array([], dtype=np.int64)
+        merged_starts = np.fromiter((start for start, _ in merged), dtype=np.int64, count=len(merged))
+        merged_ends = np.fromiter((end for _, end in merged), dtype=np.int64, count=len(merged))
+
+        # First span ending after the start of each word, which overlaps it if it starts before the word ends
+        i = np.searchsorted(merged_ends, self.starts, side='right')
+        found = i < len(merged_starts)
+        found[found] = merged_starts[i[found]] < self.ends[found]
+        return np.flatnonzero(found & (self.ends > self.starts))
+
+    # Distinct word texts containing the term, narrowed down with the rarest of its n-grams
+    def texts_containing(self, term):
+        size = min(len(term), NGRAM_SIZE)
+        candidates = None
+        for i in range(len(term) - size + 1):
+            text_ids = self.ngrams.get(term[i:i + size])
+            if not text_ids:
+                return []
+            if candidates is None or len(text_ids) < len(candidates):
+                candidates = text_ids
+        return [text_id for text_id in candidates if term in self.vocabulary[text_id]]
+
+    # Words containing one of the terms, same as testing each term against each word
+    def containing(self, terms):
+        text_ids = set()
+        for term in terms:
+            # Removing single characters from redacted words but not numbers
+            term = term.strip()
+            if len(term) <= 1 and not term.isnumeric():
+                continue
+            text_ids.update(self.texts_containing(term))
+        if not text_ids:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.words_of_text[text_id] for text_id in text_ids])
+
+    # Words that are redacted: overlapped by a detection, or containing a redacted word
+    def redacted(self, spans, terms=[]):
+        return np.union1d(self.covered(spans), self.containing(terms))
+
+    # Polygons of the words as lists of (x, y), grouped by page
+    def polygons_by_page(self, indices):
+        polygons = [[] for _ in range(self.page_count)]
+        for i in np.sort(indices):
+            polygons[self.pages[i]].append([tuple(point) for point in self.points[self.point_starts[i]:self.point_starts[i + 1]].tolist()])
+        return polygons
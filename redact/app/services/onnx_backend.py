@@ -0,0 +1,62 @@
+import os
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+ONNX_BACKENDS = {
+    # Backend: (export folder, ONNX file name)
+    'onnx': ('fp32', 'model.onnx'),
+    'onnx-int8': ('int8', 'model_quantized.onnx'),
+}
+
+def import_optimum():
+    try:
+        import optimum.onnxruntime as ort
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError as e:
+        raise ImproperlyConfigured("The ONNX backends need optimum with onnxruntime: pip install optimum[onnxruntime]") from e
+    return ort, AutoQuantizationConfig
+
+# Exports the model in MODEL_PATH to ONNX, and quantizes it to int8 for the onnx-int8 backend
+# Exports are redone when the weights in MODEL_PATH are newer, for example after fine-tuning
+def export_onnx_model(backend='onnx'):
+    from transformers import AutoTokenizer
+
+    ort, AutoQuantizationConfig = import_optimum()
+    folder, file_name = ONNX_BACKENDS[backend]
+    weights_mtime = max(os.path.getmtime(os.path.join(settings.MODEL_PATH, item)) for item in os.listdir(settings.MODEL_PATH) if item.endswith(('.safetensors', '.bin')))
+
+    fp32_path = os.path.join(settings.ONNX_MODEL_PATH, 'fp32')
+    fp32_file = os.path.join(fp32_path, 'model.onnx')
+    if not os.path.exists(fp32_file) or os.path.getmtime(fp32_file) < weights_mtime:
+        start_time = time.perf_counter()
+        model = ort.ORTModelForTokenClassification.from_pretrained(settings.MODEL_PATH, export=True)
+        model.save_pretrained(fp32_path)
+        AutoTokenizer.from_pretrained(settings.MODEL_PATH).save_pretrained(fp32_path)
+        print(f"Exported ONNX model to {fp32_path} in {time.perf_counter() - start_time:.2f}s")
+
+    model_path = os.path.join(settings.ONNX_MODEL_PATH, folder)
+    model_file = os.path.join(model_path, file_name)
+    if backend == 'onnx-int8' and (not os.path.exists(model_file) or os.path.getmtime(model_file) < os.path.getmtime(fp32_file)):
+        # Dynamic quantization: int8 weights, activations quantized at runtime
+        start_time = time.perf_counter()
+        quantizer = ort.ORTQuantizer.from_pretrained(fp32_path)
+        quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=model_path, quantization_config=quantization_config)
+        AutoTokenizer.from_pretrained(fp32_path).save_pretrained(model_path)
+        print(f"Quantized ONNX model to {model_path} in {time.perf_counter() - start_time:.2f}s")
+
+    return model_path, file_name
+
+# Token-classification pipeline served by ONNX Runtime, with the same output as the PyTorch pipeline
+def load_onnx_pipeline(backend='onnx'):
+    from transformers import AutoTokenizer, pipeline
+
+    if backend not in ONNX_BACKENDS:
+        raise ImproperlyConfigured(f"Unknown ONNX backend '{backend}', expected one of {list(ONNX_BACKENDS)}")
+
+    ort, _ = import_optimum()
+    model_path, file_name = export_onnx_model(backend)
+    model = ort.ORTModelForTokenClassification.from_pretrained(model_path, file_name=file_name, provider='CPUExecutionProvider')
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    return pipeline("token-classification", model=model, tokenizer=tokenizer)
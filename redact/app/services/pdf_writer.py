@@ -0,0 +1,192 @@
+import io
+import os
+import shutil
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+
+TAIL_SIZE = 2048 # Bytes read from the end of a PDF to find its last cross-reference section
+
+
+# PDF operators filling the redacted boxes of a page with black
+# Boxes are in the units of the OCR page (page_dim), and are scaled to the media box of the PDF page
+# The first overlay of a page closes the q written before the page content, later ones save and restore the state themselves
+def overlay_operators(page, coord_sets, page_dim, first=True):
+    mediabox = page.mediabox
+    left, bottom = float(mediabox.left), float(mediabox.bottom)
+    page_width, page_height = float(mediabox.width), float(mediabox.height)
+    operators = ([b'Q'] if first else []) + [b'q', b'0 0 0 rg']
+    for coord_set in coord_sets:
+        x_coords = [point[0] for point in coord_set]
+        y_coords = [point[1] for point in coord_set]
+        x_min, x_max = min(x_coords) / page_dim[0] * page_width, max(x_coords) / page_dim[0] * page_width
+        y_min, y_max = page_height - (max(y_coords) / page_dim[1] * page_height), page_height - (min(y_coords) / page_dim[1] * page_height)
+        operators.append(f'{left + x_min:.2f} {bottom + y_min:.2f} {x_max - x_min:.2f} {y_max - y_min:.2f} re'.encode())
+    operators += [b'f', b'Q']
+    return b'\n'.join(operators) + b'\n'
+
+# Offset of the last cross-reference section of a PDF, and whether it is a cross-reference stream
+def last_xref(file):
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(max(0, size - TAIL_SIZE))
+    tail = file.read()
+    position = tail.rfind(b'startxref')
+    if position == -1:
+        raise ValueError("The PDF has no cross-reference section.")
+    offset = int(tail[position + len(b'startxref'):].split()[0])
+    file.seek(offset)
+    return offset, not file.read(4).startswith(b'xref')
+
+# Number of object numbers used by a PDF, PyPDF2 does not keep /Size for cross-reference streams
+def object_count(reader):
+    numbers = [number for objects in reader.xref.values() for number in objects] + list(reader.xref_objStm)
+    return max([int(reader.trailer.get('/Size', 0))] + [number + 1 for number in numbers])
+
+def write_object(output, number, generation, body):
+    output.write(f'{number} {generation} obj\n'.encode())
+    output.write(body)
+    output.write(b'\nendobj\n')
+
+def write_stream(output, number, data, entries=b''):
+    output.write(f'{number} 0 obj\n<< /Length {len(data)} {entries.decode()} >>\nstream\n'.encode())
+    output.write(data)
+    output.write(b'\nendstream\nendobj\n')
+
+def serialize(pdf_object):
+    buffer = io.BytesIO()
+    pdf_object.write_to_stream(buffer, None)
+    return buffer.getvalue()
+
+# Existing content streams of a page, as references
+def content_references(page):
+    contents = page.raw_get('/Contents') if '/Contents' in page else None
+    if contents is None:
+        return []
+    if isinstance(contents, IndirectObject) and isinstance(contents.get_object(), ArrayObject):
+        contents = contents.get_object()
+    if isinstance(contents, ArrayObject):
+        return list(contents)
+    return [contents]
+
+class RedactedPDFWriter:
+    """
+        Writes a redacted copy of a PDF, appending the black boxes of its pages as an incremental update.
+        The original file is copied as it is, then each redacted page gets a content stream with its boxes and a new page dictionary pointing at it.
+        Pages can be redacted in any order and more than once, as their boxes become known. The reader is given an open file rather than a path, which PyPDF2 would read whole into memory, and only the page dictionaries are loaded from it, never the page contents. The file stays open until close or discard.
+
+        __init__ inputs:
+            pdf_path: Path of the PDF.
+            output_path: Path of the redacted PDF.
+        __init__ output:
+            A RedactedPDFWriter object, with the original file copied.
+
+        redact_page inputs:
+            page_num: Index of the page.
+            coord_sets: Boxes of the redacted words, as lists of (x, y) in the units of the OCR page.
+            page_dim: Width and height of the OCR page.
+
+        close output:
+            Writes the cross-reference section, after which the redacted PDF is complete.
+
+    """
+
+    def __init__(self, pdf_path, output_path):
+        self.source = open(pdf_path, 'rb')
+        try:
+            self.reader = PdfReader(self.source)
+            if self.reader.is_encrypted:
+                raise ValueError("Encrypted PDFs cannot be redacted.")
+        except BaseException:
+            self.source.close()
+            raise
+
+        self.output_path = output_path
+        self.output = open(output_path, 'wb')
+        with open(pdf_path, 'rb') as source:
+            self.previous_xref, self.xref_stream = last_xref(source)
+            source.seek(0)
+            shutil.copyfileobj(source, self.output, 1024 * 1024)
+        self.output.write(b'\n')
+
+        self.next_number = object_count(self.reader)
+        self.entries = {} # Offset and generation of each object written, by object number
+        self.overlays = {} # Overlay streams of each redacted page
+
+        # Content streams are wrapped in q ... Q so the boxes are drawn in the coordinates of the page, whatever the page content changes
+        self.save_state = self.write_stream(b'q\n')
+
+    def write_stream(self, data):
+        number = self.next_number
+        self.next_number += 1
+        self.entries[number] = (0, self.output.tell())
+        write_stream(self.output, number, data)
+        return IndirectObject(number, 0, self.reader)
+
+    def redact_page(self, page_num, coord_sets, page_dim):
+        page = self.reader.pages[page_num]
+        if not coord_sets or page.indirect_ref is None:
+            return
+
+        overlays = self.overlays.setdefault(page_num, [])
+        overlays.append(self.write_stream(overlay_operators(page, coord_sets, page_dim, first=not overlays)))
+        redacted_page = DictionaryObject(page)
+        redacted_page[NameObject('/Contents')] = ArrayObject([self.save_state] + content_references(page) + self.overlays[page_num])
+        # A page redacted again is written again, the cross-reference section points at its last version
+        self.entries[page.indirect_ref.idnum] = (page.indirect_ref.generation, self.output.tell())
+        write_object(self.output, page.indirect_ref.idnum, page.indirect_ref.generation, serialize(redacted_page))
+
+    def close(self):
+        entries = [(number, generation, offset) for number, (generation, offset) in self.entries.items()]
+        trailer = {key: self.reader.trailer.raw_get(key) for key in ('/Root', '/Info', '/ID') if key in self.reader.trailer}
+        if self.xref_stream:
+            write_xref_stream(self.output, entries, self.next_number, self.previous_xref, trailer)
+        else:
+            write_xref_table(self.output, entries, self.next_number, self.previous_xref, trailer)
+        self.output.close()
+        self.source.close()
+
+    # Stops writing and removes the partial output
+    def discard(self):
+        self.output.close()
+        self.source.close()
+        os.remove(self.output_path)
+
+# Writes a redacted copy of a PDF with the boxes of every page
+def redact_pdf_file(pdf_path, output_path, redacted_cords, page_dims):
+    writer = RedactedPDFWriter(pdf_path, output_path)
+    for page_num, coord_sets in enumerate(redacted_cords[:len(writer.reader.pages)]):
+        writer.redact_page(page_num, coord_sets, page_dims[page_num])
+    writer.close()
+
+def trailer_entries(trailer):
+    return b' '.join(serialize(NameObject(key)) + b' ' + serialize(value) for key, value in trailer.items())
+
+# Consecutive object numbers grouped into the subsections of a cross-reference section
+def xref_subsections(entries):
+    subsections = []
+    for entry in sorted(entries):
+        if subsections and entry[0] == subsections[-1][-1][0] + 1:
+            subsections[-1].append(entry)
+        else:
+            subsections.append([entry])
+    return subsections
+
+def write_xref_table(output, entries, size, previous_xref, trailer):
+    xref_offset = output.tell()
+    output.write(b'xref\n')
+    for subsection in xref_subsections(entries):
+        output.write(f'{subsection[0][0]} {len(subsection)}\n'.encode())
+        for _, generation, offset in subsection:
+            output.write(f'{offset:010d} {generation:05d} n\r\n'.encode())
+    output.write(f'trailer\n<< /Size {size} /Prev {previous_xref} '.encode() + trailer_entries(trailer) + b' >>\n')
+    output.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+
+# PDFs whose cross-references are streams are updated with a cross-reference stream
+def write_xref_stream(output, entries, size, previous_xref, trailer):
+    xref_offset = output.tell()
+    entries = entries + [(size, 0, xref_offset)]
+    subsections = xref_subsections(entries)
+    data = b''.join(bytes([1]) + offset.to_bytes(8, 'big') + generation.to_bytes(2, 'big') for subsection in subsections for _, generation, offset in subsection)
+    index = ' '.join(f'{subsection[0][0]} {len(subsection)}' for subsection in subsections)
+    write_stream(output, size, data, f'/Type /XRef /Size {size + 1} /W [1 8 2] /Index [{index}] /Prev {previous_xref} '.encode() + trailer_entries(trailer))
+    output.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+import urllib.request
+import psutil
+from django.conf import settings
+from .batching import NERBatcher
+
+# Set up models locally
+def download_models():
+    if not os.path.exists(settings.MODEL_PATH):
+        from transformers import AutoTokenizer, AutoModelForTokenClassification
+
+        os.makedirs(settings.MODEL_PATH)
+        tokenizer = AutoTokenizer.from_pretrained("lakshyakh93/deberta_finetuned_pii")
+        tokenizer.save_pretrained(settings.MODEL_PATH)
+        model = AutoModelForTokenClassification.from_pretrained("lakshyakh93/deberta_finetuned_pii")
+        model.save_pretrained(settings.MODEL_PATH)
+
+    if not os.path.exists(settings.YOLO_MODEL_PATH):
+        os.makedirs(settings.YOLO_MODEL_ROOT, exist_ok=True)
+        download_path = 'https://drive.google.com/file/d/1ZD_CEsbo3p3_dd8eAtRfRxHDV44M0djK/view'
+        urllib.request.urlretrieve(download_path, settings.YOLO_MODEL_PATH)
+
+
+# Token-classification pipeline for a backend: 'pytorch', 'onnx' or 'onnx-int8'
+def load_pipeline(backend='pytorch'):
+    download_models()
+    if backend == 'pytorch':
+        from transformers import pipeline
+        return pipeline("token-classification", tokenizer=settings.MODEL_PATH, model=settings.MODEL_PATH, device=-1)
+
+    from .onnx_backend import load_onnx_pipeline
+    return load_onnx_pipeline(backend)
+
+
+class ModelRegistry:
+    """
+        Process-wide registry for the models used by the agents, so the weights are loaded once per process instead of once per request.
+
+        get_pipeline output:
+            The token-classification pipeline (DeBERTa), loaded on first use.
+        get_assistant output:
+            The pipeline behind the micro-batching scheduler when NER_BATCHING is on, otherwise the pipeline itself.
+        get_yolo_model output:
+            The YOLO model used for face detection, loaded on first use.
+        reload_assistant output:
+            The token-classification pipeline, reloaded from MODEL_PATH.
+        warm output:
+            Loads all models. Called once at startup from AppConfig.ready.
+        status output:
+            Readiness, load time of each model and the memory used by the process.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pipeline = None
+        self._assistant = None
+        self._yolo_model = None
+        self.load_times = {}
+        # YOLO predictors keep per-call state, so calls on the shared model are serialized
+        self.yolo_lock = threading.Lock()
+
+    def get_pipeline(self):
+        if self._pipeline is None:
+            with self._lock:
+                if self._pipeline is None:
+                    start_time = time.perf_counter()
+                    self._pipeline = load_pipeline(settings.NER_BACKEND)
+                    self.load_times['assistant'] = time.perf_counter() - start_time
+        return self._pipeline
+
+    def get_assistant(self):
+        if self._assistant is None:
+            with self._lock:
+                if self._assistant is None:
+                    if settings.NER_BATCHING:
+                        self._assistant = NERBatcher(self.get_pipeline(), settings.NER_BATCH_MAX_SIZE, settings.NER_BATCH_MAX_WAIT_MS)
+                    else:
+                        self._assistant = self.get_pipeline()
+        return self._assistant
+
+    def get_yolo_model(self):
+        if self._yolo_model is None:
+            with self._lock:
+                if self._yolo_model is None:
+                    from ultralytics import YOLO
+
+                    download_models()
+                    start_time = time.perf_counter()
+                    self._yolo_model = YOLO(settings.YOLO_MODEL_PATH)
+                    self.load_times['yolo_model'] = time.perf_counter() - start_time
+        return self._yolo_model
+
+    # Reloads the pipeline, used once fine-tuned weights replace the ones in MODEL_PATH
+    def reload_assistant(self):
+        with self._lock:
+            # The worker thread of the old batcher holds the old pipeline until it is closed
+            if isinstance(self._assistant, NERBatcher):
+                self._assistant.close()
+            self._pipeline = None
+            self._assistant = None
+            return self.get_assistant()
+
+    def warm(self):
+        start_time = time.perf_counter()
+        self.get_assistant()
+        self.get_yolo_model()
+        print(f"Models loaded in {time.perf_counter() - start_time:.2f}s")
+
+    def is_ready(self):
+        return self._assistant is not None and self._yolo_model is not None
+
+    def status(self):
+        memory = psutil.Process(os.getpid()).memory_info()
+        return {
+            'ready': self.is_ready(),
+            'backend': settings.NER_BACKEND,
+            'models': {
+                'assistant': self._assistant is not None,
+                'yolo_model': self._yolo_model is not None,
+            },
+            'load_times': {name: round(seconds, 3) for name, seconds in self.load_times.items()},
+            'memory': {
+                'rss_mb': round(memory.rss / (1024 * 1024), 1),
+                'vms_mb': round(memory.vms / (1024 * 1024), 1),
+            },
+            'batching': self._assistant.stats() if isinstance(self._assistant, NERBatcher) else None,
+            'pid': os.getpid(),
+        }
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,98 @@
+import re
+
+REDACTION_MASK = '█'
+
+
+class TermMatcher:
+    """
+        Finds every occurrence of many terms in a single pass over the text.
+        The terms are stored in a trie, which is compiled into one pattern, so each position of the text is only visited once regardless of the number of terms.
+
+        __init__ inputs:
+            terms: Words or phrases to find.
+        __init__ output:
+            A TermMatcher object.
+
+        spans inputs:
+            text: The text to search.
+        spans outputs:
+            (start, end) of the longest term starting at each matching position, in text order.
+
+    """
+
+    def __init__(self, terms):
+        trie = {}
+        for term in terms:
+            if not term:
+                continue
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[''] = True
+
+        # The lookahead matches at every start position, so terms overlapping each other are all found
+        self.pattern = re.compile('(?=(' + self._trie_pattern(trie) + '))') if trie else None
+
+    def spans(self, text):
+        if self.pattern is None:
+            return
+        for match in self.pattern.finditer(text):
+            yield match.start(), match.end(1)
+
+    # Compiles a trie node into a pattern, preferring the longest term
+    def _trie_pattern(self, node):
+        is_end = '' in node
+        branches = []
+        for char, child in sorted((char, child) for char, child in node.items() if char):
+            # Collapse chains of single children into a literal
+            literal = char
+            while len(child) == 1 and '' not in child:
+                (next_char, child), = child.items()
+                literal += next_char
+            branches.append(re.escape(literal) + self._trie_pattern(child))
+
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if is_end:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+
+# Merges sorted (start, end) spans into non-overlapping spans
+def merge_spans(spans):
+    current_start = current_end = None
+    for start, end in spans:
+        if current_end is not None and start <= current_end:
+            current_end = max(current_end, end)
+            continue
+        if current_end is not None:
+            yield current_start, current_end
+        current_start, current_end = start, end
+    if current_end is not None:
+        yield current_start, current_end
+
+# Masks sorted spans of the text, keeping its length
+def redact_spans(text, spans, mask=REDACTION_MASK):
+    parts = []
+    position = 0
+    for start, end in merge_spans(spans):
+        parts.append(text[position:start])
+        parts.append(mask * (end - start))
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+# Removing single characters from redacted words but not numbers
+def redaction_terms(redacted_list):
+    terms = set()
+    for redacted_word in redacted_list:
+        redacted_word = redacted_word.strip()
+        if len(redacted_word) > 1 or redacted_word.isnumeric():
+            terms.add(redacted_word)
+    return terms
+
+# Masks every occurrence of the redacted words in a single pass over the text
+def redact_terms(text, redacted_list, mask=REDACTION_MASK):
+    matcher = TermMatcher(redaction_terms(redacted_list))
+    return redact_spans(text, matcher.spans(text), mask)
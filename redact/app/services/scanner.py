@@ -0,0 +1,74 @@
+import threading
+import re
+
+
+class PatternScanner:
+    """
+        Runs many regex patterns over a text in a single pass.
+        The registered patterns are compiled once into one combined pattern, in which each pattern is a lookahead tried at every position of the text.
+        Matches are the same as running finditer with each pattern on its own.
+
+        register inputs:
+            name: Name the matches of the pattern are reported under.
+            pattern: The regex pattern, as a string.
+
+        scan inputs:
+            text: The text to scan.
+        scan outputs:
+            List of (name, matches) in registration order, where matches are (start, end, value) in text order.
+            value is the text captured by the groups of the pattern, or the whole match if it has none, like findall.
+
+    """
+
+    def __init__(self):
+        self.patterns = []
+        self.lock = threading.Lock()
+        self._compiled = None
+
+    def register(self, name, pattern):
+        # Compiling the pattern on its own validates it and counts its groups
+        groups = re.compile(pattern).groups
+        with self.lock:
+            self.patterns.append((name, pattern, groups))
+            self._compiled = None
+
+    # The combined pattern, the index and group count of each pattern in it, and their names
+    def compiled(self):
+        with self.lock:
+            if self._compiled is None:
+                parts = []
+                layout = []
+                index = 1
+                for _, pattern, groups in self.patterns:
+                    parts.append('(?:(?=(' + pattern + '))|)')
+                    layout.append((index, groups))
+                    index += groups + 1
+
+                # Positions where none of the patterns match are skipped without returning to Python
+                any_match = '(?!)'
+                for index, _ in reversed(layout):
+                    any_match = f'(?({index})|{any_match})'
+
+                names = [name for name, _, _ in self.patterns]
+                self._compiled = (re.compile(''.join(parts) + any_match) if parts else None), layout, names
+            return self._compiled
+
+    def scan(self, text):
+        combined, layout, names = self.compiled()
+        if combined is None:
+            return []
+
+        results = [[] for _ in layout]
+        last_ends = [0] * len(layout)
+        for match in combined.finditer(text):
+            for i, (index, groups) in enumerate(layout):
+                start = match.start(index)
+                # Not matched here, or overlapping the previous match of the same pattern
+                if start == -1 or start < last_ends[i]:
+                    continue
+                end = match.end(index)
+                last_ends[i] = end if end > start else start + 1
+                value = ''.join(match.group(group) or '' for group in range(index + 1, index + groups + 1)) if groups else match.group(index)
+                results[i].append((start, end, value))
+
+        return list(zip(names, results))
@@ -0,0 +1,69 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StageGraph:
+    """
+        Runs the stages of a redaction service on threads, each stage as soon as the stages it depends on are done.
+        A stage with stop_if ends the run when its result matches, for example when content safety flags the input: stages that have not started are cancelled and running ones are left to finish in the background, their results ignored.
+
+        add inputs:
+            name: Name of the stage.
+            func: Function of the stage, called with the results of the stages in after, in order.
+            after: Names of the stages it depends on.
+            stop_if: Function of the result, that stops the run when true.
+
+        run outputs:
+            Results of the stages by name. stopped is set to the stage that stopped the run, latencies to the seconds each finished stage took and total_latency to the seconds of the run. Printing them is left to the service.
+
+    """
+
+    def __init__(self, name='stages'):
+        self.name = name
+        self.stages = {}
+        self.results = {}
+        self.latencies = {}
+        self.total_latency = None
+        self.stopped = None
+
+    def add(self, name, func, after=[], stop_if=None):
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = (func, list(after), stop_if)
+
+    def run(self):
+        start_time = time.perf_counter()
+        pending = dict(self.stages)
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=max(len(self.stages), 1), thread_name_prefix=self.name)
+        try:
+            while pending or running:
+                # Starting every stage whose dependencies are done
+                for name, (func, after, stop_if) in list(pending.items()):
+                    if all(dependency in self.results for dependency in after):
+                        running[executor.submit(self.run_stage, name, func, [self.results[dependency] for dependency in after])] = name
+                        del pending[name]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.results[name] = future.result()
+                    stop_if = self.stages[name][2]
+                    if stop_if is not None and stop_if(self.results[name]):
+                        self.stopped = name
+                        for other in running:
+                            other.cancel()
+                        return self.results
+        finally:
+            # Stages already running after a stop or an error finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.total_latency = time.perf_counter() - start_time
+        return self.results
+
+    def run_stage(self, name, func, args):
+        start_time = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.latencies[name] = time.perf_counter() - start_time
@@ -0,0 +1,129 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from ..apps import TRAINING_PROCESS_ENV
+from ..models import trainingRun
+from .jobs import process_alive
+
+# Statuses of runs that have not ended
+ACTIVE_STATUSES = ['queued', 'running']
+
+
+# Entries of the training metrics log after the first `after` lines, of one run or of every run
+# Returns the entries and the number of lines read, to pass as `after` for the next entries
+def read_training_logs(run_id=None, after=0, limit=1000):
+    entries = []
+    line_number = after
+    if not os.path.exists(settings.MODEL_TRAINING_LOGS):
+        return entries, line_number
+
+    with open(settings.MODEL_TRAINING_LOGS, 'r') as file:
+        for i, line in enumerate(file):
+            if i < after:
+                continue
+            if len(entries) >= limit:
+                break
+            line_number = i + 1
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # A line being written by the training process
+            if run_id is None or entry.get('run_id') == run_id:
+                entries.append(entry)
+    return entries, line_number
+
+
+class TrainingRunner:
+    """
+        Starts fine-tuning runs in a detached process, so training never shares the CPU budget or memory of the serving process, and the server can stop or reload while a run trains.
+        The training process records its progress in the trainingRun table, where only one run can be queued or running at a time.
+        A thread of the serving process that started a run waits for it and reloads the fine-tuned agent when the run is done. Runs whose process is gone are failed by recover.
+
+        start outputs:
+            The trainingRun started, or the one already queued or running, and whether it was started.
+
+        cancel inputs:
+            run_id: Id of the run.
+        cancel outputs:
+            Whether the run was cancelled, or will stop at its next progress update.
+
+    """
+
+    def start(self):
+        while True:
+            try:
+                with transaction.atomic():
+                    run = trainingRun.objects.create()
+                break
+            except IntegrityError:
+                # Another run is active, maybe started by another server process
+                active = trainingRun.objects.filter(status__in=ACTIVE_STATUSES).first()
+                if active is not None:
+                    return active, False
+
+        try:
+            with open(settings.TRAINING_PROCESS_LOG, 'ab') as log:
+                process = subprocess.Popen(
+                    [sys.executable, '-m', 'app.services.training_worker', str(run.run_id), str(settings.TRAINING_CPU_THREADS), str(settings.TRAINING_NICENESS)],
+                    cwd=settings.BASE_DIR, env={**os.environ, TRAINING_PROCESS_ENV: '1'},
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                    start_new_session=True, # Not stopped with the server, nor by the signals sent to its process group
+                )
+        except OSError as e:
+            trainingRun.objects.filter(pk=run.pk).update(status='failed', error=f'The training process could not start: {e}', finished=timezone.now())
+            run.refresh_from_db()
+            return run, False
+
+        trainingRun.objects.filter(pk=run.pk, pid__isnull=True).update(pid=process.pid)
+        threading.Thread(target=self.watch, args=(run.run_id, process), name='training-watch', daemon=True).start()
+        print(f"Training run {run.run_id} started in process {process.pid}")
+        return run, True
+
+    def watch(self, run_id, process):
+        returncode = process.wait()
+        close_old_connections()
+        try:
+            # A process that died without recording the end of its run (killed, out of memory) fails it
+            trainingRun.objects.filter(run_id=run_id, status__in=ACTIVE_STATUSES).update(status='failed', error=f'The training process exited with code {returncode}.', finished=timezone.now())
+            run = trainingRun.objects.get(run_id=run_id)
+            print(f"Training run {run_id} {run.status}")
+            if run.status == 'done':
+                # Serve the fine-tuned weights from the shared registry
+                from .registry import model_registry
+                model_registry.reload_assistant()
+        finally:
+            close_old_connections()
+
+    # Queued runs are cancelled at once, running ones stop at their next progress update
+    def cancel(self, run_id):
+        if trainingRun.objects.filter(run_id=run_id, status='queued').update(status='cancelled', cancel_requested=True, finished=timezone.now()):
+            return True
+        return bool(trainingRun.objects.filter(run_id=run_id, status='running').update(cancel_requested=True))
+
+    # Runs whose training process is gone, for example after the machine restarted, cannot be resumed
+    # A run gets the pid of its process right after it is created, one still without it after a minute never got a process
+    def recover(self):
+        interrupted = trainingRun.objects.filter(status__in=ACTIVE_STATUSES, pid__isnull=True, created__lt=timezone.now() - timedelta(minutes=1)).update(status='failed', error='The training process did not start.', finished=timezone.now())
+        for run in trainingRun.objects.filter(status__in=ACTIVE_STATUSES, pid__isnull=False):
+            if not process_alive(run.pid):
+                interrupted += trainingRun.objects.filter(pk=run.pk, status=run.status).update(status='failed', error='The training process stopped while the run was training.', finished=timezone.now())
+        if interrupted:
+            print(f"Recovered training runs: {interrupted} interrupted")
+
+training_runner = None
+training_runner_lock = threading.Lock()
+
+# The training runner of this process, started on first use
+def get_training_runner():
+    global training_runner
+    with training_runner_lock:
+        if training_runner is None:
+            training_runner = TrainingRunner()
+            training_runner.recover()
+    return training_runner
@@ -0,0 +1,61 @@
+import os
+import sys
+from ..apps import TRAINING_PROCESS_ENV
+
+# Training runs in a process of its own, started with python -m app.services.training_worker <run_id> <cpu_threads> <niceness>
+# This module is imported there before Django is set up
+
+
+# Limits a training process to cpu_threads of the last CPUs, below the priority of the serving process
+# Thread pools of torch are sized when it is imported, so this runs before Django and the training modules are loaded
+def limit_training_cpu(cpu_threads, niceness):
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = str(cpu_threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cpus[-cpu_threads:])
+    if niceness:
+        os.nice(niceness)
+
+# Entry point of the training process, records the end of the run it trains
+def training_process(run_id, cpu_threads, niceness):
+    limit_training_cpu(cpu_threads, niceness)
+
+    import django
+
+    # Before Django is set up, so the app does not warm the serving models in this process
+    os.environ[TRAINING_PROCESS_ENV] = '1'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'redact.settings')
+    django.setup()
+
+    import torch
+    from django.conf import settings
+    from django.utils import timezone
+    from ..models import trainingRun
+    from .db_service import trainingSelection
+    from .model_training import train_model
+
+    torch.set_num_threads(cpu_threads)
+    # A run cancelled while it was queued is never started
+    if not trainingRun.objects.filter(run_id=run_id, status='queued').update(status='running', started=timezone.now(), pid=os.getpid()):
+        return
+
+    high_water_mark = None
+    try:
+        # Only the training labels seen since the last finished run are trained on, with a replay of older ones
+        selection = trainingSelection(seed=trainingRun.objects.filter(status='done').count())
+        trainingRun.objects.filter(run_id=run_id).update(new_labels=selection.new_labels)
+        if selection.new_labels < settings.TRAINING_MIN_NEW_LABELS:
+            metrics, status, error = None, 'skipped', f'Only {selection.new_labels} training labels are new since the last run, {settings.TRAINING_MIN_NEW_LABELS} are needed.'
+        else:
+            metrics = train_model(run_id, selection)
+            status, error = ('cancelled', '') if metrics is None else ('done', '')
+            high_water_mark = selection.until if metrics is not None else None
+    except Exception as e:
+        print(f"Training run {run_id} failed: {e!r}")
+        metrics, status, error = None, 'failed', str(e)
+    trainingRun.objects.filter(run_id=run_id).update(status=status, metrics=metrics, error=error, high_water_mark=high_water_mark, eta_seconds=None, finished=timezone.now())
+
+if __name__ == '__main__':
+    training_process(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
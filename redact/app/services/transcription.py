@@ -0,0 +1,118 @@
+import os
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+import numpy as np
+from django.conf import settings
+from .muting import SAMPLE_TYPES, is_pcm_wav
+
+SILENCE_WINDOW_MS = 20 # Length of the windows compared when looking for the quietest point
+
+
+# Frame of the quietest window between first and last, where the audio is cut
+def quietest_frame(source, first, last):
+    params = source.getparams()
+    source.setpos(first)
+    samples = np.frombuffer(source.readframes(last - first), dtype=SAMPLE_TYPES[params.sampwidth]).reshape(-1, params.nchannels).astype(np.float64)
+    if params.sampwidth == 1:
+        samples -= 128 # 8-bit PCM is unsigned
+    window = max(1, params.framerate * SILENCE_WINDOW_MS // 1000)
+    windows = len(samples) // window
+    if windows == 0:
+        return (first + last) // 2
+    energy = (samples[:windows * window] ** 2).reshape(windows, -1).mean(axis=1)
+    return first + int(np.argmin(energy)) * window + window // 2
+
+# Frames where a long recording is cut, each at the quietest point within SPEECH_SILENCE_SEARCH_SECONDS of every SPEECH_CHUNK_SECONDS
+def silence_cuts(source):
+    params = source.getparams()
+    chunk = int(settings.SPEECH_CHUNK_SECONDS * params.framerate)
+    search = int(settings.SPEECH_SILENCE_SEARCH_SECONDS * params.framerate)
+    cuts = []
+    position = 0
+    while params.nframes - position > chunk + search:
+        target = position + chunk
+        cut = quietest_frame(source, max(position + 1, target - search), min(params.nframes - 1, target + search))
+        cuts.append(cut)
+        position = cut
+    return cuts
+
+# Writes frames first to last of a WAV file into a WAV file of its own, in blocks
+def write_chunk(source, chunk_path, first, last):
+    params = source.getparams()
+    block = max(1, int(settings.AUDIO_BLOCK_SECONDS * params.framerate))
+    source.setpos(first)
+    with wave.open(chunk_path, 'wb') as chunk:
+        chunk.setparams(params)
+        position = first
+        while position < last:
+            frames = source.readframes(min(block, last - position))
+            if not frames:
+                break
+            chunk.writeframesraw(frames)
+            position += len(frames) // (params.sampwidth * params.nchannels)
+
+# Whether a recording is long enough to be transcribed in chunks
+def can_transcribe_in_chunks(audio_path):
+    if not settings.SPEECH_CHUNKING or not is_pcm_wav(audio_path):
+        return False
+    with wave.open(audio_path, 'rb') as source:
+        if source.getsampwidth() not in SAMPLE_TYPES:
+            return False
+        return source.getnframes() > (settings.SPEECH_CHUNK_SECONDS + settings.SPEECH_SILENCE_SEARCH_SECONDS) * source.getframerate()
+
+# Moves the phrases and words of a chunk to their place in the whole recording
+# Only words whose middle falls between the cuts around the chunk are kept, as the overlap with the chunks next to it is transcribed twice
+def shift_phrases(transcription_json, offset, start, end):
+    phrases = []
+    for phrase in transcription_json.get('phrases', []):
+        words = []
+        for word in phrase.get('words', []):
+            word = {**word, 'offsetMilliseconds': word['offsetMilliseconds'] + offset}
+            if start <= word['offsetMilliseconds'] + word['durationMilliseconds'] / 2 < end:
+                words.append(word)
+        if not words:
+            continue
+        shifted = {**phrase, 'words': words, 'offsetMilliseconds': phrase['offsetMilliseconds'] + offset}
+        if len(words) < len(phrase['words']):
+            # Phrases cut by the chunk keep their words on this side of the cut
+            shifted['text'] = ' '.join(word['text'] for word in words)
+            shifted['offsetMilliseconds'] = words[0]['offsetMilliseconds']
+            shifted['durationMilliseconds'] = words[-1]['offsetMilliseconds'] + words[-1]['durationMilliseconds'] - words[0]['offsetMilliseconds']
+        phrases.append(shifted)
+    return phrases
+
+# Transcribes a long WAV recording in chunks cut at silences, SPEECH_MAX_CONCURRENCY at a time
+# transcribe: Function sending one audio file to the speech service, returning its transcription json and status code
+# Returns the transcription json of the whole recording, with the phrases and words of every chunk, and the status code
+def transcribe_in_chunks(audio_path, transcribe):
+    with TemporaryDirectory() as directory:
+        chunks = []
+        with wave.open(audio_path, 'rb') as source:
+            frame_rate = source.getframerate()
+            frame_count = source.getnframes()
+            overlap = int(settings.SPEECH_CHUNK_OVERLAP_SECONDS * frame_rate)
+            bounds = [0] + silence_cuts(source) + [frame_count]
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+                first, last = max(0, start - overlap), min(frame_count, end + overlap)
+                chunk_path = os.path.join(directory, f'chunk_{i}.wav')
+                write_chunk(source, chunk_path, first, last)
+                # Offset of the chunk, and the part of the recording its words are kept for, in milliseconds
+                chunks.append((chunk_path, first * 1000 / frame_rate, start * 1000 / frame_rate, end * 1000 / frame_rate if end < frame_count else float('inf')))
+
+        with ThreadPoolExecutor(max_workers=settings.SPEECH_MAX_CONCURRENCY, thread_name_prefix='transcription') as executor:
+            results = list(executor.map(lambda chunk: transcribe(chunk[0]), chunks))
+
+    for transcription_json, status_code in results:
+        if status_code != 200:
+            return transcription_json, status_code
+
+    phrases = []
+    for (_, offset, start, end), (transcription_json, _) in zip(chunks, results):
+        phrases += shift_phrases(transcription_json, round(offset), start, end)
+    print(f"Transcribed {os.path.basename(audio_path)} in {len(chunks)} chunks")
+    return {
+        'durationMilliseconds': round(frame_count * 1000 / frame_rate),
+        'combinedPhrases': [{'text': ' '.join(phrase['text'] for phrase in phrases)}],
+        'phrases': phrases,
+    }, 200
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import uuid
+from django.conf import settings
+from django.utils.text import get_valid_filename
+from .cache import remember_digest
+
+
+# Raised for uploads over the size limit of their type, the message is shown to the user
+class UploadTooLarge(ValueError):
+
+    def __init__(self, name, kind, limit):
+        super().__init__(f"{name} is larger than the {limit // (1024 * 1024)} MB allowed for {kind} files.")
+
+# Rejects an upload over the size limit of its kind, before any of it is read
+def check_upload_size(file, kind):
+    limit = settings.UPLOAD_MAX_SIZES.get(kind)
+    if limit is not None and file.size is not None and file.size > limit:
+        raise UploadTooLarge(file.name, kind, limit)
+
+# Streams an upload to the uploads folder in chunks, hashing it while it is written
+# Files are named after their content, so uploads with the same name never overwrite each other and a file uploaded again is stored once
+# Returns the path of the stored file
+def save_upload(file, kind):
+    check_upload_size(file, kind)
+    limit = settings.UPLOAD_MAX_SIZES.get(kind)
+    upload_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    partial_path = os.path.join(upload_dir, f'.{uuid.uuid4().hex}.part')
+    try:
+        with open(partial_path, 'wb') as partial_file:
+            for chunk in file.chunks():
+                size += len(chunk)
+                # The size given by the client is not trusted
+                if limit is not None and size > limit:
+                    raise UploadTooLarge(file.name, kind, limit)
+                digest.update(chunk)
+                partial_file.write(chunk)
+
+        base_name, extension = os.path.splitext(get_valid_filename(os.path.basename(file.name)) or 'upload')
+        path = os.path.join(upload_dir, f'{base_name}_{digest.hexdigest()[:16]}{extension}')
+        if os.path.exists(path):
+            os.remove(partial_path)
+        else:
+            os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+    remember_digest(path, digest.hexdigest())
+    return path
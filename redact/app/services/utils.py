@@ -1,84 +1,79 @@
-import datetime
 import os
+import threading
+from functools import lru_cache
 import regex as re
-import requests
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
-from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer import AnalyzeResult
+from .clients import get_http_session, get_document_analysis_client, get_blob_service_client, MultipartFile
+from .cache import cached, file_digest
+from .muting import redact_audio_file
+from .pdf_writer import redact_pdf_file
+from .transcription import can_transcribe_in_chunks, transcribe_in_chunks
 from django.conf import settings
 from PIL import Image, ImageDraw
-from pydub import AudioSegment
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from io import BytesIO, StringIO
 
 # Azure OCR function for images
 def azure_image_ocr(image):
-    endpoint = settings.AZURE_DI_ENDPOINT
-    key = settings.AZURE_DI_KEY
+    return azure_read_ocr(image)
 
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=endpoint, credential=AzureKeyCredential(key)
-    )
-    
-    with open(image, "rb") as form_file:
-        poller = document_analysis_client.begin_analyze_document(
-            model_id="prebuilt-read", document=form_file
-        )
-        result = poller.result()
-    
-    return result
+# Azure OCR function for PDFs, of the given pages only when set (like "1-20")
+def azure_pdf_ocr(pdf, pages=None):
+    return azure_read_ocr(pdf, pages)
 
-# Azure OCR function for PDFs
-def azure_pdf_ocr(pdf):
-    endpoint = settings.AZURE_DI_ENDPOINT
-    key = settings.AZURE_DI_KEY
+# Azure OCR with the prebuilt read model, cached by the SHA-256 of the file and the pages read
+def azure_read_ocr(path, pages=None):
+    def analyze():
+        document_analysis_client = get_document_analysis_client()
 
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=endpoint, credential=AzureKeyCredential(key)
-    )
-    
-    with open(pdf, "rb") as form_file:
-        poller = document_analysis_client.begin_analyze_document(
-            model_id="prebuilt-read", document=form_file
-        )
-        result = poller.result()
-    
-    return result
+        with open(path, "rb") as form_file:
+            poller = document_analysis_client.begin_analyze_document(
+                model_id="prebuilt-read", document=form_file, **({'pages': pages} if pages else {})
+            )
+            result = poller.result()
+
+        return result
 
-# Azure speech-to-text function
+    key = ('prebuilt-read', file_digest(path)) + ((pages,) if pages else ())
+    return cached('ocr', key, analyze, dump=AnalyzeResult.to_dict, load=AnalyzeResult.from_dict)
+
+# Azure speech-to-text function, cached by the SHA-256 of the audio
+# Long WAV recordings are cut at silences and their chunks transcribed in parallel
 def azure_speech_to_text(audio_path):
+    def transcribe():
+        if can_transcribe_in_chunks(audio_path):
+            transcription_json, status_code = transcribe_in_chunks(audio_path, azure_fast_transcription)
+        else:
+            transcription_json, status_code = azure_fast_transcription(audio_path)
+
+        text = ''
+        if status_code == 200:
+            text = transcription_json['combinedPhrases'][0]['text']
+
+        return text, transcription_json, status_code
+
+    # Failed transcriptions are not cached
+    text, transcription_json, _ = cached('transcription', file_digest(audio_path), transcribe, store_if=lambda transcription: transcription[2] == 200)
+    return text, transcription_json
+
+# One fast transcription request, returns the transcription json and the status code
+def azure_fast_transcription(audio_path):
     key = settings.AZURE_SI_KEY
     endpoint = settings.AZURE_SI_ENDPOINT
 
-    audio = open(audio_path, "rb").read()
+    # The audio is streamed from disk
+    audio = MultipartFile("audio", audio_path)
 
     headers = {
-        "Ocp-Apim-Subscription-Key": key
-    }
-    files = {
-        "audio": audio
+        "Ocp-Apim-Subscription-Key": key,
+        "Content-Type": audio.content_type
     }
-    fast_transcription_request = requests.post(f"{endpoint}/speechtotext/transcriptions:transcribe?api-version=2024-11-15", headers=headers, files=files)
-    
-    text = ''
-    if fast_transcription_request.status_code == 200:
-        text = fast_transcription_request.json()['combinedPhrases'][0]['text']
+    fast_transcription_request = get_http_session().post(f"{endpoint}/speechtotext/transcriptions:transcribe?api-version=2024-11-15", headers=headers, data=audio)
 
-    return text, fast_transcription_request.json()
+    return fast_transcription_request.json(), fast_transcription_request.status_code
 
 # Azure function to upload video to storage account
 def azure_upload_video(video_path):
     video_name = os.path.basename(video_path)
-    storage_credential = DefaultAzureCredential()
-    blob_service_client = BlobServiceClient(account_url=settings.AZURE_STORAGE_URL, credential=storage_credential)
-    container_client = blob_service_client.get_container_client(settings.AZURE_STORAGE_CONTAINER)
-    user_delegation_key = blob_service_client.get_user_delegation_key(
-        key_start_time=datetime.datetime.now(datetime.timezone.utc),
-        key_expiry_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
-    )
+    container_client = get_blob_service_client().get_container_client(settings.AZURE_STORAGE_CONTAINER)
 
     with open(file=video_path, mode="rb") as video_file:
         video_blob = container_client.upload_blob(name=video_name, data=video_file, overwrite=True)
@@ -87,10 +82,108 @@ def azure_upload_video(video_path):
 
     return video_url
 
-# Function to extract Regex matches from text
+# Raised for user regex patterns that are rejected or time out, the message is shown to the user
+class RegexPatternError(ValueError):
+    pass
+
+# Quantifiers that can repeat without bound, the ones behind catastrophic backtracking
+UNBOUNDED_QUANTIFIER = re.compile(r'[+*]|\{\d*,\}')
+
+# Rejects patterns that are too long, or that repeat a group which itself repeats, like (a+)+ or (\w*\s?)*
+def check_regexPattern(regexPattern):
+    if len(regexPattern) > settings.REGEX_MAX_LENGTH:
+        raise RegexPatternError(f"The regex pattern is longer than {settings.REGEX_MAX_LENGTH} characters.")
+
+    groups = [] # Whether each open group contains an unbounded quantifier
+    i = 0
+    while i < len(regexPattern):
+        char = regexPattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == '[':
+            # Skipping character classes, where quantifier characters are literals
+            end = i + 1
+            if end < len(regexPattern) and regexPattern[end] == '^':
+                end += 1
+            if end < len(regexPattern) and regexPattern[end] == ']':
+                end += 1
+            while end < len(regexPattern) and regexPattern[end] != ']':
+                end += 2 if regexPattern[end] == '\\' else 1
+            i = end + 1
+            continue
+        if char == '(':
+            groups.append(False)
+        elif char == ')' and groups:
+            repeats_inside = groups.pop()
+            quantifier = UNBOUNDED_QUANTIFIER.match(regexPattern, i + 1)
+            if repeats_inside and quantifier:
+                raise RegexPatternError("The regex pattern repeats a group that already repeats, which can take exponential time. Please simplify it.")
+            if groups and (repeats_inside or quantifier):
+                groups[-1] = True
+        elif groups and UNBOUNDED_QUANTIFIER.match(regexPattern, i):
+            groups[-1] = True
+        i += 1
+
+def compile_uncached_regexPattern(regexPattern):
+    check_regexPattern(regexPattern)
+    try:
+        return re.compile(regexPattern)
+    except re.error as e:
+        raise RegexPatternError(f"The regex pattern is not valid: {e}") from e
+
+regex_cache = None
+regex_cache_lock = threading.Lock()
+
+# Compiled user patterns, the same few patterns are sent many times
+# The cache is built on first use with REGEX_CACHE_SIZE entries, and built again when the setting changes
+def compile_regexPattern(regexPattern):
+    global regex_cache
+    with regex_cache_lock:
+        if regex_cache is None or regex_cache.cache_parameters()['maxsize'] != settings.REGEX_CACHE_SIZE:
+            regex_cache = lru_cache(maxsize=settings.REGEX_CACHE_SIZE)(compile_uncached_regexPattern)
+        cache = regex_cache
+    return cache(regexPattern)
+
+# Function to extract Regex matches from text, as (start, end) spans
+# Each match is stopped after REGEX_MATCH_TIMEOUT seconds
 def match_regexPattern(text, regexPattern):
-    matches = re.findall(regexPattern, text)
-    return matches
+    if not regexPattern:
+        return []
+
+    pattern = compile_regexPattern(regexPattern)
+    spans = []
+    position = 0
+    while position <= len(text):
+        try:
+            match = pattern.search(text, position, timeout=settings.REGEX_MATCH_TIMEOUT)
+        except TimeoutError as e:
+            print(f"Regex pattern {regexPattern!r} timed out at offset {position}")
+            raise RegexPatternError("The regex pattern took too long to match. Please simplify it.") from e
+        if match is None:
+            break
+        if match.end() > match.start():
+            spans.append(match.span())
+            position = match.end()
+        else:
+            position = match.end() + 1
+    return spans
+
+# Path of the redacted output of an uploaded file, in the outputs folder of the media root
+def output_file_path(input_path):
+    if not os.path.exists(os.path.join(settings.MEDIA_ROOT, 'outputs')):
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'outputs'))
+    return os.path.join(settings.MEDIA_ROOT, 'outputs', os.path.basename(input_path))
+
+# URL of an output in the media root
+def output_file_url(output_path):
+    relative_output_path = os.path.relpath(output_path, settings.MEDIA_ROOT)
+    return os.path.join(settings.MEDIA_URL, relative_output_path)
+
+# Path in the media root of an output URL
+def media_file_path(output_url):
+    relative_output_path = os.path.relpath(output_url, settings.MEDIA_URL)
+    return os.path.join(settings.MEDIA_ROOT, relative_output_path)
 
 # Export redacted image
 def export_redacted_image(image_path, redacted_cords):
@@ -111,70 +204,21 @@ def export_redacted_image(image_path, redacted_cords):
         finally:
             draw.rectangle([x_min, y_min, x_max, y_max], fill='black')
 
-    if not os.path.exists(os.path.join(settings.MEDIA_ROOT, 'outputs')):
-        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'outputs'))
-    output_path = os.path.join(settings.MEDIA_ROOT, 'outputs', os.path.basename(image_path))
+    output_path = output_file_path(image_path)
     image.save(output_path)
 
-    relative_output_path = os.path.relpath(output_path, settings.MEDIA_ROOT)
-    return os.path.join(settings.MEDIA_URL, relative_output_path)
+    return output_file_url(output_path)
 
-# Export redacted PDF
+# Export redacted PDF, the boxes of every page are appended to a copy of the file
 def export_redacted_pdf(pdf_path, redacted_cords, page_dims):
-    reader = PdfReader(pdf_path)
-    writer = PdfWriter()
-
-    for page_num in range(len(reader.pages)):
-        page = reader.pages[page_num]
-        page_width = float(page.mediabox.width)
-        page_height = float(page.mediabox.height)
-        packet = BytesIO()
-        can = canvas.Canvas(packet, pagesize=letter)
-
-        # For each set of coordinates, draw black boxes
-        if page_num < 2:
-            for coord_set in redacted_cords[page_num]:
-                x_coords = [point[0] for point in coord_set]
-                y_coords = [point[1] for point in coord_set]
-                x_min, x_max = min(x_coords) / page_dims[page_num][0] * page_width, max(x_coords) / page_dims[page_num][0] * page_width
-                y_min, y_max = page_height - (min(y_coords) / page_dims[page_num][1] * page_height), page_height - (max(y_coords) / page_dims[page_num][1] * page_height)
-
-                can.setFillColorRGB(0, 0, 0)
-                can.rect(x_min, y_min, (x_max - x_min), (y_max - y_min), stroke=0, fill=1)
-
-        # Finalize the canvas for the page
-        can.save()
-
-        # Merge the redaction onto the page
-        packet.seek(0)
-        new_pdf = PdfReader(packet)
-        if new_pdf.pages:
-            page.merge_page(new_pdf.pages[0])
-        writer.add_page(page)
-
-    if not os.path.exists(os.path.join(settings.MEDIA_ROOT, 'outputs')):
-        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'outputs'))
-    output_path = os.path.join(settings.MEDIA_ROOT, 'outputs', os.path.basename(pdf_path))
-    with open(output_path, 'wb') as output_file:
-        writer.write(output_file)
+    output_path = output_file_path(pdf_path)
+    redact_pdf_file(pdf_path, output_path, redacted_cords, page_dims)
 
-    relative_output_path = os.path.relpath(output_path, settings.MEDIA_ROOT)
-    return os.path.join(settings.MEDIA_URL, relative_output_path)
+    return output_file_url(output_path)
 
-# Export redacted audio
+# Export redacted audio, muting or bleeping (AUDIO_BLEEP_FREQUENCY) the redacted timestamps in the format of the input
 def export_redacted_audio(audio_path, redacted_timestamps):
-    audio = AudioSegment.from_file(audio_path)
-    
-    for start_time, end_time in redacted_timestamps:
-        if 0 <= start_time < len(audio) and 0 < end_time <= len(audio):
-            # Replace the segment with silence
-            silence = AudioSegment.silent(duration=end_time - start_time)
-            audio = audio[:start_time] + silence + audio[end_time:]
-    
-    if not os.path.exists(os.path.join(settings.MEDIA_ROOT, 'outputs')):
-        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'outputs'))
-    output_path = os.path.join(settings.MEDIA_ROOT, 'outputs', os.path.basename(audio_path))
-    audio.export(output_path, format='wav')
+    output_path = output_file_path(audio_path)
+    redact_audio_file(audio_path, output_path, redacted_timestamps, settings.AUDIO_BLEEP_FREQUENCY)
 
-    relative_output_path = os.path.relpath(output_path, settings.MEDIA_ROOT)
-    return os.path.join(settings.MEDIA_URL, relative_output_path)
+    return output_file_url(output_path)
@@ -1,9 +1,41 @@
-from django.test import TestCase
-from .services.db_service import ModelData
-from .models import modelTrainingData
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, SimpleTestCase, override_settings
+from .services.db_service import uploadOutputDB as ModelData, FeedbackWriter, countTrainingLabels, iterTrainingLabels, trainingLabelQuerySet, trainingSelection
+from .services.rewriter import redact_terms
+from .services.scanner import PatternScanner
+from .services.ocr_index import OCRWordIndex
+from .services.document import SpanTable, AnalyzedDocument, MAX_SENTENCE_TOKENS
+from .services.stages import StageGraph
+from .services.utils import RegexPatternError, match_regexPattern, azure_speech_to_text
+from .services.clients import TokenCache
+from .services.cache import get_content_cache, file_digest
+from .services.uploads import UploadTooLarge, save_upload
+from .services.muting import merge_intervals, redact_wav
+from .management.fake_speech import FakeSpeechServer, build_recording
+from .services.pdf_writer import RedactedPDFWriter, redact_pdf_file
+from .services.batching import NERBatcher
+from .services.chunking import TextChunker
+from .services import model_service, batch, guardrails
+from .models import trainingLabel, redactionJob, trainingRun
 # Create your tests here.
 class ModelDataTest(TestCase):
 
+    # Test transactions are not visible to the feedback writer thread, rows are written in the request
+    @override_settings(FEEDBACK_WRITE_BEHIND=False)
     def test_model_data_insertion(self):
         # Sample data
         dict_struct = [
@@ -15,6 +47,833 @@ class ModelDataTest(TestCase):
         ModelData(dict_struct)
 
         # Check that the data was added correctly
-        self.assertEqual(modelTrainingData.objects.count(), 2)
-        self.assertEqual(modelTrainingData.objects.first().word, 'Shashwat')
-        self.assertEqual(modelTrainingData.objects.last().label, 'I like to get garglled')
\ No newline at end of file
+        self.assertEqual(trainingLabel.objects.count(), 2)
+        self.assertEqual(trainingLabel.objects.get(word='Shashwat').label, "If you fall for nothing, what do you stand for?")
+        self.assertEqual(trainingLabel.objects.get(word='Povidone-iodine').label, 'I like to get garglled')
+
+    @override_settings(FEEDBACK_WRITE_BEHIND=False)
+    def test_pairs_seen_again_are_counted(self):
+        ModelData([{"word": "John", "label": "B-PER"}, {"word": "John", "label": "I-PER"}, {"word": "John", "label": "B-PER"}])
+        first_seen = trainingLabel.objects.get(word='John', label='B-PER').first_seen
+        ModelData([{"word": "John", "label": "B-PER"}])
+
+        self.assertEqual(sorted(trainingLabel.objects.values_list('label', 'count')), [('B-PER', 3), ('I-PER', 1)])
+        pair = trainingLabel.objects.get(word='John', label='B-PER')
+        self.assertEqual(pair.first_seen, first_seen)
+        self.assertGreaterEqual(pair.last_seen, first_seen)
+
+    @override_settings(TRAINING_EVAL_BUCKETS=10)
+    def test_training_labels_are_streamed_in_chunks_by_split(self):
+        trainingLabel.objects.bulk_create([trainingLabel(word=f'word{i}', label='B-PER' if i % 5 else 'O') for i in range(1, 31)])
+        ids = dict(trainingLabel.objects.order_by('id').values_list('word', 'id'))
+
+        train_chunks = list(iterTrainingLabels('train', labels={'B-PER': 0}, chunk_size=7))
+        eval_pairs = [pair for chunk in iterTrainingLabels('eval', chunk_size=7) for pair in chunk]
+
+        self.assertTrue(all(len(chunk) <= 7 for chunk in train_chunks))
+        train_words = [word for chunk in train_chunks for word, _ in chunk]
+        self.assertEqual(train_words, [word for word in ids if ids[word] % 10 and int(word[4:]) % 5])
+        self.assertEqual([word for word, _ in eval_pairs], [word for word in ids if ids[word] % 10 == 0])
+
+    @override_settings(TRAINING_EVAL_BUCKETS=1000, TRAINING_REPLAY_RATIO=0.5, TRAINING_MIN_NEW_LABELS=1)
+    def test_runs_train_on_labels_seen_since_the_last_run_with_a_replay(self):
+        from datetime import datetime, timedelta, timezone as dt_timezone
+
+        start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        trainingLabel.objects.bulk_create([trainingLabel(word=f'word{i}', label='B-PER', last_seen=start + timedelta(minutes=i)) for i in range(1, 41)])
+
+        # A first run trains on every pair
+        self.assertEqual(trainingSelection().new_labels, 40)
+        trainingRun.objects.create(status='done', high_water_mark=start + timedelta(minutes=30))
+
+        selection = trainingSelection(seed=1)
+        words = [word for chunk in iterTrainingLabels('train', chunk_size=7, selection=selection) for word, _ in chunk]
+
+        self.assertEqual((selection.new_labels, selection.until), (10, start + timedelta(minutes=40)))
+        self.assertEqual([word for word in words if int(word[4:]) > 30], [f'word{i}' for i in range(31, 41)])
+        # Half as many older pairs are replayed
+        self.assertEqual(len([word for word in words if int(word[4:]) <= 30]), 5)
+        self.assertEqual(len(selection.replay_ids), 5)
+        self.assertEqual(countTrainingLabels('train', selection=selection), 15)
+        # The new pairs are read through the index on last_seen rather than a scan of every pair
+        self.assertIn('USING INDEX', trainingLabelQuerySet('train', selection=selection).order_by('last_seen', 'id').explain())
+
+    @override_settings(TRAINING_EVAL_BUCKETS=10, TRAINING_MIN_NEW_LABELS=1)
+    def test_pairs_sharing_their_last_seen_are_streamed_once(self):
+        from django.utils import timezone
+
+        # Pairs written in one batch get the same last_seen
+        now = timezone.now()
+        trainingLabel.objects.bulk_create([trainingLabel(word=f'word{i}', label='B-PER', last_seen=now) for i in range(1, 21)])
+        selection = trainingSelection()
+        words = [word for chunk in iterTrainingLabels('train', chunk_size=3, selection=selection) for word, _ in chunk]
+
+        self.assertEqual(words, [word for word, id in trainingLabel.objects.order_by('id').values_list('word', 'id') if id % 10])
+
+    @override_settings(TRAINING_EVAL_BUCKETS=10, TRAINING_REPLAY_RATIO=0.5, TRAINING_MIN_NEW_LABELS=1)
+    def test_chunks_are_read_in_a_shuffled_order(self):
+        import random
+        from datetime import datetime, timedelta, timezone as dt_timezone
+
+        start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        trainingLabel.objects.bulk_create([trainingLabel(word=f'word{i}', label='B-PER', last_seen=start + timedelta(minutes=i // 4)) for i in range(1, 81)])
+        trainingRun.objects.create(status='done', high_water_mark=start + timedelta(minutes=10))
+
+        for selection in (None, trainingSelection()):
+            in_order = list(iterTrainingLabels('train', chunk_size=6, selection=selection))
+            orders = [list(iterTrainingLabels('train', chunk_size=6, selection=selection, rng=random.Random(seed))) for seed in range(3)]
+            for shuffled in orders:
+                self.assertEqual(sorted(map(tuple, shuffled)), sorted(map(tuple, in_order)))
+            self.assertTrue(any(shuffled != in_order for shuffled in orders))
+
+
+class FeedbackWriterTest(SimpleTestCase):
+
+    def test_rows_are_written_in_batches_in_the_background(self):
+        batches = []
+        writer = FeedbackWriter(batches.append, batch_size=4, flush_seconds=0.05)
+        writer.put([{'word': f'word{i}', 'label': 'B-PER'} for i in range(10)])
+
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertEqual(writer.stats(), {'queued': 0, 'written': 10, 'dropped': 0, 'failed': 0})
+
+    def test_rows_are_dropped_when_the_writer_falls_behind(self):
+        writing = threading.Event()
+        release = threading.Event()
+
+        def write(rows):
+            writing.set()
+            release.wait(5)
+
+        writer = FeedbackWriter(write, batch_size=1, flush_seconds=0, max_queued=2, put_timeout=0.05)
+        writer.put([{'word': 'word0', 'label': 'B-PER'}])
+        self.assertTrue(writing.wait(5))
+        # One row is being written, two fit in the queue and the others are dropped once the timeout is spent
+        started = time.monotonic()
+        writer.put([{'word': f'word{i}', 'label': 'B-PER'} for i in range(1, 6)])
+        waited = time.monotonic() - started
+        release.set()
+
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertLess(waited, 1)
+        self.assertEqual(writer.stats()['dropped'], 3)
+        self.assertEqual(writer.stats()['written'], 3)
+
+
+class RedactTermsTest(SimpleTestCase):
+
+    def test_masks_every_occurrence_keeping_length(self):
+        text = "John Smith emailed Johnny Smith."
+        redacted_text = redact_terms(text, ["John", "Johnny", "Smith"])
+
+        self.assertEqual(redacted_text, "████ █████ emailed ██████ █████.")
+        self.assertEqual(len(redacted_text), len(text))
+
+    def test_overlapping_terms_are_both_masked(self):
+        # "ab" and "bcdef" overlap, neither may leak
+        self.assertEqual(redact_terms("abcdef", ["ab", "bcdef"]), "██████")
+
+    def test_single_characters_are_skipped_but_not_numbers(self):
+        self.assertEqual(redact_terms("a b 7 *bold*", ["a", " b ", "7", "*bold*"]), "a b █ ██████")
+
+
+class PatternScannerTest(SimpleTestCase):
+
+    def test_matches_are_the_same_as_scanning_each_pattern(self):
+        scanner = PatternScanner()
+        scanner.register('numbers', r"\b\d+[\d.,-]*\b")
+        scanner.register('urls', r'(?:https?://)?(?:www\.)?([\w.-]+\.\w+)')
+
+        # "3.5" is both a number and a url, and each pattern keeps its own non-overlapping matches
+        results = scanner.scan("Pay 3.5 at https://www.example.com/pay or 42")
+
+        self.assertEqual(results, [
+            ('numbers', [(4, 7, '3.5'), (42, 44, '42')]),
+            ('urls', [(4, 7, '3.5'), (11, 34, 'example.com')]),
+        ])
+
+
+class MatchRegexPatternTest(SimpleTestCase):
+
+    def test_returns_spans_of_the_matches(self):
+        self.assertEqual(match_regexPattern("id 12 and 345", r"\d+"), [(3, 5), (10, 13)])
+        self.assertEqual(match_regexPattern("id 12", ""), [])
+
+    def test_rejects_invalid_and_nested_quantifier_patterns(self):
+        for regexPattern in ["(unclosed", "(a+)+$", r"(\w*\s?)*x", "((ab)*c)+"]:
+            with self.assertRaises(RegexPatternError):
+                match_regexPattern("aaaa", regexPattern)
+
+    def test_quantifier_characters_in_classes_are_literals(self):
+        self.assertEqual(match_regexPattern("a+b", r"([+*]\w)+"), [(1, 3)])
+
+    @override_settings(REGEX_MATCH_TIMEOUT=0.05)
+    def test_slow_matches_time_out(self):
+        # Overlapping alternatives are not caught up front, the timeout stops them
+        with self.assertRaises(RegexPatternError):
+            match_regexPattern("a" * 40 + "!", r"(?:a|aa)*(?:b|!c)")
+
+    def test_the_pattern_cache_follows_its_setting(self):
+        from .services import utils
+
+        with override_settings(REGEX_CACHE_SIZE=2):
+            for regexPattern in [r"\d", r"\w", r"\s"]:
+                match_regexPattern("a 1", regexPattern)
+            self.assertEqual(utils.regex_cache.cache_info().maxsize, 2)
+            self.assertEqual(utils.regex_cache.cache_info().currsize, 2)
+        match_regexPattern("a 1", r"\d")
+        self.assertEqual(utils.regex_cache.cache_info().maxsize, utils.settings.REGEX_CACHE_SIZE)
+
+
+class OCRWordIndexTest(SimpleTestCase):
+
+    def build_result(self, pages):
+        # Minimal AnalyzeResult: words with their text, offset and a square polygon
+        result_pages = []
+        content = ''
+        for words in pages:
+            page_words = []
+            for word in words:
+                polygon = [SimpleNamespace(x=len(content), y=0), SimpleNamespace(x=len(content) + 1, y=1)]
+                page_words.append(SimpleNamespace(content=word, span=SimpleNamespace(offset=len(content), length=len(word)), polygon=polygon))
+                content += word + ' '
+            result_pages.append(SimpleNamespace(words=page_words))
+        return SimpleNamespace(content=content, pages=result_pages)
+
+    def test_words_containing_terms_are_found_on_every_page(self):
+        result = self.build_result([["Call", "John,", "at", "555-1234"], ["John", "Johnson", "a", "7"]])
+        index = OCRWordIndex(result)
+
+        self.assertEqual(sorted(index.containing(["John", "a", "7", "1234"])), [1, 3, 4, 5, 7])
+        self.assertEqual(index.polygons_by_page(index.containing(["555"])), [[[(14.0, 0.0), (15.0, 1.0)]], []])
+
+    def test_words_overlapped_by_detections(self):
+        result = self.build_result([["Call", "John", "Smith", "now"]])
+        spans = SpanTable()
+        spans.add(6, 7, 'PER', 'ner') # "ohn Smi"
+
+        self.assertEqual(list(OCRWordIndex(result).covered(spans)), [1, 2])
+
+
+class JobStatusTest(TestCase):
+
+    def test_status_of_done_failed_and_unknown_jobs(self):
+        done = redactionJob.objects.create(kind='text', status='done', result={'redacted_text': '████ called'})
+        failed = redactionJob.objects.create(kind='video', status='failed', error='Could not process the video at this time.')
+
+        response = self.client.get(f'/jobs/{done.job_id}/')
+        self.assertEqual(response.json()['result'], {'redacted_text': '████ called'})
+
+        response = self.client.get(f'/jobs/{failed.job_id}/')
+        self.assertEqual((response.json()['status'], response.json()['error']), ('failed', 'Could not process the video at this time.'))
+
+        self.assertEqual(self.client.get(f'/jobs/{uuid.uuid4()}/').status_code, 404)
+
+
+class TrainingRunTest(TestCase):
+
+    def test_queued_runs_are_cancelled_and_ended_runs_are_not(self):
+        queued = trainingRun.objects.create()
+        done = trainingRun.objects.create(status='done', step=120, max_steps=120, metrics={'train_loss': 0.4})
+
+        response = self.client.post(f'/training/{queued.run_id}/cancel/')
+        self.assertEqual((response.json()['status'], response.json()['cancel_requested']), ('cancelled', True))
+        self.assertEqual(self.client.post(f'/training/{done.run_id}/cancel/').status_code, 409)
+
+        response = self.client.get(f'/training/{done.run_id}/')
+        self.assertEqual((response.json()['step'], response.json()['metrics']), (120, {'train_loss': 0.4}))
+        self.assertEqual(self.client.get(f'/training/{uuid.uuid4()}/').status_code, 404)
+
+    def test_one_run_is_active_at_a_time_in_a_detached_process(self):
+        from django.db import IntegrityError, transaction
+        from .services.training_runner import TrainingRunner
+
+        runner = TrainingRunner()
+        with TemporaryDirectory() as directory, override_settings(TRAINING_PROCESS_LOG=os.path.join(directory, 'training.log')), \
+                mock.patch('subprocess.Popen', return_value=SimpleNamespace(pid=4321)) as popen, mock.patch.object(TrainingRunner, 'watch'):
+            run, started = runner.start()
+            active, started_again = runner.start()
+
+        self.assertTrue(started)
+        self.assertEqual((active.pk, started_again, active.pid), (run.pk, False, 4321))
+        self.assertEqual(popen.call_count, 1)
+        self.assertTrue(popen.call_args.kwargs['start_new_session'])
+        # Server processes that race past each other are stopped by the database
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            trainingRun.objects.create(status='running')
+
+    @override_settings(WARM_MODELS_ON_STARTUP=True)
+    def test_training_processes_do_not_warm_the_serving_models(self):
+        from django.apps import apps
+        from .apps import TRAINING_PROCESS_ENV
+        from .services.registry import model_registry
+
+        # Training processes inherit the argv of the server
+        with mock.patch.object(model_registry, 'warm') as warm, mock.patch('sys.argv', ['manage.py', 'runserver', '--noreload']):
+            with mock.patch.dict(os.environ, {TRAINING_PROCESS_ENV: '1'}):
+                apps.get_app_config('app').ready()
+            self.assertFalse(warm.called)
+            apps.get_app_config('app').ready()
+            self.assertTrue(warm.called)
+
+    def test_metrics_log_is_read_by_run_after_a_line(self):
+        with TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, 'training_logs.jsonl')
+            with open(log_path, 'w') as log_file:
+                for step, run_id in [(50, 'a'), (50, 'b'), (100, 'a'), (150, 'a')]:
+                    log_file.write(json.dumps({'run_id': run_id, 'step': step, 'loss': 1 / step}) + '\n')
+                log_file.write('{"run_id": "a", "st') # Line being written
+
+            with override_settings(MODEL_TRAINING_LOGS=log_path):
+                response = self.client.get('/training/logs/', {'run': 'a', 'after': 1})
+
+        self.assertEqual([entry['step'] for entry in response.json()['logs']], [100, 150])
+        self.assertEqual(response.json()['next'], 5)
+
+
+class StageGraphTest(SimpleTestCase):
+
+    def test_stages_get_the_results_they_depend_on(self):
+        stages = StageGraph()
+        stages.add('ocr', lambda: 'John Smith')
+        stages.add('words', lambda text: text.split(), after=['ocr'])
+        stages.add('count', lambda text, words: (len(text), len(words)), after=['ocr', 'words'])
+
+        self.assertEqual(stages.run()['count'], (10, 2))
+        self.assertIsNone(stages.stopped)
+        self.assertEqual(set(stages.latencies), {'ocr', 'words', 'count'})
+        self.assertGreaterEqual(stages.total_latency, max(stages.latencies.values()))
+
+    def test_flagged_stage_stops_the_stages_after_it(self):
+        ran = []
+        stages = StageGraph()
+        stages.add('content_safety', lambda: 1, stop_if=bool)
+        stages.add('agent', lambda flag: ran.append('agent'), after=['content_safety'])
+        results = stages.run()
+
+        self.assertEqual(stages.stopped, 'content_safety')
+        self.assertNotIn('agent', results)
+        self.assertEqual(ran, [])
+
+
+class FakeAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keeps connections alive like the Azure endpoints
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.server.body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        body = json.dumps({'combinedPhrases': [{'text': 'John called'}], 'phrases': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Local stand-in for the Azure endpoints, counting the connections opened to it
+class FakeAzureServer(ThreadingHTTPServer):
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeAzureHandler)
+        self.connections = 0
+        self.requests = 0
+        self.body = b''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class AzureClientPoolTest(SimpleTestCase):
+
+    def test_requests_reuse_one_connection(self):
+        server = FakeAzureServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with override_settings(AZURE_SI_ENDPOINT=server.endpoint, CONTENT_CACHE=False), NamedTemporaryFile(suffix='.wav') as audio:
+            for _ in range(5):
+                text, _ = azure_speech_to_text(audio.name)
+
+        self.assertEqual(text, 'John called')
+        self.assertEqual(server.requests, 5)
+        self.assertEqual(server.connections, 1)
+
+    def test_tokens_are_fetched_again_shortly_before_they_expire(self):
+        cache = TokenCache(refresh_margin=60)
+        cache.get('arm', lambda: ('token-1', time.time() + 3600))
+        self.assertEqual(cache.get('arm', lambda: ('token-2', time.time() + 3600)), 'token-1')
+
+        cache.get('vi', lambda: ('token-3', time.time() + 30))
+        self.assertEqual(cache.get('vi', lambda: ('token-4', time.time() + 3600)), 'token-4')
+        self.assertEqual(cache.fetches, 3)
+
+    def test_the_refresh_margin_is_read_from_settings_when_used(self):
+        cache = TokenCache()
+        cache.get('arm', lambda: ('token-1', time.time() + 600))
+        with override_settings(AZURE_TOKEN_REFRESH_MARGIN=60):
+            self.assertEqual(cache.get('arm', lambda: ('token-2', time.time() + 3600)), 'token-1')
+        with override_settings(AZURE_TOKEN_REFRESH_MARGIN=900):
+            self.assertEqual(cache.get('arm', lambda: ('token-3', time.time() + 3600)), 'token-3')
+
+
+class ContentCacheTest(SimpleTestCase):
+
+    def test_same_audio_is_transcribed_once(self):
+        server = FakeAzureServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with TemporaryDirectory() as cache_path, override_settings(AZURE_SI_ENDPOINT=server.endpoint, CONTENT_CACHE=True, CONTENT_CACHE_PATH=cache_path):
+            with NamedTemporaryFile(suffix='.wav') as audio, NamedTemporaryFile(suffix='.wav') as copy:
+                for file in (audio, copy):
+                    file.write(b'RIFF same audio')
+                    file.flush()
+                self.assertEqual(azure_speech_to_text(audio.name)[0], 'John called')
+                self.assertEqual(azure_speech_to_text(copy.name)[0], 'John called')
+
+                self.assertEqual(server.requests, 1)
+                self.assertIn(b'\r\n\r\nRIFF same audio\r\n--', server.body)
+                stats = get_content_cache().stats()
+                self.assertEqual((stats['hits']['transcription'], stats['misses']['transcription']), (1, 1))
+
+
+class SaveUploadTest(SimpleTestCase):
+
+    def test_uploads_are_named_after_their_content(self):
+        with TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            first = save_upload(SimpleUploadedFile('scan.png', b'first'), 'image')
+            again = save_upload(SimpleUploadedFile('scan.png', b'first'), 'image')
+            second = save_upload(SimpleUploadedFile('scan.png', b'second'), 'image')
+
+            self.assertEqual(first, again)
+            self.assertNotEqual(first, second)
+            self.assertTrue(first.endswith('.png'))
+            with open(first, 'rb') as file:
+                self.assertEqual(file.read(), b'first')
+            self.assertEqual(file_digest(first), hashlib.sha256(b'first').hexdigest())
+
+    def test_uploads_over_the_limit_are_not_stored(self):
+        with TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, UPLOAD_MAX_SIZES={'audio': 4}):
+            upload = SimpleUploadedFile('call.wav', b'too long')
+            with self.assertRaises(UploadTooLarge):
+                save_upload(upload, 'audio')
+
+            # A size reported smaller than the content is caught while streaming
+            upload.size = 1
+            with self.assertRaises(UploadTooLarge):
+                save_upload(upload, 'audio')
+            self.assertEqual(os.listdir(os.path.join(media_root, 'uploads')), [])
+
+
+class AudioMutingTest(SimpleTestCase):
+
+    def test_merges_overlapping_intervals(self):
+        self.assertEqual(merge_intervals([(500, 900), (0, 100), (80, 200), (200, 300), (950, 940)]), [(0, 300), (500, 900)])
+
+    def test_mutes_redacted_frames_across_blocks(self):
+        samples = np.arange(1, 2 * 8000 + 1, dtype=np.int16).reshape(-1, 2) # 1 second of stereo at 8 kHz
+        with TemporaryDirectory() as directory, override_settings(AUDIO_BLOCK_SECONDS=0.3):
+            audio_path = os.path.join(directory, 'call.wav')
+            with wave.open(audio_path, 'wb') as audio:
+                audio.setnchannels(2)
+                audio.setsampwidth(2)
+                audio.setframerate(8000)
+                audio.writeframes(samples.tobytes())
+
+            output_path = os.path.join(directory, 'redacted.wav')
+            redact_wav(audio_path, output_path, [(250, 400), (300, 350), (900, 1500)])
+            with wave.open(output_path, 'rb') as output:
+                self.assertEqual((output.getnchannels(), output.getsampwidth(), output.getframerate()), (2, 2, 8000))
+                redacted = np.frombuffer(output.readframes(output.getnframes()), dtype=np.int16).reshape(-1, 2)
+
+        expected = samples.copy()
+        expected[2000:3200] = 0
+        expected[7200:] = 0
+        np.testing.assert_array_equal(redacted, expected)
+
+
+class ChunkedTranscriptionTest(SimpleTestCase):
+
+    def test_chunks_are_stitched_into_one_transcription(self):
+        server = FakeSpeechServer(seconds_per_minute=0.6)
+        self.addCleanup(server.close)
+
+        with TemporaryDirectory() as directory:
+            audio_path = os.path.join(directory, 'call.wav')
+            expected = build_recording(audio_path, [i % 9 + 1 for i in range(60)], frame_rate=8000)
+            with override_settings(AZURE_SI_ENDPOINT=server.endpoint, CONTENT_CACHE=False, SPEECH_CHUNK_SECONDS=5, SPEECH_SILENCE_SEARCH_SECONDS=1, SPEECH_MAX_CONCURRENCY=2):
+                text, transcription_json = azure_speech_to_text(audio_path)
+
+        words = [(word['text'], word['offsetMilliseconds'], word['durationMilliseconds']) for phrase in transcription_json['phrases'] for word in phrase['words']]
+        self.assertEqual(words, expected)
+        self.assertEqual(text, ' '.join(word for word, _, _ in expected))
+        self.assertGreater(server.requests, 1)
+        self.assertLessEqual(server.peak_active, 2)
+
+
+class PDFWriterTest(SimpleTestCase):
+
+    def test_redacts_every_page_as_an_incremental_update(self):
+        from PyPDF2 import PdfReader
+        from reportlab.pdfgen import canvas
+
+        with TemporaryDirectory() as directory:
+            pdf_path = os.path.join(directory, 'statement.pdf')
+            pdf = canvas.Canvas(pdf_path, pagesize=(612, 792))
+            for page_num in range(4):
+                pdf.drawString(72, 700, f'Page {page_num} of John Smith')
+                pdf.showPage()
+            pdf.save()
+
+            box = [(1, 1), (3, 1), (3, 1.5), (1, 1.5)] # Inches from the top left, as OCR gives them
+            output_path = os.path.join(directory, 'redacted.pdf')
+            redact_pdf_file(pdf_path, output_path, [[box], [], [box], [box, box]], [(8.5, 11)] * 4)
+
+            with open(pdf_path, 'rb') as original, open(output_path, 'rb') as redacted:
+                self.assertTrue(redacted.read().startswith(original.read()))
+            reader = PdfReader(output_path)
+            overlays = [b''.join(content.get_object().get_data() for content in page['/Contents']) if isinstance(page['/Contents'], list) else page['/Contents'].get_data() for page in reader.pages]
+
+        self.assertEqual(len(overlays), 4)
+        self.assertIn(b'72.00 684.00 144.00 36.00 re', overlays[0])
+        self.assertNotIn(b' re\n', overlays[1])
+        self.assertEqual(overlays[3].count(b'72.00 684.00 144.00 36.00 re'), 2)
+
+    def test_the_pdf_is_read_from_its_file_until_the_writer_closes(self):
+        from reportlab.pdfgen import canvas
+
+        with TemporaryDirectory() as directory:
+            pdf_path = os.path.join(directory, 'statement.pdf')
+            pdf = canvas.Canvas(pdf_path, pagesize=(612, 792))
+            pdf.drawString(72, 700, 'John Smith')
+            pdf.save()
+
+            for finish in ('close', 'discard'):
+                writer = RedactedPDFWriter(pdf_path, os.path.join(directory, f'{finish}.pdf'))
+                # A path would be read whole into a BytesIO by PyPDF2
+                self.assertIs(writer.reader.stream, writer.source)
+                self.assertFalse(writer.source.closed)
+                getattr(writer, finish)()
+                self.assertTrue(writer.source.closed)
+
+
+    def test_a_page_redacted_twice_keeps_its_graphics_state_balanced(self):
+        from PyPDF2 import PdfReader
+        from reportlab.pdfgen import canvas
+
+        with TemporaryDirectory() as directory:
+            pdf_path = os.path.join(directory, 'statement.pdf')
+            pdf = canvas.Canvas(pdf_path, pagesize=(612, 792))
+            pdf.drawString(72, 700, 'John Smith')
+            pdf.save()
+
+            output_path = os.path.join(directory, 'redacted.pdf')
+            writer = RedactedPDFWriter(pdf_path, output_path)
+            box = [(1, 1), (3, 1), (3, 1.5), (1, 1.5)]
+            writer.redact_page(0, [box], (8.5, 11))
+            writer.redact_page(0, [box], (8.5, 11))
+            writer.close()
+
+            page = PdfReader(output_path).pages[0]
+            operators = [operator for content in page['/Contents'] for operator in content.get_object().get_data().split()]
+
+        self.assertEqual(operators.count(b're'), 2)
+        depth = 0
+        for operator in operators:
+            depth += {b'q': 1, b'Q': -1}.get(operator, 0)
+            self.assertGreaterEqual(depth, 0)
+        self.assertEqual(depth, 0)
+
+
+class PDFShardingTest(SimpleTestCase):
+
+    pages = ["Call John Smith today", "Nothing here", "Still nothing", "More text", "John called back"]
+
+    def fake_ocr(self, pdf, pages=None):
+        # AnalyzeResult of the requested pages, each word a box one inch wide on the first line
+        first, last = map(int, pages.split('-')) if pages else (1, len(self.pages))
+        result_pages = []
+        content = ''
+        for page_number in range(first, last + 1):
+            start = len(content)
+            words = []
+            for i, word in enumerate(self.pages[page_number - 1].split()):
+                polygon = [SimpleNamespace(x=1 + i, y=1), SimpleNamespace(x=2 + i, y=1), SimpleNamespace(x=2 + i, y=1.5), SimpleNamespace(x=1 + i, y=1.5)]
+                words.append(SimpleNamespace(content=word, span=SimpleNamespace(offset=len(content), length=len(word)), polygon=polygon))
+                content += word + ' '
+            result_pages.append(SimpleNamespace(page_number=page_number, width=8.5, height=11, words=words, spans=[SimpleNamespace(offset=start, length=len(content) - start)]))
+        return SimpleNamespace(content=content, pages=result_pages)
+
+    def fake_assistant(self, texts, aggregation_strategy=None):
+        # Finds "John Smith" only, so "John" on the last page is redacted for being found on the first
+        return [[{'entity_group': 'PER', 'word': 'John Smith', 'start': text.find('John Smith'), 'end': text.find('John Smith') + 10, 'score': 0.99}] if 'John Smith' in text else [] for text in texts]
+
+    def redact(self, directory, flagged=lambda document: False):
+        from reportlab.pdfgen import canvas
+
+        pdf_path = os.path.join(directory, 'statement.pdf')
+        pdf = canvas.Canvas(pdf_path, pagesize=(612, 792))
+        for text in self.pages:
+            pdf.drawString(72, 700, text)
+            pdf.showPage()
+        pdf.save()
+
+        service = model_service.PDFRedactionService.__new__(model_service.PDFRedactionService)
+        service.degree, service.guardrail_toggle, service.entity_groups = 0, 0, {'PER'}
+        service.assistant = self.fake_assistant
+        with override_settings(CONTENT_CACHE=False, PDF_SHARD_PAGES=2, PDF_OCR_CONCURRENCY=3), \
+                mock.patch.object(model_service, 'azure_pdf_ocr', self.fake_ocr), \
+                mock.patch.object(model_service, 'guardrail_azure_cs_text', flagged), \
+                mock.patch.object(model_service, 'uploadOutputDB'), \
+                mock.patch.object(model_service, 'output_file_path', lambda path: os.path.join(directory, 'redacted.pdf')):
+            output, agents_speech = service.redact_pdf(pdf_path, '')
+        return service, output, agents_speech
+
+    def test_shards_are_redacted_with_words_found_in_other_shards(self):
+        from PyPDF2 import PdfReader
+
+        with TemporaryDirectory() as directory:
+            service, output, agents_speech = self.redact(directory)
+            reader = PdfReader(os.path.join(directory, 'redacted.pdf'))
+            boxes = [sum(content.get_object().get_data().count(b' re\n') for content in page['/Contents']) if isinstance(page['/Contents'], list) else 0 for page in reader.pages]
+
+        self.assertEqual(set(service.stage_latencies), {'1-2', '3-4', '5-5'})
+        self.assertEqual(boxes, [2, 0, 0, 0, 1])
+        self.assertIn('John', agents_speech[1])
+
+    def test_a_flagged_shard_flags_the_pdf(self):
+        with TemporaryDirectory() as directory:
+            _, output, _ = self.redact(directory, flagged=lambda document: 'More' in document.text)
+
+            self.assertEqual(output, 'flag')
+            self.assertFalse(os.path.exists(os.path.join(directory, 'redacted.pdf')))
+
+
+class RedactBatchTest(SimpleTestCase):
+
+    def test_outputs_are_archived_from_their_media_urls_with_unique_names(self):
+        import zipfile
+
+        with TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, MEDIA_URL='/media/'), ThreadPoolExecutor(2) as pool:
+            os.makedirs(os.path.join(media_root, 'outputs'))
+            for name in ('scan.png', 'scan_2.png'):
+                with open(os.path.join(media_root, 'outputs', name), 'wb') as output:
+                    output.write(name.encode())
+
+            # Services return the media URL of a redacted file, the text of a text file, or 'flag'
+            outputs = {'a': '/media/outputs/scan.png', 'b': '/media/outputs/scan_2.png', 'c': '/media/outputs/missing.pdf', 'd': '████ called', 'e': 'flag'}
+            files = [('scan.png', 'image', {'id': 'a'}), ('scan.png', 'image', {'id': 'b'}), ('report.pdf', 'pdf', {'id': 'c'}), ('note.txt', 'text', {'id': 'd'}), ('bad.png', 'image', {'id': 'e'})]
+            with mock.patch.object(batch, 'get_batch_pool', lambda: pool), mock.patch.object(batch, 'redact_batch_file', lambda kind, params: (outputs[params['id']], [], 0.1)):
+                archive_path, manifest = batch.redact_batch(files, os.path.join(media_root, 'outputs', 'batch.zip'))
+
+            with zipfile.ZipFile(archive_path) as archive:
+                names = sorted(archive.namelist())
+                images = sorted(archive.read(name) for name in names if name.startswith('scan_redacted'))
+
+        self.assertEqual(names, ['manifest.json', 'note_redacted.txt', 'scan_redacted.png', 'scan_redacted_2.png'])
+        self.assertEqual(images, [b'scan.png', b'scan_2.png'])
+        statuses = sorted((entry['file'], entry['status']) for entry in manifest)
+        self.assertEqual(statuses, [('bad.png', 'flagged'), ('note.txt', 'done'), ('report.pdf', 'failed'), ('scan.png', 'done'), ('scan.png', 'done')])
+
+
+class StubPipeline:
+    """
+        Token-classification pipeline returning one entity per text, the text itself, and failing on 'bad'.
+    """
+
+    tokenizer = None
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts, **kwargs):
+        self.calls.append((texts, kwargs))
+        if isinstance(texts, str):
+            if texts == 'bad':
+                raise ValueError('bad text')
+            return [{'word': texts}]
+        if 'bad' in texts:
+            raise ValueError('bad text')
+        return [[{'word': text}] for text in texts]
+
+
+class NERBatcherTest(SimpleTestCase):
+
+    def test_concurrent_texts_share_a_batch_by_pipeline_arguments(self):
+        pipeline = StubPipeline()
+        batcher = NERBatcher(pipeline, max_batch_size=8, max_wait_ms=200)
+        futures = [batcher.submit(text, aggregation_strategy='simple') for text in ('one', 'two', 'three')]
+        futures.append(batcher.submit('four', aggregation_strategy='first'))
+        results = [future.result(timeout=5) for future in futures]
+        batcher.close()
+
+        self.assertEqual(results, [[{'word': 'one'}], [{'word': 'two'}], [{'word': 'three'}], [{'word': 'four'}]])
+        self.assertEqual(sorted((texts, kwargs['aggregation_strategy']) for texts, kwargs in pipeline.calls),
+                         [(['four'], 'first'), (['one', 'two', 'three'], 'simple')])
+        self.assertEqual(batcher.stats()['batches'], 2)
+
+    def test_empty_texts_are_not_run(self):
+        pipeline = StubPipeline()
+        batcher = NERBatcher(pipeline)
+
+        self.assertEqual(batcher(['', '  ', 'name']), [[], [], [{'word': 'name'}]])
+        self.assertEqual(pipeline.calls[0][0], ['name'])
+        batcher.close()
+
+    def test_a_failing_text_only_fails_its_own_call(self):
+        pipeline = StubPipeline()
+        batcher = NERBatcher(pipeline, max_batch_size=8, max_wait_ms=200)
+        futures = [batcher.submit(text) for text in ('one', 'bad', 'two')]
+
+        self.assertEqual(futures[0].result(timeout=5), [{'word': 'one'}])
+        self.assertEqual(futures[2].result(timeout=5), [{'word': 'two'}])
+        with self.assertRaises(ValueError):
+            futures[1].result(timeout=5)
+        batcher.close()
+
+    def test_close_stops_the_worker_after_the_queued_texts(self):
+        batcher = NERBatcher(StubPipeline(), max_wait_ms=200)
+        future = batcher.submit('queued')
+        batcher.close()
+        batcher._thread.join(5)
+
+        self.assertFalse(batcher._thread.is_alive())
+        self.assertEqual(future.result(timeout=5), [{'word': 'queued'}])
+        # Texts submitted after close run directly on the pipeline
+        self.assertEqual(batcher('late'), [{'word': 'late'}])
+
+
+class StubTagger:
+    """
+        POS tagger tagging capitalized words as proper nouns, counting the sentences it tags.
+    """
+
+    def __init__(self):
+        self.tagged = 0
+
+    def tag(self, tokens):
+        return self.tag_sents([tokens])[0]
+
+    def tag_sents(self, sentences):
+        self.tagged += len(sentences)
+        return [[(token, 'NNP' if token[0].isupper() else 'NN') for token in sentence] for sentence in sentences]
+
+
+class POSTaggingTest(SimpleTestCase):
+
+    def test_sentences_are_cut_after_sentence_ends_and_long_runs(self):
+        document = AnalyzedDocument('Alice met Bob.  Then they left!\nno end')
+        self.assertEqual(document.sentences, [(0, 3), (3, 6), (6, 8)])
+        self.assertEqual(AnalyzedDocument('   ').sentences, [])
+        long_document = AnalyzedDocument(' '.join(['word'] * (MAX_SENTENCE_TOKENS + 1)))
+        self.assertEqual(long_document.sentences, [(0, MAX_SENTENCE_TOKENS), (MAX_SENTENCE_TOKENS, MAX_SENTENCE_TOKENS + 1)])
+
+    def test_sentences_are_tagged_once_and_evicted_by_age(self):
+        tagger = StubTagger()
+        with mock.patch.object(guardrails, 'get_pos_tagger', lambda: tagger), mock.patch.object(guardrails, 'pos_tag_cache', guardrails.OrderedDict()), mock.patch.object(guardrails, 'POS_TAG_CACHE_SIZE', 2):
+            first, second, third = ('Alice', 'left'), ('they', 'met', 'Bob'), ('no', 'one')
+            # The batch is larger than the cache, every sentence still gets its tags
+            self.assertEqual(guardrails.tag_sentences([first, second, first, third]), [('NNP', 'NN'), ('NN', 'NN', 'NNP'), ('NNP', 'NN'), ('NN', 'NN')])
+            self.assertEqual(tagger.tagged, 3)
+            self.assertEqual(list(guardrails.pos_tag_cache), [second, third])
+
+            self.assertEqual(guardrails.tag_sentences([third]), [('NN', 'NN')])
+            self.assertEqual(tagger.tagged, 3)
+
+    def test_the_cache_is_shared_by_threads(self):
+        tagger = StubTagger()
+        errors = []
+
+        def tag(offset):
+            try:
+                for i in range(200):
+                    sentences = [(f'Word{(offset + i + j) % 50}', 'end') for j in range(5)]
+                    self.assertEqual(guardrails.tag_sentences(sentences), [('NNP', 'NN')] * 5)
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(guardrails, 'get_pos_tagger', lambda: tagger), mock.patch.object(guardrails, 'pos_tag_cache', guardrails.OrderedDict()), mock.patch.object(guardrails, 'POS_TAG_CACHE_SIZE', 10):
+            threads = [threading.Thread(target=tag, args=(offset,)) for offset in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+
+
+class StubTokenizer:
+    """
+        Fast tokenizer stub with one token per whitespace separated word, and two special tokens.
+    """
+
+    def num_special_tokens_to_add(self):
+        return 2
+
+    def __call__(self, texts, add_special_tokens=False, return_offsets_mapping=True):
+        return {'offset_mapping': [[(match.start(), match.end()) for match in re.finditer(r'\S+', text)] for text in texts]}
+
+
+class StubAssistant:
+    """
+        Token-classification pipeline stub finding every capitalized word, with offsets in the text it is given.
+    """
+
+    def __init__(self):
+        self.windows = []
+
+    def __call__(self, texts, **kwargs):
+        self.windows += texts
+        return [[{'entity_group': 'PER', 'word': match.group(), 'start': match.start(), 'end': match.end()} for match in re.finditer(r'[A-Z]\w*', text)] for text in texts]
+
+
+class TextChunkerTest(SimpleTestCase):
+
+    def capitalized(self, text):
+        return [(match.start(), match.group()) for match in re.finditer(r'[A-Z]\w*', text)]
+
+    def test_entities_of_later_windows_get_document_offsets_once(self):
+        text = ' '.join(f'Name{i} met someone today.' for i in range(20))
+        chunker = TextChunker(StubTokenizer(), max_tokens=12, overlap_tokens=4, batch_size=3)
+        assistant = StubAssistant()
+        windows = list(chunker.windows(text))
+        entities = chunker.analyze(assistant, text)
+
+        self.assertGreater(len(windows), 3)
+        self.assertTrue(all(len(text[start:end].split()) <= 10 for start, end in windows))
+        # Consecutive windows overlap, so the entities there are found twice and reported once
+        overlaps = [(later[0], earlier[1]) for earlier, later in zip(windows, windows[1:])]
+        self.assertTrue(all(start < end for start, end in overlaps))
+        self.assertTrue(any(start <= position < end for position, _ in self.capitalized(text) for start, end in overlaps))
+        self.assertGreater(sum(len(self.capitalized(window)) for window in assistant.windows), len(self.capitalized(text)))
+        self.assertEqual([(entity['start'], entity['word']) for entity in entities], self.capitalized(text))
+        self.assertTrue(all(text[entity['start']:entity['end']] == entity['word'] for entity in entities))
+
+    def test_sentences_longer_than_a_window_are_cut(self):
+        text = ' '.join(f'Word{i}' if i % 3 == 0 else f'word{i}' for i in range(40))
+        chunker = TextChunker(StubTokenizer(), max_tokens=12, overlap_tokens=4)
+        windows = list(chunker.windows(text))
+        entities = chunker.analyze(StubAssistant(), text)
+
+        self.assertGreater(len(windows), 1)
+        self.assertTrue(all(len(text[start:end].split()) <= 10 for start, end in windows))
+        self.assertEqual([(entity['start'], entity['word']) for entity in entities], self.capitalized(text))
+
+    def test_empty_and_whitespace_texts_have_no_windows(self):
+        chunker = TextChunker(StubTokenizer(), max_tokens=12, overlap_tokens=4)
+        assistant = StubAssistant()
+
+        for text in ('', '   ', '\n\n\t'):
+            self.assertEqual(list(chunker.windows(text)), [])
+            self.assertEqual(chunker.analyze(assistant, text), [])
+        self.assertEqual(assistant.windows, [])
@@ -5,4 +5,10 @@ from . import views
 urlpatterns = [
     path('', views.index, name="index"),
     path('training/', views.begin_training, name="begin_training"),
+    path('training/logs/', views.training_logs, name="training_logs"),
+    path('training/<uuid:run_id>/', views.training_status, name="training_status"),
+    path('training/<uuid:run_id>/cancel/', views.cancel_training, name="cancel_training"),
+    path('ready/', views.readiness, name="readiness"),
+    path('jobs/', views.submit_job, name="submit_job"),
+    path('jobs/<uuid:job_id>/', views.job_status, name="job_status"),
 ]
\ No newline at end of file
@@ -1,29 +1,35 @@
 import os
 import time
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+import uuid
+from django.core.exceptions import ValidationError
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.utils.text import slugify
 from .services.model_service import TextRedactionService, ImageRedactionService, PDFRedactionService, AudioRedactionService, VideoRedactionService
-from .services.model_training import train_model
+from .services.training_runner import get_training_runner, read_training_logs
+from .services.registry import model_registry
+from .services.jobs import get_job_runner, media_url
+from .services.batch import redact_batch
+from .services.cache import get_content_cache
+from .services import db_service
+from .services.uploads import UploadTooLarge, check_upload_size, save_upload
+from .models import redactionJob, trainingRun
+from .services.utils import RegexPatternError, compile_regexPattern
 from django.conf import settings
-import re
 
 def handle_uploaded_file(file):
     if file.content_type == 'text/plain':
         return text_file_to_string(file)
 
-def save_image_file(file):
-    file_path = f'uploads/{file.name}'
-    if default_storage.exists(file_path):
-        default_storage.delete(file_path)
-    file_name = default_storage.save(file_path, ContentFile(file.read()))
-    file_url = default_storage.url(file_name)
-    return file.name
+# Streams an uploaded file to the uploads folder, returns its path
+def save_uploaded_file(file):
+    return save_upload(file, file_job_kind(file.name))
 
+# Text files are redacted as a whole, so they are read into memory within the size limit of text files
 def text_file_to_string(txt_file):
-    return txt_file.read().decode('utf-8')
+    check_upload_size(txt_file, 'text')
+    return b''.join(txt_file.chunks()).decode('utf-8')
 
 def is_image_file(file_name):
     image_extensions = ['.png', '.jpg', '.jpeg']
@@ -79,97 +85,260 @@ def index(request):
         wordsToRemove = form_data.get('wordsToRemove').split(',')
         regexPattern = form_data.get('regexPattern')
 
-        if form_data.get('files'):
-            for file in form_data['files']:
-                if is_document_file(file.name):
-                    # Redacts text files
-                    file_text = handle_uploaded_file(file)
-
-                    if degree >= 2:
-                        degree = 2
-
-                    service = TextRedactionService(degree, guardrail_toggle)
-                    redacted_text, agents_speech = service.redact_text(file_text, regexPattern, wordsToRemove)
-
-                    # Check for content safety flag
-                    if redacted_text == 'flag':
-                        return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
-
-                    redacted_text = re.sub(r'\*(.*?)\*', lambda match: '█' * len(match.group(1)), redacted_text)
-                    redacted_file_url = save_redacted_file(redacted_text, file.name)
-                    return render(request, 'index.html', {'redacted_text': redacted_text, 'redacted_file_url': redacted_file_url, 'agents_speech': agents_speech})
-
-                elif is_image_file(file.name):
-                    # Redacts images
-                    image_url = os.path.join(settings.BASE_DIR, 'media', 'uploads', save_image_file(file))
-                    print(image_url)
-
-                    service = ImageRedactionService(degree, guardrail_toggle)
-                    redacted_image_url, agents_speech = service.redact_image(image_url, regexPattern, wordsToRemove)
-
-                    # Check for content safety flag
-                    if redacted_image_url == 'flag':
-                        return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
-
-                    redacted_image_url = redacted_image_url.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
-                    print(redacted_image_url)
-                    return render(request, 'index.html', {'redacted_image_url': redacted_image_url, 'agents_speech': agents_speech})
+        try:
+            # Checking the regex pattern before any file is processed
+            if regexPattern:
+                compile_regexPattern(regexPattern)
+
+            if len(form_data['files']) > 1:
+                # Redacts all files in parallel into one zip
+                archive_path, manifest = redact_uploaded_batch(form_data['files'], degree, guardrail_toggle, regexPattern, wordsToRemove)
+                agents_speech = []
+                for entry in manifest:
+                    agents_speech.append('<h4>' + entry['file'] + ': ' + entry['status'] + '</h4>')
+                    agents_speech += entry.get('agents_speech', [])
+                return render(request, 'index.html', {'redacted_file_url': media_url(archive_path), 'agents_speech': agents_speech})
+
+            elif form_data.get('files'):
+                for file in form_data['files']:
+                    if is_document_file(file.name):
+                        # Redacts text files
+                        file_text = handle_uploaded_file(file)
+
+                        if degree >= 2:
+                            degree = 2
+
+                        service = TextRedactionService(degree, guardrail_toggle)
+                        redacted_text, agents_speech = service.redact_text(file_text, regexPattern, wordsToRemove)
+
+                        # Check for content safety flag
+                        if redacted_text == 'flag':
+                            return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
+
+                        redacted_file_url = save_redacted_file(redacted_text, file.name)
+                        return render(request, 'index.html', {'redacted_text': redacted_text, 'redacted_file_url': redacted_file_url, 'agents_speech': agents_speech})
+
+                    elif is_image_file(file.name):
+                        # Redacts images
+                        image_url = save_uploaded_file(file)
+                        print(image_url)
+
+                        service = ImageRedactionService(degree, guardrail_toggle)
+                        redacted_image_url, agents_speech = service.redact_image(image_url, regexPattern, wordsToRemove)
+
+                        # Check for content safety flag
+                        if redacted_image_url == 'flag':
+                            return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
+
+                        redacted_image_url = redacted_image_url.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+                        print(redacted_image_url)
+                        return render(request, 'index.html', {'redacted_image_url': redacted_image_url, 'agents_speech': agents_speech})
                 
-                elif is_pdf_file(file.name):
-                    # Redacts PDFs
-                    pdf_url = os.path.join(settings.BASE_DIR, 'media', 'uploads', save_image_file(file))
-                    print(pdf_url)
+                    elif is_pdf_file(file.name):
+                        # Redacts PDFs
+                        pdf_url = save_uploaded_file(file)
+                        print(pdf_url)
 
-                    service = PDFRedactionService(degree, guardrail_toggle)
-                    redacted_file_url, agents_speech = service.redact_pdf(pdf_url, regexPattern, wordsToRemove)
+                        service = PDFRedactionService(degree, guardrail_toggle)
+                        redacted_file_url, agents_speech = service.redact_pdf(pdf_url, regexPattern, wordsToRemove)
 
-                    return render(request, 'index.html', {'redacted_file_url': redacted_file_url, 'agents_speech': agents_speech})
+                        return render(request, 'index.html', {'redacted_file_url': redacted_file_url, 'agents_speech': agents_speech})
                 
-                elif is_audio_file(file.name):
-                    # Redacts audio
-                    audio_url = os.path.join(settings.BASE_DIR, 'media', 'uploads', save_image_file(file))
-                    print(audio_url)
+                    elif is_audio_file(file.name):
+                        # Redacts audio
+                        audio_url = save_uploaded_file(file)
+                        print(audio_url)
 
-                    service = AudioRedactionService(degree, guardrail_toggle)
-                    redacted_audio_url, agents_speech = service.redact_audio(audio_url)
+                        service = AudioRedactionService(degree, guardrail_toggle)
+                        redacted_audio_url, agents_speech = service.redact_audio(audio_url)
 
-                    return render(request, 'index.html', {'redacted_audio_url': redacted_audio_url, 'agents_speech': agents_speech})
+                        return render(request, 'index.html', {'redacted_audio_url': redacted_audio_url, 'agents_speech': agents_speech})
                 
-                elif is_video_file(file.name):
-                    # Redacts videos
-                    video_url = os.path.join(settings.BASE_DIR, 'media', 'uploads', save_image_file(file))
-                    print(video_url)
+                    elif is_video_file(file.name):
+                        # Redacts videos
+                        video_url = save_uploaded_file(file)
+                        print(video_url)
 
-                    service = VideoRedactionService(degree, guardrail_toggle)
-                    redacted_video_url, agents_speech = service.redact_video(video_url)
+                        service = VideoRedactionService(degree, guardrail_toggle)
+                        redacted_video_url, agents_speech = service.redact_video(video_url)
 
-                    # Check for flags
-                    if redacted_video_url == 'error':
-                        return render(request, 'index.html', {'error': 'Could not process the video at this time. Please try again later.'})
-                    print(redacted_video_url)
+                        # Check for flags
+                        if redacted_video_url == 'error':
+                            return render(request, 'index.html', {'error': 'Could not process the video at this time. Please try again later.'})
+                        print(redacted_video_url)
 
-                    return render(request, 'index.html', {'redacted_video_url': redacted_video_url, 'agents_speech': agents_speech})
+                        return render(request, 'index.html', {'redacted_video_url': redacted_video_url, 'agents_speech': agents_speech})
                 
-        elif form_data.get('wordsTextarea'):
-            # Redacts text from textarea
-            user_text = form_data['wordsTextarea']
-            service = TextRedactionService(degree, guardrail_toggle)
-            redacted_text, agents_speech = service.redact_text(user_text, regexPattern, wordsToRemove)
-
-            # Check for content safety flag
-            if redacted_text == 'flag':
-                return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
-
-            redacted_text = re.sub(r'\*(.*?)\*', lambda match: '█' * len(match.group(1)), redacted_text)
-            return render(request, 'index.html', {'redacted_text': redacted_text, 'agents_speech': agents_speech})
-
-        else:
-            return JsonResponse({'error': 'No text provided for redaction'}, status=400)
-
-    if request.GET.get('training_complete'):
-        return render(request, 'index.html', {'training_complete': True, 'train_runtime': request.GET.get('runtime'), 'train_loss': request.GET.get('loss')})
+            elif form_data.get('wordsTextarea'):
+                # Redacts text from textarea
+                user_text = form_data['wordsTextarea']
+                service = TextRedactionService(degree, guardrail_toggle)
+                redacted_text, agents_speech = service.redact_text(user_text, regexPattern, wordsToRemove)
+
+                # Check for content safety flag
+                if redacted_text == 'flag':
+                    return render(request, 'index.html', {'flag': 'The data you submitted was flagged for content safety violations.'})
+
+                return render(request, 'index.html', {'redacted_text': redacted_text, 'agents_speech': agents_speech})
+
+            else:
+                return JsonResponse({'error': 'No text provided for redaction'}, status=400)
+        except (RegexPatternError, UploadTooLarge) as e:
+            # Regex patterns that are invalid, too complex or time out while matching, and files over the size limit
+            return render(request, 'index.html', {'error': str(e)})
+
+    if request.GET.get('training_run'):
+        try:
+            run = trainingRun.objects.filter(run_id=request.GET.get('training_run')).first()
+        except ValidationError:
+            run = None
+        return render(request, 'index.html', {'training_run': run})
     return render(request, 'index.html', {'redacted_text': None})
 
+# Starts a fine-tuning run in the background, or shows the one already running
 def begin_training(request):
-    metrics = train_model()
-    return redirect(f"/?training_complete=true&runtime={metrics['train_runtime']}&loss={metrics['train_loss']}")
+    run, _ = get_training_runner().start()
+    return redirect(f"/?training_run={run.run_id}")
+
+# Progress of a fine-tuning run, polled by the client
+def training_status(request, run_id):
+    run = trainingRun.objects.filter(run_id=run_id).first()
+    if run is None:
+        return JsonResponse({'error': 'Unknown training run'}, status=404)
+
+    response = {
+        'run_id': str(run.run_id),
+        'status': run.status,
+        'step': run.step,
+        'max_steps': run.max_steps,
+        'epoch': run.epoch,
+        'loss': run.loss,
+        'eta_seconds': run.eta_seconds,
+        'cancel_requested': run.cancel_requested,
+        'new_labels': run.new_labels,
+        'created': run.created,
+        'started': run.started,
+        'finished': run.finished,
+    }
+    if run.status == 'done':
+        response['metrics'] = run.metrics
+    elif run.status in ('failed', 'skipped'):
+        response['error'] = run.error
+    return JsonResponse(response)
+
+def cancel_training(request, run_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Training runs are cancelled with POST'}, status=405)
+    if not get_training_runner().cancel(run_id):
+        return JsonResponse({'error': 'The training run is not queued or running'}, status=409)
+    return training_status(request, run_id)
+
+# Entries of the training metrics log, of one run when ?run= is given, after the first ?after= lines
+def training_logs(request):
+    try:
+        after = max(int(request.GET.get('after') or 0), 0)
+        limit = min(max(int(request.GET.get('limit') or 1000), 1), 1000)
+    except ValueError:
+        return JsonResponse({'error': 'after and limit must be numbers'}, status=400)
+    entries, next_after = read_training_logs(request.GET.get('run'), after, limit)
+    return JsonResponse({'logs': entries, 'next': next_after})
+
+# Reports whether the shared models are loaded, with load times and memory usage, and the hits and misses of the content cache
+def readiness(request):
+    status = model_registry.status()
+    content_cache = get_content_cache()
+    if content_cache is not None:
+        status['cache'] = content_cache.stats()
+    if db_service.feedback_writer is not None:
+        status['feedback'] = db_service.feedback_writer.stats()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
+
+# Kind of redaction job for an uploaded file
+def file_job_kind(file_name):
+    if is_document_file(file_name):
+        return 'text'
+    elif is_image_file(file_name):
+        return 'image'
+    elif is_pdf_file(file_name):
+        return 'pdf'
+    elif is_audio_file(file_name):
+        return 'audio'
+    elif is_video_file(file_name):
+        return 'video'
+    return None
+
+# Saves the uploaded files of a batch and redacts them in parallel
+# Returns the path of the zip with the outputs and the manifest
+def redact_uploaded_batch(files, degree, guardrail_toggle, regexPattern, wordsToRemove):
+    batch_files = []
+    for file in files:
+        kind = file_job_kind(file.name)
+        params = {'degree': degree, 'guardrail_toggle': guardrail_toggle, 'regexPattern': regexPattern, 'wordsToRemove': wordsToRemove}
+        if kind == 'text':
+            params['text'] = handle_uploaded_file(file)
+        elif kind is not None:
+            params['path'] = save_uploaded_file(file)
+        batch_files.append((file.name, kind or 'unknown', params))
+
+    archive_path = os.path.join(settings.MEDIA_ROOT, 'outputs', f'redacted_batch_{time.strftime("%Y%m%d-%H%M%S")}_{uuid.uuid4().hex[:8]}.zip')
+    return redact_batch(batch_files, archive_path)
+
+# Queues a redaction job, with the same fields as the form of the index page
+# Returns the job id right away, the result is polled at /jobs/<job_id>/
+def submit_job(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Redaction jobs are submitted with POST'}, status=405)
+
+    degree = min(int(request.POST.get('rangeInput') or 0), 2)
+    params = {
+        'degree': degree,
+        'guardrail_toggle': int(request.POST.get('guardrails') or 1),
+        'wordsToRemove': (request.POST.get('wordsToRemove') or '').split(','),
+        'regexPattern': request.POST.get('regexPattern'),
+    }
+    try:
+        if params['regexPattern']:
+            compile_regexPattern(params['regexPattern'])
+    except RegexPatternError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    files = request.FILES.getlist('files')
+    if files:
+        kind = file_job_kind(files[0].name)
+        if kind is None:
+            return JsonResponse({'error': 'Unsupported file type'}, status=400)
+        try:
+            if kind == 'text':
+                params['text'] = handle_uploaded_file(files[0])
+            else:
+                params['path'] = save_uploaded_file(files[0])
+        except UploadTooLarge as e:
+            return JsonResponse({'error': str(e)}, status=413)
+    elif request.POST.get('wordsTextarea'):
+        kind = 'text'
+        params['text'] = request.POST['wordsTextarea']
+    else:
+        return JsonResponse({'error': 'No text provided for redaction'}, status=400)
+
+    job = get_job_runner().submit(kind, params)
+    return JsonResponse({'job_id': str(job.job_id), 'status': job.status, 'status_url': reverse('job_status', args=[job.job_id])}, status=202)
+
+# Status of a redaction job, with its result once it is done
+def job_status(request, job_id):
+    job = redactionJob.objects.filter(job_id=job_id).first()
+    if job is None:
+        return JsonResponse({'error': 'Unknown or expired job'}, status=404)
+
+    response = {
+        'job_id': str(job.job_id),
+        'kind': job.kind,
+        'status': job.status,
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+    }
+    if job.status == 'done':
+        response['result'] = job.result
+    elif job.status == 'failed':
+        response['error'] = job.error
+    return JsonResponse(response)
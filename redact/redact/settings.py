@@ -152,7 +152,108 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 MODEL_PATH = os.path.join(BASE_DIR, 'models')
-MODEL_TRAINING_LOGS = os.path.join(MODEL_PATH, 'training_logs.json')
+MODEL_TRAINING_LOGS = os.path.join(MODEL_PATH, 'training_logs.jsonl')
+
+# Fine-tuning streams the training labels from the database TRAINING_CHUNK_SIZE pairs at a time
+# One pair in every TRAINING_EVAL_BUCKETS, by id, is kept for evaluation
+TRAINING_CHUNK_SIZE = 1000
+TRAINING_EVAL_BUCKETS = 10
+
+# Each run trains on the training labels seen since the last finished run, with TRAINING_REPLAY_RATIO older labels replayed for each new one
+# Runs with fewer than TRAINING_MIN_NEW_LABELS new labels are skipped
+TRAINING_REPLAY_RATIO = 0.2
+TRAINING_MIN_NEW_LABELS = 100
+
+# Fine-tuning runs in a separate process limited to TRAINING_CPU_THREADS CPUs, TRAINING_NICENESS below the priority of serving
+# Progress is saved, and cancellation checked, every TRAINING_PROGRESS_SECONDS. Losses are logged every TRAINING_LOGGING_STEPS steps and checkpoints saved every TRAINING_CHECKPOINT_STEPS
+TRAINING_CPU_THREADS = max(1, (os.cpu_count() or 1) // 4)
+TRAINING_NICENESS = 10
+TRAINING_PROGRESS_SECONDS = 5
+TRAINING_LOGGING_STEPS = 50
+TRAINING_CHECKPOINT_STEPS = 500
+TRAINING_PROCESS_LOG = os.path.join(MODEL_PATH, 'training_process.log') # Output of the training processes
 
 YOLO_MODEL_ROOT = os.path.join(BASE_DIR, 'yolo')
 YOLO_MODEL_PATH = os.path.join(BASE_DIR, 'yolo', 'yolov8n_100e.pt')
+
+# NLTK data (the POS tagger of the proper nouns guardrail), searched before the system NLTK paths
+NLTK_DATA_PATH = os.path.join(BASE_DIR, 'nltk_data')
+
+# Load the NER pipeline and YOLO model once when the app starts, instead of on the first request
+WARM_MODELS_ON_STARTUP = True
+
+# Micro-batching of concurrent NER calls into padded batches
+NER_BATCHING = True
+NER_BATCH_MAX_SIZE = 8
+NER_BATCH_MAX_WAIT_MS = 10
+
+# Sliding-window chunking of long documents for the agent
+NER_CHUNK_MAX_TOKENS = 512
+NER_CHUNK_OVERLAP_TOKENS = 64
+NER_CHUNK_BATCH_SIZE = 16
+
+# Azure clients are created once per process over one keep-alive HTTP session: hosts kept, connections kept per host
+# Access tokens are fetched again this many seconds before they expire
+AZURE_HTTP_POOL_CONNECTIONS = 10
+AZURE_HTTP_POOL_SIZE = 20
+AZURE_TOKEN_REFRESH_MARGIN = 300
+
+# Largest upload accepted for each type of file, in bytes. Uploads are streamed to disk, so these only bound disk use and processing time
+UPLOAD_MAX_SIZES = {
+    'text': 10 * 1024 ** 2,
+    'image': 50 * 1024 ** 2,
+    'pdf': 200 * 1024 ** 2,
+    'audio': 2 * 1024 ** 3,
+    'video': 4 * 1024 ** 3,
+}
+
+# Redacted audio is muted, or bleeped with a tone of this frequency in Hz when set
+# WAV files are redacted in blocks of AUDIO_BLOCK_SECONDS, other formats are decoded whole with ffmpeg
+AUDIO_BLEEP_FREQUENCY = None
+AUDIO_BLOCK_SECONDS = 30
+
+# Long WAV recordings are transcribed in chunks of about SPEECH_CHUNK_SECONDS, cut at the quietest point within SPEECH_SILENCE_SEARCH_SECONDS
+# Chunks overlap by SPEECH_CHUNK_OVERLAP_SECONDS on each side, and at most SPEECH_MAX_CONCURRENCY are sent at a time
+SPEECH_CHUNKING = True
+SPEECH_CHUNK_SECONDS = 120
+SPEECH_SILENCE_SEARCH_SECONDS = 10
+SPEECH_CHUNK_OVERLAP_SECONDS = 1
+SPEECH_MAX_CONCURRENCY = 4
+
+# PDFs longer than PDF_SHARD_PAGES pages are OCRed in shards of that many pages, at most PDF_OCR_CONCURRENCY at a time
+PDF_SHARD_PAGES = 20
+PDF_OCR_CONCURRENCY = 4
+
+# Rows of detected words kept for training are written in the background, in transactions of up to FEEDBACK_BATCH_SIZE rows, at least every FEEDBACK_FLUSH_SECONDS
+# When FEEDBACK_MAX_QUEUED rows are waiting, requests wait up to FEEDBACK_PUT_TIMEOUT seconds for room before their rows are dropped
+# On shutdown, queued rows are written for up to FEEDBACK_SHUTDOWN_TIMEOUT seconds
+FEEDBACK_WRITE_BEHIND = True
+FEEDBACK_BATCH_SIZE = 500
+FEEDBACK_FLUSH_SECONDS = 1.0
+FEEDBACK_MAX_QUEUED = 50000
+FEEDBACK_PUT_TIMEOUT = 5.0
+FEEDBACK_SHUTDOWN_TIMEOUT = 30
+
+# Disk cache of OCR results, transcriptions, content safety verdicts and final outputs, keyed by the SHA-256 of the input
+# Least recently used entries are evicted past CONTENT_CACHE_SIZE bytes
+CONTENT_CACHE = True
+CONTENT_CACHE_PATH = os.path.join(BASE_DIR, 'cache')
+CONTENT_CACHE_SIZE = 2 * 1024 ** 3
+
+# Redaction jobs: worker threads for text, image and PDF jobs, for audio and video jobs, and hours finished jobs are kept
+JOB_WORKERS = 4
+JOB_MEDIA_WORKERS = 2
+JOB_RETENTION_HOURS = 24
+
+# Worker processes redacting the files of a batch upload, None for one per CPU
+BATCH_WORKERS = None
+
+# Regex patterns sent by users: compiled patterns kept, maximum length, and seconds allowed for finding each match
+# The pattern cache is built on first use, and built again empty when REGEX_CACHE_SIZE changes
+REGEX_CACHE_SIZE = 256
+REGEX_MAX_LENGTH = 500
+REGEX_MATCH_TIMEOUT = 0.5
+
+# Inference backend of the agent: 'pytorch', 'onnx' or 'onnx-int8' (needs optimum[onnxruntime])
+NER_BACKEND = 'pytorch'
+ONNX_MODEL_PATH = os.path.join(BASE_DIR, 'models_onnx')